@@ -0,0 +1,116 @@
+#! /usr/bin/python3
+#
+# Microbenchmark for the packet codec in tftp.py. Compares the string based
+# functions (make_packet_data, parse_packet, recvfrom) with the buffer codec
+# (PacketBuffer, parse_packet_view, recvfrom_into) and prints packets per
+# second for each. DATA packets are also built from a tftp_io block source,
+# the way tftp_transfer does it.
+#
+#  bash$ ./bench_codec.py [BLOCK_SIZE] [N_PACKETS]
+import sys,os,socket,time
+import tftp,tftp_io
+
+
+def rate(func, n):
+    start = time.time()
+    func(n)
+    return n / (time.time() - start)
+
+
+def build_string(fd, block_size):
+    def run(n):
+        for i in range(n):
+            data = fd.read(block_size)
+            if len(data) < block_size:
+                fd.seek(0)
+            tftp.make_packet_data(i & 0xFFFF, data)
+    return run
+
+def build_buffer(fd, block_size):
+    buf = tftp.PacketBuffer(block_size)
+    def run(n):
+        for i in range(n):
+            if buf.read_data(i & 0xFFFF, fd) < block_size:
+                fd.seek(0)
+    return run
+
+def build_source(fd, block_size):
+    buf = tftp.PacketBuffer(block_size)
+    source = tftp_io.open_source(fd, block_size)
+    def run(n):
+        blocknr = 1
+        for i in range(n):
+            if buf.fill(i & 0xFFFF, source.block(blocknr)) < block_size:
+                blocknr = 0
+            source.release(blocknr)
+            blocknr += 1
+    return run
+
+def parse_string(packet):
+    def run(n):
+        for i in range(n):
+            tftp.parse_packet(packet)
+    return run
+
+def parse_buffer(packet):
+    buf = bytearray(packet)
+    view = memoryview(buf)
+    nbytes = len(packet)
+    def run(n):
+        for i in range(n):
+            tftp.parse_packet_view(view, nbytes)
+    return run
+
+def loopback(packet, use_buffer):
+    """Send packets over loopback and parse them on the receiving side. Sends
+        in batches so the socket buffer does not overflow"""
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(("127.0.0.1", 0))
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    addr = rx.getsockname()
+    buf = bytearray(len(packet))
+    view = memoryview(buf)
+
+    def run(n):
+        for i in range(0, n, 64):
+            for j in range(64):
+                tx.sendto(packet, addr)
+            for j in range(64):
+                if use_buffer:
+                    (nbytes, sender) = rx.recvfrom_into(buf)
+                    tftp.parse_packet_view(view, nbytes)
+                else:
+                    (data, sender) = rx.recvfrom(len(packet))
+                    tftp.parse_packet(data)
+    return run
+
+
+def main():
+    block_size = tftp.blksize_for_mtu(tftp.PATH_MTU)
+    n = 200000
+    if len(sys.argv) > 1:
+        block_size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n = int(sys.argv[2])
+
+    packet = tftp.make_packet_data(1, b"x" * block_size)
+    # Any file will do, it is read over and over again
+    fd = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "large.jpeg"), "rb")
+
+    print("Block size %d, %d packets per test" % (block_size, n))
+    print("%-24s %14s %14s %8s" % ("", "string pkt/s", "buffer pkt/s", "speedup"))
+    tests = [("build DATA from file", build_string(fd, block_size), build_buffer(fd, block_size)),
+             ("build DATA from source", build_string(fd, block_size), build_source(fd, block_size)),
+             ("parse DATA", parse_string(packet), parse_buffer(packet)),
+             ("loopback send+parse", loopback(packet, False), loopback(packet, True))]
+    for (name, old, new) in tests:
+        fd.seek(0)
+        old_rate = rate(old, n)
+        fd.seek(0)
+        new_rate = rate(new, n)
+        print("%-24s %14.0f %14.0f %7.2fx" % (name, old_rate, new_rate, new_rate / old_rate))
+    fd.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#! /usr/bin/python3
+#
+# Packet codec before and after the move to Python 3. Runs bench_codec.py of
+# the last Python 2 revision under a Python 2 interpreter and the current one
+# under this interpreter, and prints packets per second of both side by side.
+#
+#  bash$ ./bench_port.py [-2 PYTHON2] [-r REVISION] [BLOCK_SIZE] [N_PACKETS]
+#
+# The old revision is taken from git, the working tree is left alone. Unless
+# -r names it, it is the one before the last commit that touched the Python 2
+# shebang of tftp.py, which is the port. PYTHON2 must be on the PATH, pyenv
+# and the like only have it there under the name of the version, pass its
+# full path with -2 then.
+import sys,os,getopt,subprocess,tempfile,shutil
+
+# First line of tftp.py while lab1 ran on Python 2
+PY2_SHEBANG= "#! /usr/bin/python"
+
+PYTHON2= "python2"
+
+LAB_DIR= os.path.dirname(os.path.abspath(__file__))
+
+
+def python2_revision():
+    """Last revision in which tftp.py has PY2_SHEBANG"""
+    port = subprocess.check_output(["git", "log", "-1", "--format=%H", "-G", "^%s$" % PY2_SHEBANG, "--",
+                                    "tftp.py"], cwd=LAB_DIR, universal_newlines=True).strip()
+    if port:
+        head = subprocess.check_output(["git", "show", "%s:./tftp.py" % port], cwd=LAB_DIR,
+                                       universal_newlines=True).split("\n", 1)[0]
+        if head.strip() != PY2_SHEBANG:
+            return subprocess.check_output(["git", "rev-parse", "--short", port + "^"], cwd=LAB_DIR,
+                                           universal_newlines=True).strip()
+    raise RuntimeError("cannot find the Python 2 revision of tftp.py, give it with -r")
+
+
+def export_revision(revision, dest):
+    """Write lab1 as of revision below dest. Returns the directory"""
+    top = subprocess.check_output(["git", "rev-parse", "--show-toplevel"], cwd=LAB_DIR,
+                                  universal_newlines=True).strip()
+    prefix = os.path.relpath(LAB_DIR, top)
+    archive = subprocess.Popen(["git", "archive", revision, prefix], cwd=top, stdout=subprocess.PIPE)
+    subprocess.check_call(["tar", "-x", "-C", dest], stdin=archive.stdout)
+    archive.stdout.close()
+    if archive.wait() != 0:
+        raise RuntimeError("git archive %s failed" % revision)
+    return os.path.join(dest, prefix)
+
+
+def run_codec(python, lab_dir, args):
+    """Run bench_codec.py in lab_dir. Returns {test: (string pkt/s, buffer pkt/s)}"""
+    out = subprocess.check_output([python, os.path.join(lab_dir, "bench_codec.py")] + args,
+                                  cwd=lab_dir, universal_newlines=True)
+    rates = {}
+    for line in out.splitlines()[2:]:
+        fields = line.rsplit(None, 3)
+        if len(fields) == 4:
+            rates[fields[0]] = (float(fields[1]), float(fields[2]))
+    return rates
+
+
+def usage():
+    """Print the usage on stderr and quit with error code"""
+    sys.stderr.write("Usage: %s [-2 PYTHON2] [-r REVISION] [BLOCK_SIZE] [N_PACKETS]\n"
+                     "  -2 PYTHON2   Python 2 interpreter, default %s. Under pyenv give the full\n"
+                     "               path, e.g. ~/.pyenv/versions/2.7.18/bin/python\n"
+                     "  -r REVISION  last Python 2 revision, default the one before the port\n"
+                     % (sys.argv[0], PYTHON2))
+    sys.exit(1)
+
+
+def main():
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "2:r:")
+    except getopt.GetoptError:
+        usage()
+        return
+
+    python2 = PYTHON2
+    revision = None
+    for (opt, value) in opts:
+        if opt == "-2":
+            python2 = value
+        elif opt == "-r":
+            revision = value
+
+    if revision is None:
+        revision = python2_revision()
+    work = tempfile.mkdtemp(prefix="bench-port-")
+    try:
+        old = run_codec(python2, export_revision(revision, work), args)
+    finally:
+        shutil.rmtree(work)
+    new = run_codec(sys.executable, LAB_DIR, args)
+
+    print("Python 2 at %s against Python 3 %s, packets/s" % (revision, sys.version.split()[0]))
+    print("%-24s %12s %12s %12s %12s %8s" % ("", "py2 string", "py2 buffer", "py3 string", "py3 buffer",
+                                              "buffer"))
+    for (name, (old_string, old_buffer)) in sorted(old.items()):
+        if name not in new:
+            continue
+        (new_string, new_buffer) = new[name]
+        print("%-24s %12.0f %12.0f %12.0f %12.0f %7.2fx" % (name, old_string, old_buffer, new_string,
+                                                            new_buffer, new_buffer / old_buffer))
+
+if __name__ == "__main__":
+    main()
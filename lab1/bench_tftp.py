@@ -0,0 +1,448 @@
+#! /usr/bin/python3
+#
+# Reproducible TFTP benchmark. Starts tftp_server.py on loopback and an
+# impairment proxy in front of it, then runs tftp.tftp_transfer through the
+# proxy for every point of a parameter grid and writes one CSV row per run.
+#
+#   client <--> proxy (delay, jitter, loss, duplication, reordering) <--> server
+#
+# The proxy makes its random choices from a seed derived from the grid point
+# and the repetition, so two code revisions run against the same pattern of
+# lost and delayed packets. Label the runs of each revision with -l and
+# compare two CSV files with -c:
+#
+#  bash$ ./bench_tftp.py -l before -o before.csv
+#  bash$ ./bench_tftp.py -l after -o after.csv
+#  bash$ ./bench_tftp.py -c before.csv after.csv
+#
+# Grid options take comma separated lists, for instance
+#
+#  bash$ ./bench_tftp.py --loss 0,0.01,0.1 --delay 0.01 --windowsize 1,8,16 -r 5
+#
+# A blksize of 0 lets the client pick its default, see tftp.blksize_for_mtu.
+# batch is the most datagrams per system call, see tftp_batch. Compare
+# --batch 1,32 to see what batching saves in the syscalls_per_mb column.
+#
+# Columns: throughput is what the sender put on the wire, DATA packets with
+# their headers and retransmissions included, per second of transfer time.
+# goodput only counts the file itself. retransmits are DATA packets the
+# proxy saw a second time, whichever side sent them.
+import sys,os,getopt,socket,select,heapq,random,time,zlib,csv,shutil,tempfile,subprocess
+import multiprocessing
+import tftp,tftp_batch
+
+# Files of the lab, served from a copy in a temporary directory
+FILES= ["small.txt", "medium.pdf", "large.jpeg"]
+
+# Extra delay of a reordered packet, in seconds. Packets sent within this
+# time after it overtake it
+REORDER_DELAY= 0.005
+
+GRID_DEFAULTS = [('file', FILES),
+                 ('direction', ["get", "put"]),
+                 ('delay', [0.0, 0.005]),
+                 ('jitter', [0.0]),
+                 ('loss', [0.0, 0.05]),
+                 ('dup', [0.0]),
+                 ('reorder', [0.0]),
+                 ('blksize', [512, 0]),
+                 ('windowsize', [1, 8]),
+                 ('batch', [tftp_batch.BATCH_MAX])]
+
+RESULT_COLUMNS = ['completed', 'verified', 'bytes', 'time', 'throughput', 'goodput',
+                  'data_packets', 'retransmits', 'timeouts', 'dropped', 'duplicated', 'reordered',
+                  'srtt', 'rto', 'syscalls', 'syscalls_per_mb']
+
+# Columns that identify a grid point, see compare()
+KEY_COLUMNS = [name for (name, values) in GRID_DEFAULTS]
+
+# What key columns that CSV files of older revisions lack stood for
+KEY_MISSING = {'batch': "1"}
+
+
+class ImpairmentProxy(object):
+    """UDP proxy between TFTP clients and a server. Every client address gets
+        its own socket towards the server, so the server sees one TID per
+        client. The client always sees the proxy port, so the proxy does
+        what the client would do with TIDs: it sticks to the first one the
+        server answers from and sends ERROR 5 to any other.
+
+        Packets in either direction are dropped with probability loss, sent
+        twice with probability dup and held back REORDER_DELAY seconds with
+        probability reorder. All of them are delayed by delay plus a uniform
+        random jitter"""
+
+    def __init__(self, server_addr, host="127.0.0.1"):
+        self.server_addr = server_addr
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, 0))
+        self.addr = self.sock.getsockname()
+        # client address -> [socket towards server, server TID address or None]
+        self.sessions = {}
+        # socket towards server -> client address
+        self.clients = {}
+        # Heap of (send time, sequence number, socket, packet, address)
+        self.queue = []
+        self.seq = 0
+        self.configure({}, 0)
+
+    def configure(self, params, seed):
+        """Set the impairments and start over with the given seed, forgetting
+            all clients and packets still in flight"""
+        self.delay = float(params.get('delay', 0))
+        self.jitter = float(params.get('jitter', 0))
+        self.loss = float(params.get('loss', 0))
+        self.dup = float(params.get('dup', 0))
+        self.reorder = float(params.get('reorder', 0))
+        self.random = random.Random(seed)
+        for (sock, server_addr) in self.sessions.values():
+            sock.close()
+        self.sessions = {}
+        self.clients = {}
+        self.queue = []
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = {'packets': 0, 'dropped': 0, 'duplicated': 0, 'reordered': 0,
+                         'data_packets': 0, 'data_bytes': 0, 'retransmits': 0}
+        # (session, block number) of every DATA packet seen, to spot resends
+        self.seen = set()
+
+    def sockets(self):
+        return [self.sock] + list(self.clients)
+
+    def receive(self, sock):
+        (packet, addr) = sock.recvfrom(65536)
+        if sock is self.sock:
+            session = self.sessions.get(addr)
+            if session is None:
+                upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                upstream.bind((self.addr[0], 0))
+                session = [upstream, None]
+                self.sessions[addr] = session
+                self.clients[upstream] = addr
+            # Requests go to the server port, everything else to the TID
+            if session[1] is None or packet[:2] in (tftp.OPCODE_HEADER.pack(tftp.OPCODE_RRQ),
+                                                     tftp.OPCODE_HEADER.pack(tftp.OPCODE_WRQ)):
+                dest = self.server_addr
+            else:
+                dest = session[1]
+            self.count(packet, addr)
+            self.impair(session[0], packet, dest)
+        else:
+            client = self.clients[sock]
+            session = self.sessions[client]
+            if session[1] is None:
+                session[1] = addr
+            elif session[1] != addr:
+                sock.sendto(tftp.make_packet_err(5, tftp.ERROR_CODES[5]), addr)
+                return
+            self.count(packet, client)
+            self.impair(self.sock, packet, client)
+
+    def count(self, packet, client):
+        self.counters['packets'] += 1
+        if len(packet) >= 4 and packet[:2] == tftp.OPCODE_HEADER.pack(tftp.OPCODE_DATA):
+            self.counters['data_packets'] += 1
+            self.counters['data_bytes'] += len(packet)
+            key = (client, tftp.BLOCK_HEADER.unpack_from(packet)[1])
+            if key in self.seen:
+                self.counters['retransmits'] += 1
+            else:
+                self.seen.add(key)
+
+    def impair(self, sock, packet, addr):
+        if self.random.random() < self.loss:
+            self.counters['dropped'] += 1
+            return
+        copies = 1
+        if self.random.random() < self.dup:
+            self.counters['duplicated'] += 1
+            copies = 2
+        now = time.time()
+        for i in range(copies):
+            delay = self.delay + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.reorder:
+                self.counters['reordered'] += 1
+                delay += REORDER_DELAY
+            self.seq += 1
+            heapq.heappush(self.queue, (now + delay, self.seq, sock, packet, addr))
+
+    def send_due(self):
+        """Send the packets whose time has come. Returns the time until the
+            next one, or None"""
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            (when, seq, sock, packet, addr) = heapq.heappop(self.queue)
+            try:
+                sock.sendto(packet, addr)
+            except socket.error:
+                pass
+        if self.queue:
+            return max(0.0, self.queue[0][0] - now)
+        return None
+
+    def close(self):
+        self.configure({}, 0)
+        self.sock.close()
+
+
+def run_proxy(server_addr, conn):
+    """Body of the proxy process. Answers commands on conn:
+        ('configure', params, seed), ('counters',) and ('stop',)"""
+    proxy = ImpairmentProxy(server_addr)
+    conn.send(proxy.addr)
+    while True:
+        wait = proxy.send_due()
+        (rl, wl, xl) = select.select(proxy.sockets() + [conn], [], [], wait)
+        for sock in rl:
+            if sock is conn:
+                command = conn.recv()
+                if command[0] == 'configure':
+                    proxy.configure(command[1], command[2])
+                    conn.send(True)
+                elif command[0] == 'counters':
+                    conn.send(proxy.counters)
+                else:
+                    proxy.close()
+                    return
+            else:
+                try:
+                    proxy.receive(sock)
+                except socket.error:
+                    pass
+
+
+def start_server(root):
+    """Run tftp_server.py on a free loopback port. Returns (process, port)"""
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tftp_server.py")
+    proc = subprocess.Popen([sys.executable, "-u", server, "-p", "0", "-b", "127.0.0.1", "-w", root],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    line = proc.stdout.readline()
+    if not line.startswith("Serving"):
+        proc.kill()
+        raise RuntimeError("tftp_server.py did not start")
+    return proc, int(line.split()[-1])
+
+
+def grid_points(grid):
+    """Every combination of the values in grid, a list of (name, values), as
+        a list of dicts"""
+    points = [{}]
+    for (name, values) in grid:
+        points = [dict(point, **{name: value}) for point in points for value in values]
+    return points
+
+
+def run_seed(point, rep):
+    # Only the columns older revisions had, so that seeds stay the same
+    # across revisions and batch sizes
+    key = ",".join(str(point[name]) for name in KEY_COLUMNS if name not in KEY_MISSING) + ",%d" % rep
+    return zlib.crc32(key.encode()) & 0xFFFFFFFF
+
+
+def same_file(a, b):
+    with open(a, "rb") as fa:
+        with open(b, "rb") as fb:
+            return fa.read() == fb.read()
+
+
+def run_point(point, rep, proxy_conn, proxy_port, src_dir, server_root):
+    """Run a single transfer through the proxy. The current directory must be
+        the client directory, tftp_transfer asks for fd.name"""
+    proxy_conn.send(('configure', point, run_seed(point, rep)))
+    proxy_conn.recv()
+
+    source = os.path.join(src_dir, point['file'])
+    if point['direction'] == "get":
+        direction = tftp.TFTP_GET
+        filename = point['file']
+        received = filename
+        fd = open(filename, "wb")
+    else:
+        # Upload under another name, so that a failed PUT cannot leave the
+        # server with an intact copy from an earlier run
+        direction = tftp.TFTP_PUT
+        filename = "put-" + point['file']
+        received = os.path.join(server_root, filename)
+        if os.path.exists(received):
+            os.remove(received)
+        fd = open(filename, "rb")
+    blksize = point['blksize'] or None
+    try:
+        stats = tftp.tftp_transfer(fd, "127.0.0.1", direction, proxy_port, blksize, point['windowsize'],
+                                   batch=point['batch'])
+    finally:
+        fd.close()
+
+    proxy_conn.send(('counters',))
+    counters = proxy_conn.recv()
+    size = os.path.getsize(source)
+    elapsed = stats['time']
+    verified = stats['completed'] and os.path.exists(received) and same_file(source, received)
+    return {'completed': int(stats['completed']),
+            'verified': int(verified),
+            'bytes': size,
+            'time': "%.6f" % elapsed,
+            'throughput': "%.0f" % (counters['data_bytes'] / elapsed),
+            'goodput': "%.0f" % ((verified and size or 0) / elapsed),
+            'data_packets': counters['data_packets'],
+            'retransmits': counters['retransmits'],
+            'timeouts': stats['timeouts'],
+            'dropped': counters['dropped'],
+            'duplicated': counters['duplicated'],
+            'reordered': counters['reordered'],
+            'srtt': stats['srtt'] is not None and "%.6f" % stats['srtt'] or "",
+            'rto': "%.3f" % stats['rto'],
+            'syscalls': stats['syscalls'],
+            'syscalls_per_mb': size and "%.0f" % (stats['syscalls'] / (size / 1048576.0)) or ""}
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.DEVNULL, universal_newlines=True)
+        return out.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_grid(grid, reps, label, out):
+    """Run every grid point reps times and write the results to out as CSV"""
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    work = tempfile.mkdtemp(prefix="bench_tftp-")
+    server_root = os.path.join(work, "server")
+    client_dir = os.path.join(work, "client")
+    os.mkdir(server_root)
+    os.mkdir(client_dir)
+    files = set(point['file'] for point in grid_points(grid))
+    for name in files:
+        shutil.copy(os.path.join(src_dir, name), os.path.join(server_root, name))
+        shutil.copy(os.path.join(src_dir, name), os.path.join(client_dir, "put-" + name))
+
+    (server, server_port) = start_server(server_root)
+    (proxy_conn, child_conn) = multiprocessing.Pipe()
+    proxy = multiprocessing.Process(target=run_proxy, args=(("127.0.0.1", server_port), child_conn))
+    proxy.daemon = True
+    proxy.start()
+    proxy_port = proxy_conn.recv()[1]
+
+    writer = csv.writer(out)
+    writer.writerow(['label', 'rep'] + KEY_COLUMNS + RESULT_COLUMNS)
+    cwd = os.getcwd()
+    os.chdir(client_dir)
+    points = grid_points(grid)
+    # tftp_transfer prints a line now and then, keep it away from the CSV
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        for (i, point) in enumerate(points):
+            for rep in range(reps):
+                result = run_point(point, rep, proxy_conn, proxy_port, src_dir, server_root)
+                writer.writerow([label, rep] + [point[name] for name in KEY_COLUMNS]
+                                + [result[name] for name in RESULT_COLUMNS])
+                out.flush()
+            sys.stderr.write("%d/%d %s\n" % (i + 1, len(points),
+                                             " ".join("%s=%s" % (name, point[name]) for name in KEY_COLUMNS)))
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        proxy_conn.send(('stop',))
+        proxy.join()
+        server.terminate()
+        server.wait()
+        shutil.rmtree(work)
+
+
+def read_results(filename):
+    """Mean goodput and retransmits per grid point of a CSV file, keyed by the
+        KEY_COLUMNS values. Runs that were not verified count with goodput 0"""
+    sums = {}
+    with open(filename, newline="") as f:
+        for row in csv.DictReader(f):
+            key = tuple(row.get(name, KEY_MISSING.get(name)) for name in KEY_COLUMNS)
+            s = sums.setdefault(key, [0, 0.0, 0])
+            s[0] += 1
+            s[1] += float(row['goodput'])
+            s[2] += int(row['retransmits'])
+    return dict((key, (s[1] / s[0], float(s[2]) / s[0])) for (key, s) in sums.items())
+
+
+def compare(old_file, new_file, out=sys.stdout):
+    """Print goodput and retransmits of the grid points both files have"""
+    old = read_results(old_file)
+    new = read_results(new_file)
+    out.write("%-44s %12s %12s %7s %8s %8s\n" % ("grid point", "old B/s", "new B/s", "ratio",
+                                                   "old rtx", "new rtx"))
+    for key in sorted(set(old) & set(new)):
+        (old_goodput, old_rtx) = old[key]
+        (new_goodput, new_rtx) = new[key]
+        if old_goodput > 0:
+            ratio = "%6.2fx" % (new_goodput / old_goodput)
+        else:
+            ratio = "-"
+        out.write("%-44s %12.0f %12.0f %7s %8.1f %8.1f\n" % (" ".join(key), old_goodput, new_goodput,
+                                                              ratio, old_rtx, new_rtx))
+    missing = len(set(old) ^ set(new))
+    if missing:
+        out.write("%d grid points are in only one of the files\n" % missing)
+
+
+def usage():
+    """Print the usage on stderr and quit with error code"""
+    sys.stderr.write("Usage: %s [-o OUT.csv] [-l LABEL] [-r REPS] [--file LIST] [--direction LIST]\n"
+                     "       [--delay LIST] [--jitter LIST] [--loss LIST] [--dup LIST] [--reorder LIST]\n"
+                     "       [--blksize LIST] [--windowsize LIST] [--batch LIST]\n"
+                     "       %s -c OLD.csv NEW.csv\n" % (sys.argv[0], sys.argv[0]))
+    sys.exit(1)
+
+
+def main():
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "o:l:r:c",
+                                     [name + "=" for name in KEY_COLUMNS])
+    except getopt.GetoptError:
+        usage()
+        return
+
+    grid = [(name, list(values)) for (name, values) in GRID_DEFAULTS]
+    out_file = None
+    label = None
+    reps = 3
+    for (opt, value) in opts:
+        if opt == "-c":
+            if len(args) != 2:
+                usage()
+            compare(args[0], args[1])
+            return
+        elif opt == "-o":
+            out_file = value
+        elif opt == "-l":
+            label = value
+        elif opt == "-r":
+            reps = int(value)
+        else:
+            name = opt[2:]
+            index = KEY_COLUMNS.index(name)
+            if name in ('file', 'direction'):
+                values = value.split(",")
+            elif name in ('blksize', 'windowsize', 'batch'):
+                values = [int(v) for v in value.split(",")]
+            else:
+                values = [float(v) for v in value.split(",")]
+            grid[index] = (name, values)
+    if args:
+        usage()
+        return
+    if label is None:
+        label = git_revision()
+
+    if out_file is None:
+        run_grid(grid, reps, label, sys.stdout)
+    else:
+        with open(out_file, "w", newline="") as out:
+            run_grid(grid, reps, label, out)
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,7 @@ echo "./tftp.py $direction $inputfile rabbit.it.uu.se" > "output_"$outputfile".t
 echo "./tftp.py $direction $inputfile rabbit.it.uu.se" > "extended_output_"$outputfile".txt"
 for i in {1..11}
 do
-        t=$((time ./tftp.py "$direction" "$inputfile" rabbit.it.uu.se) 2>&1)
+        t=$((time ./tftp.py -j "events_"$outputfile".jsonl" "$direction" "$inputfile" rabbit.it.uu.se) 2>&1)
  
         echo $t >> "extended_output_"$outputfile".txt"
  
@@ -1,16 +1,28 @@
-#! /usr/bin/python
-import sys,socket,struct,select,time,hashlib
+#! /usr/bin/python3
+import sys,os,socket,struct,time,errno,hashlib,getopt,threading,asyncio
+import tftp_io,tftp_events,tftp_batch,tftp_loop
 
 BLOCK_SIZE= 512
 
 # 512 + header (4)
 
+# Blocksize option (RFC 2348). We ask for the largest block that still fits
+# in one datagram on the path: MTU - IP header - UDP header (8) - TFTP header (4)
+PATH_MTU= 1500
+BLKSIZE_MIN= 8
+BLKSIZE_MAX= 65464
+
+# Windowsize option (RFC 7440). Number of blocks the sender may have in flight
+# before it waits for an ACK. 1 is plain stop-and-wait
+WINDOW_SIZE= 8
+
 #TFTP header consists of a 2 byte opcode field which indicates the packet's type
 OPCODE_RRQ = 1
 OPCODE_WRQ = 2
 OPCODE_DATA = 3
 OPCODE_ACK = 4
 OPCODE_ERR = 5
+OPCODE_OACK = 6
 
 MODE_NETASCII= "netascii"
 MODE_OCTET=    "octet"
@@ -18,9 +30,18 @@ MODE_MAIL=     "mail"
 
 TFTP_PORT= 13069
 
-# Timeout in seconds
+# Initial retransmission timeout in seconds, before we have measured the RTT
 TFTP_TIMEOUT= 2
 
+# Bounds for the adaptive retransmission timeout in seconds
+RTO_MIN= 0.1
+RTO_MAX= 16
+
+# Smoothing gains and clock granularity of the RTT estimator (RFC 6298)
+RTT_ALPHA= 1.0 / 8
+RTT_BETA= 1.0 / 4
+RTT_GRANULARITY= 0.01
+
 ERROR_CODES = ["Undef",
                "File not found",
                "Access violation",
@@ -28,239 +49,1356 @@ ERROR_CODES = ["Undef",
                "Illegal TFTP operation",
                "Unknown transfer ID",
                "File already exists",
-               "No such user"]
+               "No such user",
+               "Option negotiation failed"]
+
+# Digests and sizes of the files on the lab servers, see main()
+MANIFEST= os.path.join(os.path.dirname(os.path.abspath(__file__)), "checksums.md5")
+
+# Socket buffers we ask for in a TftpSession, big enough for a full window of
+# the largest blocks. The kernel may give us less
+SOCKET_BUFFER= 1 << 20
+
+# Idle sockets a TftpSession keeps per address family
+SESSION_POOL= 64
+
+# Errors of each class a transfer puts up with before it gives up: packets
+# from the server that make no sense, failed sends, and packets from other
+# TIDs. The last are answered with ERROR 5 while there is budget left and
+# dropped after that, they never end the transfer. Duplicate DATA and stale
+# ACKs are counted since the transfer last moved on, a lost block brings a
+# window's worth of them but a server that only repeats itself is given up on
+ERROR_BUDGET= {'malformed': 16,
+               'socket': 8,
+               'foreign': 64,
+               'duplicate': 256}
 
 # Internal defines
 TFTP_GET = 1
 TFTP_PUT = 2
 
-def make_packet_rrq(filename, mode):
+# Block numbers on the wire are 16 bits. After 65535 they roll over to 0, or
+# to 1 if both sides agree on the rollover option, see wire_blocknr.
+# Internally blocks are counted from the start of the transfer without limit
+BLOCKNR_MAX= 0xFFFF
+
+# Precompiled packet headers: the opcode alone, and opcode + block number
+# (or error code). Compiling the format once saves a cache lookup per packet
+OPCODE_HEADER = struct.Struct("!H")
+BLOCK_HEADER = struct.Struct("!HH")
+
+# Packets are bytes, file names, modes, options and error messages are text.
+# The fields are converted with this encoding when a packet is built or parsed
+FIELD_ENCODING= "utf-8"
+
+def blksize_for_mtu(mtu, family=socket.AF_INET):
+    """Largest blksize whose DATA packet fits in a single datagram of size mtu"""
+    if family == socket.AF_INET6:
+        ip_header = 40
+    else:
+        ip_header = 20
+    return max(BLKSIZE_MIN, min(BLKSIZE_MAX, mtu - ip_header - 8 - 4))
+
+def encode_field(text):
+    """A file name, mode, option or error message as the bytes sent for it.
+        Bytes that are not UTF-8 survive the trip through decode_field, the
+        same way the os module handles such file names"""
+    return text.encode(FIELD_ENCODING, "surrogateescape")
+
+def decode_field(data):
+    return data.decode(FIELD_ENCODING, "surrogateescape")
+
+def make_options(options):
+    # Options are appended to the request as "name\0value\0" pairs (RFC 2347)
+    if not options:
+        return b''
+    return b''.join(encode_field(name) + b'\0' + encode_field(str(value)) + b'\0'
+                    for (name, value) in options.items())
+
+def parse_options(fields):
+    """Turn a list of alternating option names and values into a dict. Names
+        are case insensitive, values are kept as strings"""
+    if len(fields) % 2 != 0:
+        return None
+    return dict((decode_field(fields[i]).lower(), decode_field(fields[i + 1]))
+                for i in range(0, len(fields), 2))
+
+def make_packet_rrq(filename, mode, options=None):
     # Note the exclamation mark in the format string to pack(). What is it for?
     # ! = network, H = unsigned short
-    return struct.pack("!H", OPCODE_RRQ) + filename + '\0' + mode + '\0'
+    return (OPCODE_HEADER.pack(OPCODE_RRQ) + encode_field(filename) + b'\0' + encode_field(mode) + b'\0'
+            + make_options(options))
 
-def make_packet_wrq(filename, mode):
-    return struct.pack("!H", OPCODE_WRQ) + filename + '\0' + mode + '\0'
+def make_packet_wrq(filename, mode, options=None):
+    return (OPCODE_HEADER.pack(OPCODE_WRQ) + encode_field(filename) + b'\0' + encode_field(mode) + b'\0'
+            + make_options(options))
 
 def make_packet_data(blocknr, data):
     # !HH
-    return struct.pack("!HH", OPCODE_DATA, blocknr) + data
+    return BLOCK_HEADER.pack(OPCODE_DATA, blocknr) + data
 
 def make_packet_ack(blocknr):
-    return struct.pack("!HH", OPCODE_ACK, blocknr) 
+    return BLOCK_HEADER.pack(OPCODE_ACK, blocknr) 
 
 def make_packet_err(errcode, errmsg):
-    return struct.pack("!HH", OPCODE_ERR, errcode) + errmsg + '\0'
+    return BLOCK_HEADER.pack(OPCODE_ERR, errcode) + encode_field(errmsg) + b'\0'
+
+def make_packet_oack(options):
+    return OPCODE_HEADER.pack(OPCODE_OACK) + make_options(options)
 
 def parse_packet(msg):
     """This function parses a recieved packet and returns a tuple where the
         first value is the opcode as an integer and the following values are
-        the other parameters of the packets in python data types"""
-    opcode = struct.unpack("!H", msg[:2])[0]
+        the other parameters of the packets in python data types. Packets
+        too short for their header give None, like any other malformed one"""
+    if len(msg) < OPCODE_HEADER.size:
+        return None
+    opcode = OPCODE_HEADER.unpack_from(msg)[0]
+    if opcode in (OPCODE_DATA, OPCODE_ACK, OPCODE_ERR) and len(msg) < BLOCK_HEADER.size:
+        return None
     if opcode == OPCODE_RRQ or opcode == OPCODE_WRQ:
-        l = msg[2:].split('\0')
-        if len(l) != 3:
+        # filename \0 mode \0 [name \0 value \0]*
+        l = msg[2:].split(b'\0')
+        if len(l) < 3 or l[-1] != b'':
+            return None
+        options = parse_options(l[2:-1])
+        if options is None:
             return None
-        return opcode, l[1], l[2]
+        return opcode, decode_field(l[0]), decode_field(l[1]).lower(), options
     
     elif opcode == OPCODE_DATA:
-        block = struct.unpack("!H", msg[2:4])[0]
+        block = BLOCK_HEADER.unpack_from(msg)[1]
         return opcode, block, msg[4:] 
     
     elif opcode == OPCODE_ACK:
-        block = struct.unpack("!H", msg[2:])[0]
+        block = BLOCK_HEADER.unpack_from(msg)[1]
         return opcode, block, msg[4:]
     
     elif opcode == OPCODE_ERR:
-        errcode = struct.unpack("!H", msg[2:4])[0]
-        errmsg = msg[4:-1]
+        errcode = BLOCK_HEADER.unpack_from(msg)[1]
+        errmsg = decode_field(msg[4:-1])
         return opcode, errcode, errmsg
+
+    elif opcode == OPCODE_OACK:
+        l = msg[2:].split(b'\0')
+        if l[-1] != b'':
+            return None
+        options = parse_options(l[:-1])
+        if options is None:
+            return None
+        return opcode, options
     else:
         return None 
 
 
+# BUFFER CODEC ---------------------------------------------------------------
+# The functions above build a new bytes object for every packet. For the DATA
+# packets of a running transfer we instead pack the header straight into a
+# preallocated buffer and read the file data into the same buffer. Received
+# packets go into one buffer with recvfrom_into and DATA payloads are handed
+# out as memoryviews, so no per packet bytes objects are made.
+
+class PacketBuffer(object):
+    """A preallocated DATA packet of up to block_size bytes of payload. After
+        read_data, packet is the finished packet ready for sendto. The views
+        are made once up front, making a memoryview per packet costs about
+        as much as the copy it saves"""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.buf = bytearray(block_size + 4)
+        self.view = memoryview(self.buf)
+        self.payload = self.view[4:]
+        self.packet = None
+
+    def read_data(self, blocknr, fd):
+        """Build DATA packet blocknr with the next block of fd read straight
+            into the buffer. Returns the payload length"""
+        BLOCK_HEADER.pack_into(self.buf, 0, OPCODE_DATA, blocknr)
+        try:
+            n = fd.readinto(self.payload)
+        except AttributeError:
+            data = fd.read(self.block_size)
+            n = len(data)
+            self.buf[4:4 + n] = data
+        if n == self.block_size:
+            self.packet = self.buf
+        else:
+            self.packet = self.view[:4 + n]
+        return n
+
+    def fill(self, blocknr, data):
+        """Build DATA packet blocknr carrying data, for instance a block from
+            a tftp_io block source. Returns the payload length"""
+        BLOCK_HEADER.pack_into(self.buf, 0, OPCODE_DATA, blocknr)
+        n = len(data)
+        self.payload[:n] = data
+        if n == self.block_size:
+            self.packet = self.buf
+        else:
+            self.packet = self.view[:4 + n]
+        return n
+
+
+def parse_packet_view(view, nbytes):
+    """Like parse_packet, for a packet received with recvfrom_into. view is a
+        memoryview of the receive buffer and nbytes the packet length. The
+        payload of a DATA packet is returned as a memoryview into the buffer,
+        it is only valid until the next packet is received into it"""
+    if nbytes < 4:
+        return None
+    (opcode, blocknr) = BLOCK_HEADER.unpack_from(view)
+    if opcode == OPCODE_DATA:
+        return opcode, blocknr, view[4:nbytes]
+    elif opcode == OPCODE_ACK:
+        return opcode, blocknr, b''
+    return parse_packet(view[:nbytes].tobytes())
+
+
+
+def wire_blocknr(blocknr, rollover=0):
+    """16 bit block number that block blocknr is sent as"""
+    if blocknr <= BLOCKNR_MAX:
+        return blocknr
+    return (blocknr - rollover) % (BLOCKNR_MAX + 1 - rollover) + rollover
+
+def unwrap_blocknr(wire, near, rollover=0):
+    """Block number of the block that was sent as wire. Of all blocks sent as
+        wire it is the one closest to block near, which must be less than
+        half a cycle of 16 bit block numbers away"""
+    period = BLOCKNR_MAX + 1 - rollover
+    d = (wire - wire_blocknr(near, rollover)) % period
+    if d >= period // 2:
+        d -= period
+    return near + d
+
+def negotiated_option(requested, oack, name, default, minimum):
+    """Return the value the server agreed to for option name in its OACK, or
+        default if the server left it out. The server may only lower the value
+        we asked for, anything else is a protocol error and None is returned"""
+    if name not in oack:
+        return default
+    try:
+        value = int(oack[name])
+    except ValueError:
+        return None
+    if value < minimum or value > requested.get(name, default):
+        return None
+    return value
+
+class RttEstimator(object):
+    """Retransmission timer after Jacobson/Karels (RFC 6298). Keeps a smoothed
+        RTT and RTT variance and doubles the timeout on every expiry until the
+        next valid sample"""
+
+    def __init__(self, initial=TFTP_TIMEOUT, rto_min=RTO_MIN, rto_max=RTO_MAX):
+        self.rto_min = rto_min
+        self.rto_max = rto_max
+        self.srtt = None
+        self.rttvar = None
+        self.last_sample = None
+        self.initial = min(max(initial, rto_min), rto_max)
+        self.rto = self.initial
+        self.samples = 0
+        self.backoffs = 0
+
+    def sample(self, rtt):
+        # Callers must follow Karn's rule and never pass the RTT of a
+        # retransmitted packet, we cannot tell which copy was answered
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.last_sample = rtt
+        self.samples += 1
+        self.set_rto(self.srtt + max(RTT_GRANULARITY, 4 * self.rttvar))
+
+    def backoff(self):
+        self.backoffs += 1
+        self.set_rto(self.rto * 2)
+
+    def resume(self):
+        """Drop the backoff once the peer answers again, even if there was
+            no sample to take. The RTO goes back to what the smoothed RTT
+            and variance say, or to the initial one without a sample"""
+        if self.srtt is None:
+            self.rto = self.initial
+        else:
+            self.set_rto(self.srtt + max(RTT_GRANULARITY, 4 * self.rttvar))
+
+    def repeat_window(self):
+        """How long after a rewind more ACKs for the same block are taken to
+            be from the same broken window: one SRTT, but never more than
+            rto_min. The peer does not time out and resend any sooner, and a
+            sample that took in one of its timeouts must not hide the resends"""
+        if self.srtt is None:
+            return self.rto_min
+        return min(max(self.srtt, RTT_GRANULARITY), self.rto_min)
+
+    def set_rto(self, rto):
+        self.rto = min(max(rto, self.rto_min), self.rto_max)
+
+
+def parse_address(arg, port=TFTP_PORT):
+    """HOST or HOST:PORT as (host, port). IPv6 addresses take a port only in
+        brackets, [::1]:6969"""
+    if arg.startswith("["):
+        (host, sep, rest) = arg[1:].partition("]")
+        if rest.startswith(":"):
+            port = int(rest[1:])
+        return host, port
+    if arg.count(":") == 1:
+        (host, sep, rest) = arg.partition(":")
+        return host, int(rest)
+    return arg, port
+
+
+class TftpSession(object):
+    """State shared by many transfers: resolved server addresses and a pool
+        of UDP sockets with large buffers. Pass it to tftp_transfer to pay
+        for name lookups and socket setup once instead of per transfer.
+        Transfers in several threads may share a session.
+
+        A pooled socket keeps its port, so a transfer may get packets that
+        were meant for the one before it on the same socket. release()
+        throws away what is queued and tftp_transfer only takes a packet
+        from the host it asked that answers its own request as the first
+        one. A transfer that did not complete closes its socket instead of
+        releasing it, its server may still be sending to that port"""
+
+    def __init__(self, rcvbuf=SOCKET_BUFFER, sndbuf=SOCKET_BUFFER, pool_size=SESSION_POOL):
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.pool_size = pool_size
+        self.addresses = {}
+        self.pool = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, hostname, port):
+        """getaddrinfo for a UDP socket to hostname, looked up only once"""
+        with self.lock:
+            addr = self.addresses.get((hostname, port))
+        if addr is None:
+            addr = socket.getaddrinfo(hostname, port, 0, socket.SOCK_DGRAM)[0]
+            with self.lock:
+                self.addresses[(hostname, port)] = addr
+        return addr
+
+    def socket(self, family, socktype=socket.SOCK_DGRAM, proto=0):
+        """A bound UDP socket from the pool, or a new one if it is empty"""
+        with self.lock:
+            idle = self.pool.get(family)
+            if idle:
+                return idle.pop()
+        s = socket.socket(family, socktype, proto)
+        for (option, size) in ((socket.SO_RCVBUF, self.rcvbuf), (socket.SO_SNDBUF, self.sndbuf)):
+            try:
+                s.setsockopt(socket.SOL_SOCKET, option, size)
+            except socket.error:
+                pass
+        if family == socket.AF_INET6:
+            s.bind(("::", 0))
+        else:
+            s.bind(("0.0.0.0", 0))
+        return s
+
+    def release(self, s):
+        """Give back a socket from socket() once the transfer is over"""
+        s.setblocking(False)
+        try:
+            while True:
+                s.recv(65536)
+        except socket.error:
+            pass
+        s.setblocking(True)
+        with self.lock:
+            idle = self.pool.setdefault(s.family, [])
+            if len(idle) < self.pool_size:
+                idle.append(s)
+                return
+        s.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.pool.values():
+                for s in idle:
+                    s.close()
+            self.pool = {}
+
+
+# ERRORS -------------------------------------------------------------------
+# Reasons for a transfer to end before it is complete. code is the ERROR code
+# the server is sent about it, None when there is nothing to tell it
+
+class TftpError(Exception):
+    code = 0
+
+
+class MalformedPacket(TftpError):
+    """The server keeps sending packets we cannot parse, or that have no
+        place in the transfer"""
+    code = 4
+
+
+class OptionError(TftpError):
+    """The server answered our options in a way we cannot go on with"""
+    code = 8
+
+
+class PeerError(TftpError):
+    """The server sent ERROR"""
+    code = None
+
+    def __init__(self, errcode, errmsg):
+        TftpError.__init__(self, "RECEIVED ERROR PACKET %d %s" % (errcode, errmsg))
+        self.errcode = errcode
+
+
+class Duplicates(TftpError):
+    """The server keeps sending blocks or ACKs we are past, and nothing new"""
+    code = 0
+
+
+class RetriesExceeded(TftpError):
+    """No answer from the server, or no way to send it anything"""
+    code = None
+
+
+def over_budget(errors, name):
+    """Count one error of class name, True once there were more of them than
+        ERROR_BUDGET allows"""
+    errors[name] += 1
+    return errors[name] > ERROR_BUDGET[name]
+
+
+def first_response(pkt, direction):
+    """True if pkt can be the server's answer to our RRQ or WRQ"""
+    if pkt is None:
+        return False
+    if pkt[0] in (OPCODE_OACK, OPCODE_ERR):
+        return True
+    if direction == TFTP_GET:
+        return pkt[0] == OPCODE_DATA and pkt[1] == 1
+    return pkt[0] == OPCODE_ACK and pkt[1] == 0
+
+
+def rtt_fields(rtt):
+    """Fields of an rtt event, right after rtt took a sample"""
+    return {'sample': rtt.last_sample, 'srtt': rtt.srtt, 'rto': rtt.rto}
+
+
+def make_request(direction, filename, options):
+    if direction == TFTP_GET:
+        return make_packet_rrq(filename, MODE_OCTET, options)
+    return make_packet_wrq(filename, MODE_OCTET, options)
+
+
+def write_error(e):
+    """ERROR code and message telling the server we could not store its data"""
+    if e.errno == errno.ENOSPC:
+        return 3, ERROR_CODES[3]
+    return 0, e.strerror or ERROR_CODES[0]
+
 
-def tftp_transfer(fd, hostname, direction, port):
+def send_error(channel, addr, errcode, errmsg, hook=None):
+    """Tell the server why we stop. If that fails it times out in the end"""
+    try:
+        channel.sendto(make_packet_err(errcode, errmsg), addr)
+    except socket.error as e:
+        print("Send error:", e)
+        return
+    if hook is not None:
+        hook.event('error', {'code': errcode, 'message': errmsg, 'sent': True})
+
+
+def transfer_steps(fd, hostname, direction, port, blksize=None, windowsize=WINDOW_SIZE,
+                   rto_min=RTO_MIN, rto_max=RTO_MAX, write_buffer=tftp_io.WRITE_BEHIND_MAX, hook=None,
+                   digest=None, offset=0, rollover=0, session=None, filemap=None, length=None,
+                   batch=tftp_batch.BATCH_MAX, checkpoint=None):
+    """tftp_transfer as a generator, for running many transfers in one
+        thread. Every time it waits for a packet it yields (channel, timeout)
+        and is to be sent the next datagram from channel.receive, or None if
+        none came within timeout seconds. Returns the dict of tftp_transfer,
+        see tftp_transfer and LoopTransfer for the two ways to drive it"""
     
     # Open socket interface
-    (family, socktype, proto, canonname, sockaddr) = socket.getaddrinfo(hostname, port)[0]
-    s = socket.socket(family, socktype, proto)
+    resolve_start = time.time()
+    if session is not None:
+        (family, socktype, proto, canonname, sockaddr) = session.resolve(hostname, port)
+        socket_start = time.time()
+        s = session.socket(family, socktype, proto)
+    else:
+        (family, socktype, proto, canonname, sockaddr) = socket.getaddrinfo(hostname, port, 0, socket.SOCK_DGRAM)[0]
+        socket_start = time.time()
+        s = socket.socket(family, socktype, proto)
+    resolve_time = socket_start - resolve_start
+    socket_time = time.time() - socket_start
+    first_response_at = None
     server_TID = None
     last_packet = False
     total_packet_lost = 0
+    resend_count = 0
+    completed = False
+    total_bytes = 0
+    # Why the transfer ended before it was complete, and the errors of each
+    # class so far, see ERROR_BUDGET
+    error = None
+    errors = dict((name, 0) for name in ERROR_BUDGET)
+
+    # Retransmission timer. We time one packet at a time: timed_blocknr is the
+    # block whose DATA (GET) or ACK (PUT) completes the measurement, None when
+    # the timed packet has been retransmitted
+    rtt = RttEstimator(TFTP_TIMEOUT, rto_min, rto_max)
+    timed_blocknr = None
+    timed_at = None
+    timeouts = 0
+    timeout_time = 0.0
+    start_time = time.time()
+
+    # Ask for a larger block size and a window of several blocks. If the server
+    # ignores the options we keep using 512 byte blocks and stop-and-wait
+    if blksize is None:
+        blksize = blksize_for_mtu(PATH_MTU, family)
+    options = {}
+    if blksize != BLOCK_SIZE:
+        options['blksize'] = blksize
+    if windowsize > 1:
+        options['windowsize'] = windowsize
+    if direction == TFTP_GET and offset:
+        options['offset'] = offset
+    if direction == TFTP_GET and length is not None:
+        options['length'] = length
+    if rollover:
+        options['rollover'] = rollover
+    # Bytes at the start of the DATA stream we already have. Zero once the
+    # server agrees to start at offset
+    skip = offset
+    block_size = BLOCK_SIZE
+    window_size = 1
+    # Until the server agrees to roll over to 1 it rolls over to 0
+    wrap = 0
+    negotiated = False
        
     # Check if we are putting a file or getting a file and create 
     # the corresponding packet and send it
     if direction == TFTP_GET:
-        RECEIVE_SIZE = BLOCK_SIZE + 4
+        RECEIVE_SIZE = max(blksize, BLOCK_SIZE) + 4
         current_blocknr = 1
-        p = make_packet_rrq(fd.name, MODE_OCTET)
-        print "Sending RRQ packet"
+        # Blocks received in order since we last sent an ACK
+        window_count = 0
+        # True once we have asked the server to rewind, and when, so that
+        # the rest of a broken window does not trigger an ACK each. DATA the
+        # server still resends after rtt.repeat_window() gets one again
+        rewind_sent = False
+        rewind_at = None
+        writer = tftp_io.WriteBehind(fd, write_buffer, threaded=write_buffer > 0, digest=digest,
+                                     checkpoint=checkpoint)
+        p = make_request(direction, fd.name, options)
 
     elif direction == TFTP_PUT:
-        RECEIVE_SIZE = 4
+        # Big enough for an ACK as well as an OACK or ERROR packet
+        RECEIVE_SIZE = BLOCK_SIZE + 4
         current_blocknr = 0
         blocknr = 0
-        p = make_packet_wrq(fd.name, MODE_OCTET)
+        # DATA packets sent but not yet acknowledged, for blocks
+        # current_blocknr + 1 up to blocknr. Kept so that we can rewind
+        window = []
+        # One PacketBuffer per window slot, block n is built in slot
+        # n % window_size, and the source the blocks come from. Both are set
+        # up once the block size is known
+        slots = None
+        source = None
+        # Block we last rewound to, and when. Further ACKs for it within
+        # rtt.repeat_window() are duplicates from the same broken window and
+        # must not make us resend it all again
+        rewound_to = None
+        rewound_at = None
+        p = make_request(direction, fd.name, options)
         bytes_left = 0
         bytes_leftx = 0
     else:
-        print "No valid direction"
+        print("No valid direction")
+
+    # GET: block to hand to the writer once its ACK is on the way
+    pending_data = None
+    # GET: set once the writer is closed ahead of the last ACK
+    writer_closed = False
+
+    # Packets are received into a few fixed buffers, see parse_packet_view
+    # and tftp_batch.BatchSocket
+    channel = tftp_batch.BatchSocket(s, RECEIVE_SIZE, batch)
 
     # Send the just created packet
-    (bytes) = s.sendto(p, sockaddr)  
+    channel.sendto(p, sockaddr)
+    request_at = time.time()
+    if hook is not None:
+        hook.event('request', {'opcode': direction == TFTP_GET and "RRQ" or "WRQ",
+                               'filename': fd.name, 'options': options})
+    if direction == TFTP_GET:
+        timed_blocknr = 1
+    else:
+        timed_blocknr = 0
+    timed_at = time.time()
+
+    # Retransmission deadline. Set when we send something new and after a
+    # retransmission, never by packets that do not move the transfer on, or
+    # stray and duplicate packets would keep it alive forever
+    wait_start = timed_at
+    deadline = wait_start + rtt.rto
     
     # Put or get the file, block by block, in a loop.
     while True:
 
-        # Listen and wait until received a packet
-        (rl,wl,xl) = select.select([s],[],[],TFTP_TIMEOUT)
+        # Listen and wait until received a packet, unless the deadline has
+        # passed while we were busy with the ones before
+        wait = deadline - time.time()
+        if wait > 0:
+            try:
+                received = yield channel, wait
+            except GeneratorExit:
+                # Stopped by whoever drives us, see AsyncioTransfer. Drop
+                # what is not written yet, there is nobody to tell
+                channel.close()
+                s.close()
+                if direction == TFTP_GET:
+                    writer.abort()
+                elif source is not None:
+                    source.close()
+                raise
+        else:
+            received = None
         try: 
 
             # If received from server, read and unpack the packet
-            if s in rl:
-                (block, sender_addr) = s.recvfrom(RECEIVE_SIZE)
+            if received is not None:
+                (recv_view, nbytes, sender_addr) = received
                 (host_IP, host_TID) = sender_addr
-                pkt = parse_packet(block) 
-                
+                pkt = parse_packet_view(recv_view, nbytes)
+
+                # Not a TFTP packet at all, or a broken one. Dropped, but a
+                # server that sends nothing else is given up on
+                if pkt is None:
+                    if hook is not None:
+                        hook.event('malformed', {'nbytes': nbytes, 'opcode': None})
+                    if over_budget(errors, 'malformed'):
+                        raise MalformedPacket("Too many malformed packets")
+                    continue
+
                 if server_TID == None:
+                    # Left over from an earlier transfer on a pooled socket,
+                    # or from anyone else
+                    if host_IP != sockaddr[0] or not first_response(pkt, direction):
+                        continue
                     server_TID = host_TID
+                    if first_response_at is None:
+                        first_response_at = time.time()
 
                 # If received packet with wrong TID, send ERR packet to the source
                 elif server_TID != host_TID:
-                    error_pack = make_packet_err(5, ERROR_CODES[5])
-                    s.sendto(error_pack, sender_addr)
+                    if not over_budget(errors, 'foreign'):
+                        error_pack = make_packet_err(5, ERROR_CODES[5])
+                        channel.sendto(error_pack, sender_addr)
                     continue 
 
-                (opcode, _,_) = pkt
+                opcode = pkt[0]
+
+                # OPTION ACK --------------------
+                # The server accepted our options. Pick up the block and window
+                # size and go on as if the request had been answered the plain way
+                if opcode == OPCODE_OACK:
+                    (opcode, accepted) = pkt
+                    repeated_oack = negotiated
+                    if direction == TFTP_GET and timed_blocknr == 1 and not repeated_oack:
+                        rtt.sample(time.time() - timed_at)
+                        timed_blocknr = None
+                        if hook is not None:
+                            hook.event('rtt', rtt_fields(rtt))
+                    block_size = negotiated_option(options, accepted, 'blksize', BLOCK_SIZE, BLKSIZE_MIN)
+                    window_size = negotiated_option(options, accepted, 'windowsize', 1, 1)
+                    wrap = negotiated_option(options, accepted, 'rollover', 0, 0)
+                    if block_size is None or window_size is None or wrap is None:
+                        raise OptionError("Bad OACK from server: %s" % accepted)
+                    negotiated = True
+                    if direction == TFTP_GET and offset and accepted.get('offset') == str(offset):
+                        skip = 0
+                    if length is not None and (skip or 'length' not in accepted):
+                        raise OptionError("Server cannot send a range of the file")
+                    if hook is not None:
+                        hook.event('oack', {'block_size': block_size, 'window_size': window_size})
 
+                    # For a WRQ the OACK takes the place of ACK 0
+                    if direction == TFTP_PUT:
+                        opcode = OPCODE_ACK
+                        pkt = (OPCODE_ACK, 0, b'')
 
 
                 # RECEIVED ERROR PACKET ---------
                 if opcode == OPCODE_ERR:
                     (opcode, errcode, errmsg) = pkt
-                    print "RECEIVED ERROR PACKET", errcode, errmsg
-                    break
+                    if hook is not None:
+                        hook.event('error', {'code': errcode, 'message': errmsg, 'sent': False})
+
+                    # Server does not like our options, ask again without them
+                    if errcode == 8 and options and not negotiated:
+                        print("Server refused options, falling back to " + str(BLOCK_SIZE) + " byte blocks")
+                        options = {}
+                        server_TID = None
+                        p = make_request(direction, fd.name, options)
+                        channel.sendto(p, sockaddr)
+                        wait_start = time.time()
+                        deadline = wait_start + rtt.rto
+                        if hook is not None:
+                            hook.event('request', {'opcode': direction == TFTP_GET and "RRQ" or "WRQ",
+                                                   'filename': fd.name, 'options': options})
+                        continue
+
+                    raise PeerError(errcode, errmsg)
 
                 # GET ---------------------------
+                # Acknowledge the OACK with block 0, the server then starts
+                # sending DATA. Resent OACKs means our ACK was lost
+                elif opcode == OPCODE_OACK and direction == TFTP_GET:
+                    if current_blocknr != 1:
+                        continue
+                    packets = [make_packet_ack(0)]
+
+                    # A repeated OACK means our ACK was lost, do not time the resent one
+                    if repeated_oack:
+                        timed_blocknr = None
+                    else:
+                        timed_blocknr = 1
+                        timed_at = time.time()
+                        wait_start = timed_at
+                        deadline = wait_start + rtt.rto
+                    if hook is not None:
+                        hook.event('ack_tx', {'blocknr': 0})
+
                 #If what we received is DATA, did we get the expected block?
-                #If yes, create ACK packet for the received block
-                #If not, create ACK packet for the previous block
+                #If yes, write it and ACK it if it is the last block of the window
+                #If not, ACK the last block we got in order so the server rewinds
 
                 elif opcode == OPCODE_DATA and direction == TFTP_GET:
+                    # A range without an OACK would be the whole file
+                    if length is not None and not negotiated:
+                        raise OptionError("Server cannot send a range of the file")
                     (opcode, blocknr, data) = pkt
-                    print "RECEIVED DATA BLOCKNR " + str(blocknr)
+                    blocknr = unwrap_blocknr(blocknr, current_blocknr, wrap)
                     
-                    # If received correct DATA block, write data to file and send ACK
+                    # If received correct DATA block, write data to file
                     if current_blocknr == blocknr:
+                        # Only timeouts count as retries and back off the RTO
+                        if resend_count:
+                            rtt.resume()
                         resend_count = 0
-
-                        fd.write(data)
+                        rewind_sent = False
+                        errors['duplicate'] = 0
+                        if hook is not None:
+                            hook.event('data_rx', {'blocknr': blocknr, 'nbytes': len(data)})
+                        if timed_blocknr == blocknr:
+                            rtt.sample(time.time() - timed_at)
+                            timed_blocknr = None
+                            if hook is not None:
+                                hook.event('rtt', rtt_fields(rtt))
+                        wait_start = time.time()
+                        deadline = wait_start + rtt.rto
 
                         # If last packet, set the last_packet-flag TRUE
-                        if len(data) < BLOCK_SIZE: 
+                        if len(data) < block_size: 
                             last_packet = True
 
-                        packet = make_packet_ack(blocknr)
+                        if skip:
+                            n = min(skip, len(data))
+                            skip -= n
+                            data = data[n:]
+                        total_bytes += len(data)
+
                         current_blocknr += 1
-                        print "Sending ACK for block: " + str(blocknr)
+                        window_count += 1
+
+                        # Only the last block of a window is acknowledged
+                        if window_count < window_size and not last_packet:
+                            writer.write(data)
+                            continue
+                        window_count = 0
+
+                        packets = [make_packet_ack(wire_blocknr(blocknr, wrap))]
+                        pending_data = data
+                        timed_blocknr = blocknr + 1
+                        timed_at = time.time()
+                        if hook is not None:
+                            hook.event('ack_tx', {'blocknr': blocknr})
                         
 
 
-                    # Else, received wrong (a duplicate) DATA block, RE-Send the previous ACK
+                    # Else, received a duplicate or out of order DATA block,
+                    # RE-Send the ACK for the last block we have
                     else:
-                        packet = make_packet_ack(blocknr)
                         total_packet_lost += 1
-                        resend_count += 1
-                        print "Duplicate!"
-                        print "RE-Sending ACK for block: " + str(blocknr) + ", resend count: " + str(resend_count)
+                        if hook is not None:
+                            hook.event('duplicate', {'blocknr': blocknr, 'expected': current_blocknr})
+                        if over_budget(errors, 'duplicate'):
+                            raise Duplicates("Too many duplicate DATA packets")
+                        if rewind_sent and time.time() - rewind_at < rtt.repeat_window():
+                            continue
+                        if window_size > 1:
+                            rewind_sent = True
+                            rewind_at = time.time()
+                        window_count = 0
+                        timed_blocknr = None
+                        packets = [make_packet_ack(wire_blocknr(current_blocknr - 1, wrap))]
+                        if hook is not None:
+                            hook.event('retransmit', {'what': "ACK", 'blocknr': current_blocknr - 1,
+                                                      'count': resend_count})
 
 
                 # PUT ----------------------------
-                #If what we received is ACK, did we get the expected block?
-                #If yes, create DATA packet for the next block
-                #If not, create DATA packet for the previous block
+                #If what we received is ACK, slide the window up to that block
+                #and fill it with new DATA packets. Anything after the
+                #acknowledged block is sent again
                 elif opcode == OPCODE_ACK and direction == TFTP_PUT:
-                    (opcode, blocknr, _) = pkt
-                    print "RECEIVED ACK BLOCKNR: " + str(blocknr)
-                    #print "Current BLOCK NR: " +str(current_blocknr)
-                    
-                    # If received correct ACK block, create next DATA block
-                    if current_blocknr == blocknr:
+                    (opcode, ack_blocknr, _) = pkt
+                    ack_blocknr = unwrap_blocknr(ack_blocknr, current_blocknr, wrap)
+                    if hook is not None:
+                        hook.event('ack_rx', {'blocknr': ack_blocknr})
+
+                    # Ignore ACKs outside of the window, they are left over
+                    # from an earlier rewind
+                    repeated = (ack_blocknr == rewound_to and
+                                time.time() - rewound_at < rtt.repeat_window())
+                    if ack_blocknr < current_blocknr or ack_blocknr > blocknr or repeated:
+                        if repeated:
+                            total_packet_lost += 1
+                        if over_budget(errors, 'duplicate'):
+                            raise Duplicates("Too many stale ACK packets")
+                        continue
+
+                    if timed_blocknr == ack_blocknr:
+                        rtt.sample(time.time() - timed_at)
+                        timed_blocknr = None
+                        if hook is not None:
+                            hook.event('rtt', rtt_fields(rtt))
+                    # The first ACK, or one for blocks we had not heard of.
+                    # The transfer moves, whatever retries and backoff there
+                    # were are over even if it still needs a rewind
+                    if ack_blocknr > current_blocknr or not window:
+                        errors['duplicate'] = 0
                         resend_count = 0
-                        current_blocknr += 1
+                        rtt.resume()
+                        wait_start = time.time()
+                        deadline = wait_start + rtt.rto
+
+                    rewind = ack_blocknr < blocknr
+                    old_blocknr = blocknr
+                    if rewind:
+                        # The server did not get the whole window, rewind.
+                        # It is still there, so only timeouts count as retries
+                        total_packet_lost += 1
+                        rewound_to = ack_blocknr
+                        rewound_at = time.time()
+                        if hook is not None:
+                            hook.event('rewind', {'blocknr': ack_blocknr})
+
+                    del window[:ack_blocknr - current_blocknr]
+                    current_blocknr = ack_blocknr
+                    if source is not None:
+                        source.release(ack_blocknr)
+
+                    # The last block has been acknowledged, we are done
+                    if last_packet and not window:
+                        completed = True
+                        break
+
+                    if slots is None:
+                        slots = [PacketBuffer(block_size) for i in range(window_size)]
+                        if filemap is not None:
+                            source = filemap.source(block_size)
+                        else:
+                            source = tftp_io.open_source(fd, block_size)
+
+                    while len(window) < window_size and not last_packet:
                         blocknr += 1
-                        data_block = fd.read(BLOCK_SIZE)
+                        slot = slots[blocknr % window_size]
+                        block = source.block(blocknr)
+                        data_length = slot.fill(wire_blocknr(blocknr, wrap), block)
+                        if digest is not None:
+                            digest.update(block)
   
                         # If last DATA packet to send, set the last_packet-flag TRUE
                         # if blx to small, do not send moar
-                        if(len(data_block) < BLOCK_SIZE):
-                            msg = "Sending last"
+                        if(data_length < block_size):
                             last_packet = True
-                            
-                        # Else create normal block_size'd DATA packet
-                        else:
-                            msg = "Sending"
 
-                        packet = make_packet_data(blocknr, data_block)
-                        print "Sending " +str(len(data_block)) +" bytes of data"
-                        print msg + " block: " + str(blocknr)
+                        window.append(slot.packet)
+                        total_bytes += data_length
+                        if hook is not None:
+                            hook.event('data_tx', {'blocknr': blocknr, 'nbytes': data_length})
+
+                    # After a rewind everything up to the old end of the
+                    # window goes out again
+                    if rewind and hook is not None:
+                        for n in range(ack_blocknr + 1, old_blocknr + 1):
+                            hook.event('retransmit', {'what': "DATA", 'blocknr': n, 'count': resend_count})
+
+                    packets = window
+
+                    # Time the last block of the window, unless a rewind
+                    # left nothing in it but retransmissions
+                    if blocknr == old_blocknr:
+                        timed_blocknr = None
                     else:
-                        total_packet_lost += 1
-                        resend_count += 1
-                        (_, blocknr, _) = parse_packet(packet)
-                        print "Wrong ACK number! Resend last ACK, block " + str(blocknr)
+                        timed_blocknr = blocknr
+                        timed_at = time.time()
+
+                # A request, or DATA or ACK going the wrong way. Nothing a
+                # server of ours should send
+                else:
+                    if hook is not None:
+                        hook.event('malformed', {'nbytes': nbytes, 'opcode': opcode})
+                    if over_budget(errors, 'malformed'):
+                        raise MalformedPacket("Too many packets with opcode %d" % opcode)
+                    continue
                     
 
-                # SEND PACKET MADE IN GET OR PUT ---------------
-                print "------------------------------------"
-                (bytes) = s.sendto(packet, sender_addr)
-                if last_packet == True:
+                # The last ACK tells the server the file is in, so unlike
+                # the others it waits until everything is written and synced.
+                # If that fails the server gets an ERROR instead
+                if last_packet and direction == TFTP_GET and pending_data is not None:
+                    writer.write(pending_data)
+                    pending_data = None
+                    writer_closed = True
+                    try:
+                        writer.close()
+                    except tftp_io.WriteError:
+                        raise
+                    except (IOError, OSError) as e:
+                        raise tftp_io.WriteError(e.errno, e.strerror)
+
+                # SEND PACKETS MADE IN GET OR PUT ---------------
+                channel.send_window(packets, sender_addr)
+
+                # The ACK is out, now store the block it acknowledged. data
+                # still points into its receive buffer, nothing has been
+                # received into that since
+                if pending_data is not None:
+                    writer.write(pending_data)
+                    pending_data = None
+                if last_packet == True and direction == TFTP_GET:
+                    completed = True
                     break
 
 
-            # Initial request timed out
+            # Request or DATA/ACK timed out
             else:
+                # Back off the timer and stop timing, whatever we send now is
+                # a retransmission
+                if direction == TFTP_PUT:
+                    rewound_to = None
+                timeouts += 1
+                waited = time.time() - wait_start
+                timeout_time += waited
+                rtt.backoff()
+                timed_blocknr = None
+                wait_start = time.time()
+                deadline = wait_start + rtt.rto
+                if hook is not None:
+                    hook.event('timeout', {'rto': rtt.rto, 'waited': waited})
+
+                # If failed to resend packet too many times and the server stop responding
+                if resend_count > 3:
+                    raise RetriesExceeded("Retried to send packet to many times. Terminating request")
+
+                # If the ACK for the OACK was lost, resend it to the server TID
+                elif direction == TFTP_GET and current_blocknr == 1 and negotiated:
+                    resend_count += 1
+                    channel.sendto(make_packet_ack(0), sender_addr)
+                    if hook is not None:
+                        hook.event('retransmit', {'what': "ACK", 'blocknr': 0, 'count': resend_count})
+
                 # If RRQ packet was lost, resend
-                if direction == TFTP_GET and current_blocknr == 1:
-                    (bytes) = s.sendto(p, sender_addr)
-                    print "Timeout! Resent RRQ packet"
+                elif direction == TFTP_GET and current_blocknr == 1:
+                    resend_count += 1
+                    channel.sendto(p, sockaddr)
+                    if hook is not None:
+                        hook.event('retransmit', {'what': "RRQ", 'blocknr': None, 'count': resend_count})
 
                 # Else if WRQ packet was lost, resend
-                elif direction == TFTP_PUT and current_blocknr == 0:
-                    (bytes) = s.sendto(p, sender_addr)
-                    print "Timeout! Resent WRQ packet"
+                elif direction == TFTP_PUT and current_blocknr == 0 and not window:
+                    resend_count += 1
+                    channel.sendto(p, sockaddr)
+                    if hook is not None:
+                        hook.event('retransmit', {'what': "WRQ", 'blocknr': None, 'count': resend_count})
 
-                # If failed to resend packet too many times and the server stop responding
-                elif resend_count > 3:
-                    print "Retried to send packet to many times. Terminating request"
-                    break
+                # Our ACK was lost, or the whole window. Send the ACK again
+                elif direction == TFTP_GET:
+                    resend_count += 1
+                    rewind_sent = False
+                    window_count = 0
+                    channel.sendto(make_packet_ack(wire_blocknr(current_blocknr - 1, wrap)), sender_addr)
+                    if hook is not None:
+                        hook.event('retransmit', {'what': "ACK", 'blocknr': current_blocknr - 1,
+                                                  'count': resend_count})
 
-                # No response yet
-                #else:
-                    #print "Timeout!"
+                # No ACK for the window, send it all again
+                else:
+                    resend_count += 1
+                    channel.send_window(window, sender_addr)
+                    if hook is not None:
+                        for n in range(current_blocknr + 1, blocknr + 1):
+                            hook.event('retransmit', {'what': "DATA", 'blocknr': n, 'count': resend_count})
 
     # EXCEPTION ---------------------------------------------------------------------------           
-        except: 
-            print "Exception!!"
-    s.close()
+        except TftpError as e:
+            print(e)
+            error = str(e)
+            if e.code is not None:
+                send_error(channel, sender_addr, e.code, ERROR_CODES[e.code], hook)
+            break
+        except tftp_io.WriteError as e:
+            # Could not store what we received, tell the server to stop
+            print("Write error:", e.strerror)
+            error = "Write error: %s" % e.strerror
+            (errcode, errmsg) = write_error(e)
+            send_error(channel, sender_addr, errcode, errmsg, hook)
+            break
+        except socket.error as e:
+            # The next timeout sends it again, unless sending keeps failing
+            print("Send error:", e)
+            if over_budget(errors, 'socket'):
+                error = "Send error: %s" % e
+                break
+        except Exception as e:
+            # A bug of ours. End the transfer rather than loop on it
+            print("Internal error:", repr(e))
+            error = "Internal error: %r" % e
+            if received is not None:
+                send_error(channel, sender_addr, 0, ERROR_CODES[0], hook)
+            break
+    channel.close()
+    if session is not None and completed:
+        session.release(s)
+    else:
+        s.close()
+    # A writer that failed has stopped already and the error is reported.
+    # Sync even if we failed, what we have is where a resume starts
+    if direction == TFTP_GET and writer.error is None and not writer_closed:
+        try:
+            writer.close()
+        except (IOError, OSError) as e:
+            print("Write error:", e.strerror)
+            error = "Write error: %s" % e.strerror
+            completed = False
+    if direction == TFTP_PUT and source is not None:
+        source.close()
+
+    end_time = time.time()
+    stats = {'completed': completed,
+             'bytes': total_bytes,
+             'time': end_time - start_time,
+             'block_size': block_size,
+             'window_size': window_size,
+             'packets_lost': total_packet_lost,
+             'timeouts': timeouts,
+             'timeout_time': timeout_time,
+             'srtt': rtt.srtt,
+             'rttvar': rtt.rttvar,
+             'rto': rtt.rto,
+             'rtt_samples': rtt.samples,
+             'digest': digest and digest.hexdigest(),
+             'offset': offset,
+             'length': length,
+             'resolve_time': resolve_time,
+             'socket_time': socket_time,
+             'first_response_time': first_response_at and first_response_at - request_at,
+             'data_time': first_response_at and end_time - first_response_at,
+             'batch': channel.batch,
+             'syscalls': channel.syscalls,
+             'malformed': errors['malformed'],
+             'foreign': errors['foreign'],
+             'error': error}
+    if hook is not None:
+        hook.event('done', stats)
+    return stats
+
+
+def tftp_transfer(fd, hostname, direction, port, blksize=None, windowsize=WINDOW_SIZE,
+                  rto_min=RTO_MIN, rto_max=RTO_MAX, write_buffer=tftp_io.WRITE_BEHIND_MAX, hook=None,
+                  digest=None, offset=0, rollover=0, session=None, filemap=None, length=None,
+                  batch=tftp_batch.BATCH_MAX, checkpoint=None):
+    """Transfer fd to or from hostname. Returns a dict with statistics about
+        the transfer, including the state of the retransmission timer and the
+        time spent waiting for packets that never came.
+
+        On GET the received data is written by a background thread, holding
+        at most write_buffer bytes that are not on disk yet, so that a slow
+        disk does not hold up our ACKs. With write_buffer 0 every block is
+        written before it is acknowledged.
+
+        hook, if given, is told about every packet, retransmission, timeout
+        and RTT sample, see tftp_events.
+
+        digest, a hashlib object, is fed the file as it goes by. Its
+        hexdigest is returned in the dict, so a downloaded file can be
+        verified without reading it back.
+
+        A GET with offset asks for the file from that byte on, fd must be
+        positioned there. Servers that do not know the offset option send
+        the whole file, we then drop the first offset bytes ourselves.
+
+        A GET with length asks for only that many bytes from offset on. That
+        needs a server that knows both options, from any other the transfer
+        is refused with ERROR 8 and does not complete.
+
+        Files of more than 65535 blocks are fine, block numbers roll over to
+        0. A rollover of 1 asks the server to roll over to 1 instead.
+
+        With a TftpSession the server address and the socket come from the
+        session. The dict has the time spent in each phase of the transfer:
+        resolving the name, getting a socket, waiting for the first answer
+        and moving the data.
+
+        A PUT reads its blocks from filemap, a tftp_io.FileMap of fd, if one
+        is given. Transfers of the same file can share it.
+
+        Up to batch datagrams are received or sent per system call where the
+        system can, see tftp_batch. The dict counts the system calls made.
+
+        A transfer that does not complete says why in error. Packets that
+        make no sense are dropped and counted in malformed, packets from
+        other TIDs in foreign, up to the limits in ERROR_BUDGET.
+
+        A GET calls checkpoint(nbytes, hexdigest), if given, every now and
+        then with the bytes it has synced to fd so far, see
+        tftp_io.WriteBehind.
+
+        For running many transfers in one thread see LoopTransfer, and
+        tftp_transfer_async for asyncio code"""
+    steps = transfer_steps(fd, hostname, direction, port, blksize, windowsize, rto_min, rto_max,
+                           write_buffer, hook, digest, offset, rollover, session, filemap, length, batch,
+                           checkpoint)
+    try:
+        (channel, timeout) = next(steps)
+        while True:
+            (channel, timeout) = steps.send(channel.receive(timeout))
+    except StopIteration as e:
+        return e.value
+
+
+class LoopTransfer(object):
+    """Drives transfer_steps on a tftp_loop.EventLoop, so that one thread can
+        run any number of transfers. done(stats, error) is called once the
+        transfer is over, with the dict of tftp_transfer, or with None and
+        the exception if the transfer raised one"""
+
+    def __init__(self, loop, steps, done):
+        self.loop = loop
+        self.steps = steps
+        self.done = done
+        self.channel = None
+        self.timer = loop.timer(self.on_timeout)
+        self.advance(None)
+
+    def advance(self, received):
+        """Hand received to the transfer and wait for what it wants next.
+            False once the transfer is over"""
+        try:
+            if self.channel is None:
+                (channel, timeout) = next(self.steps)
+            else:
+                (channel, timeout) = self.steps.send(received)
+        except StopIteration as e:
+            self.finish(e.value, None)
+            return False
+        except (IOError, socket.error) as e:
+            self.finish(None, e)
+            return False
+        if self.channel is None:
+            self.channel = channel
+            self.loop.register(channel.sock, self.on_readable)
+        # The transfer yields what is left until its retransmission deadline,
+        # which only moves when the transfer does. Packets that leave it
+        # where it was leave the timer where it was
+        deadline = time.time() + timeout
+        if not self.timer.armed() or abs(deadline - self.timer.deadline) > tftp_loop.TICK:
+            self.loop.arm(self.timer, deadline)
+        return True
+
+    def on_readable(self, sock):
+        while True:
+            received = self.channel.receive_nowait()
+            if received is None or not self.advance(received):
+                return
+
+    def on_timeout(self):
+        self.advance(None)
+
+    def finish(self, stats, error):
+        self.loop.cancel(self.timer)
+        if self.channel is not None:
+            # The socket is closed or back in the session pool by now
+            self.loop.unregister(self.channel.sock)
+        self.done(stats, error)
+
+
+class AsyncioTransfer(object):
+    """Drives transfer_steps on an asyncio event loop, the way LoopTransfer
+        does on a tftp_loop.EventLoop: the socket is watched with add_reader
+        and the retransmission deadline is a call_at. future gets the dict
+        of tftp_transfer, or the exception the transfer raised. Cancelling
+        future stops the transfer"""
+
+    def __init__(self, loop, steps):
+        self.loop = loop
+        self.steps = steps
+        self.future = loop.create_future()
+        self.future.add_done_callback(self.on_done)
+        self.channel = None
+        self.fileno = None
+        self.timer = None
+        self.advance(None)
+
+    def advance(self, received):
+        """Like LoopTransfer.advance"""
+        try:
+            if self.channel is None:
+                (channel, timeout) = next(self.steps)
+            else:
+                (channel, timeout) = self.steps.send(received)
+        except StopIteration as e:
+            self.finish(e.value, None)
+            return False
+        except (IOError, socket.error) as e:
+            self.finish(None, e)
+            return False
+        if self.channel is None:
+            self.channel = channel
+            self.fileno = channel.sock.fileno()
+            self.loop.add_reader(self.fileno, self.on_readable)
+        deadline = self.loop.time() + timeout
+        if self.timer is None or abs(deadline - self.timer.when()) > tftp_loop.TICK:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = self.loop.call_at(deadline, self.on_timeout)
+        return True
+
+    def on_readable(self):
+        while True:
+            received = self.channel.receive_nowait()
+            if received is None or not self.advance(received):
+                return
+
+    def on_timeout(self):
+        self.timer = None
+        self.advance(None)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.fileno is not None:
+            # The socket is closed or back in the session pool by now
+            self.loop.remove_reader(self.fileno)
+            self.fileno = None
+
+    def finish(self, stats, error):
+        self.stop()
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(stats)
+
+    def on_done(self, future):
+        if future.cancelled():
+            self.stop()
+            self.steps.close()
+
+
+async def tftp_transfer_async(fd, hostname, direction, port, *args, **kwargs):
+    """tftp_transfer for asyncio code, with the same arguments. Returns the
+        same dict once the transfer is over. The name is looked up with the
+        getaddrinfo of the loop, so that a slow lookup does not hold it up"""
+    loop = asyncio.get_running_loop()
+    addresses = await loop.getaddrinfo(hostname, port, type=socket.SOCK_DGRAM)
+    steps = transfer_steps(fd, addresses[0][4][0], direction, port, *args, **kwargs)
+    return await AsyncioTransfer(loop, steps).future
+
+
+def tftp_resume(filename, hostname, port, blksize=None, windowsize=WINDOW_SIZE, hook=None,
+                digest=None):
+    """GET filename into a local file of the same name, carrying on where an
+        earlier attempt stopped. The checkpoint next to the file has the
+        length and digest of what made it to disk, see
+        tftp_io.resume_point. It is written while the data comes in, so a
+        GET that is killed loses at most the last few seconds, and once more
+        when a GET fails. Returns the dict of tftp_transfer, with digest and
+        size covering the whole file"""
+    if digest is None:
+        digest = hashlib.md5()
+    (offset, digest) = tftp_io.resume_point(filename, digest)
+    if offset:
+        fd = open(filename, "r+b")
+        print("Resuming %s at byte %d" % (filename, offset))
+    else:
+        fd = open(filename, "wb")
+
+    def checkpoint(nbytes, hexdigest):
+        tftp_io.save_checkpoint(filename, {'filename': filename,
+                                           'host': hostname,
+                                           'bytes': offset + nbytes,
+                                           'digest_name': digest.name,
+                                           'digest': hexdigest})
+
+    try:
+        fd.seek(offset)
+        fd.truncate()
+        stats = tftp_transfer(fd, hostname, TFTP_GET, port, blksize, windowsize,
+                              hook=hook, digest=digest, offset=offset, checkpoint=checkpoint)
+        size = fd.tell()
+    finally:
+        fd.close()
+
+    stats['size'] = size
+    if stats['completed']:
+        tftp_io.remove_checkpoint(filename)
+    else:
+        tftp_io.save_checkpoint(filename, {'filename': filename,
+                                           'host': hostname,
+                                           'bytes': size,
+                                           'block_size': stats['block_size'],
+                                           'blocks': size // stats['block_size'],
+                                           'digest_name': digest.name,
+                                           'digest': stats['digest']})
+    return stats
 
 
 def usage():
     """Print the usage on stderr and quit with error code"""
-    sys.stderr.write("Usage: %s [-g|-p] FILE HOST\n" % sys.argv[0])
+    sys.stderr.write("Usage: %s [-g|-p] [-v] [-j EVENTS.jsonl] [-m MANIFEST] [-r] FILE HOST\n" % sys.argv[0])
     sys.exit(1)
 
 # MAIN_2 ---------------------------------------------------------------------------   
-def main_performance(filename, direction, hostname, port, n_iterations):
+def format_phase(seconds):
+    if seconds is None:
+        return "-"
+    return "%.3f ms" % (seconds * 1000)
+
+def main_performance(filename, direction, hostname, port, n_iterations, blksize=None, windowsize=WINDOW_SIZE,
+                     hook=None, session=None):
     TFTP_PORT= port
     # No need to change this function
     if direction == TFTP_GET:
-        print "Transfer file %s from host %s" % (filename, hostname)
+        print("Transfer file %s from host %s" % (filename, hostname))
     else:
-        print "Transfer file %s to host %s" % (filename, hostname)
+        print("Transfer file %s to host %s" % (filename, hostname))
 
     total_time = 0
+    # All iterations share the name lookup and the socket
+    own_session = session is None
+    if own_session:
+        session = TftpSession()
 
     for i in range(0,n_iterations):
         try:
@@ -272,81 +1410,117 @@ def main_performance(filename, direction, hostname, port, n_iterations):
             sys.stderr.write("File error (%s): %s\n" % (filename, e.strerror))
             sys.exit(2)
         start = time.time()
-        tftp_transfer(fd, hostname, direction, port)
+        stats = tftp_transfer(fd, hostname, direction, port, blksize, windowsize, hook=hook, session=session)
         stop = time.time()
         time_taken = stop-start
-        print "Time taken: " + str(time_taken) + ", Iteration: " + str(i)
-        print "++++++++++++++++++++++++++++++++++++"
-        print "\n"
+        print("Time taken: " + str(time_taken) + ", Iteration: " + str(i))
+        print("Timeouts: %d (%.3f s), SRTT: %s, RTO: %.3f" % (stats['timeouts'], stats['timeout_time'],
+                                                             stats['srtt'], stats['rto']))
+        print("Resolve: %s, socket: %s, first response: %s, data: %s" % (
+            format_phase(stats['resolve_time']), format_phase(stats['socket_time']),
+            format_phase(stats['first_response_time']), format_phase(stats['data_time'])))
+        print("++++++++++++++++++++++++++++++++++++")
+        print("\n")
         total_time += time_taken
         fd.close()
 
+    if own_session:
+        session.close()
     average_time = total_time/n_iterations
-    print "Average time taken: " + str(average_time)
+    print("Average time taken: " + str(average_time))
     return average_time
 
 
 # MAIN ---------------------------------------------------------------------------   
 
 def main():
-    # No need to change this function
-    # select
+    # -v prints every packet, -j appends the events of the transfer to a
+    # JSON lines file, one object per line. A downloaded file is checked
+    # against the manifest given with -m, see tftp_io.load_manifest. With -r
+    # a GET carries on where the last one failed, see tftp_resume
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "gpvj:m:r")
+    except getopt.GetoptError:
+        usage()
+        return
+    if len(args) != 2:
+        usage()
+        return
+    (filename, hostname) = args
+
     direction = TFTP_GET
-    if len(sys.argv) == 3:
-        filename = sys.argv[1]
-        hostname = sys.argv[2]
-    elif len(sys.argv) == 4:
-        if sys.argv[1] == "-g":
+    console = None
+    events_file = None
+    manifest_file = MANIFEST
+    resume = False
+    for (opt, value) in opts:
+        if opt == "-g":
             direction = TFTP_GET
-        elif sys.argv[1] == "-p":
+        elif opt == "-p":
             direction = TFTP_PUT
-        else:
-            usage()
-            return
-        filename = sys.argv[2]
-        hostname = sys.argv[3]
-    else:
-        usage()
-        return
+        elif opt == "-v":
+            console = tftp_events.Console()
+        elif opt == "-j":
+            events_file = value
+        elif opt == "-m":
+            manifest_file = value
+        elif opt == "-r":
+            resume = True
 
     if direction == TFTP_GET:
-        print "Transfer file %s from host %s" % (filename, hostname)
+        print("Transfer file %s from host %s" % (filename, hostname))
     else:
-        print "Transfer file %s to host %s" % (filename, hostname)
+        print("Transfer file %s to host %s" % (filename, hostname))
 
-    try:
-        if direction == TFTP_GET:
-            fd = open(filename, "wb")
-        else:
-            fd = open(filename, "rb")
-    except IOError as e:
-        sys.stderr.write("File error (%s): %s\n" % (filename, e.strerror))
-        sys.exit(2)
+    if not (resume and direction == TFTP_GET):
+        try:
+            if direction == TFTP_GET:
+                fd = open(filename, "wb")
+            else:
+                fd = open(filename, "rb")
+        except IOError as e:
+            sys.stderr.write("File error (%s): %s\n" % (filename, e.strerror))
+            sys.exit(2)
 
-    tftp_transfer(fd, hostname, direction, TFTP_PORT)
-    fd.close()
+    events = None
+    if events_file is not None:
+        try:
+            events = open(events_file, "a")
+        except IOError as e:
+            sys.stderr.write("File error (%s): %s\n" % (events_file, e.strerror))
+            sys.exit(2)
+    metrics = tftp_events.Metrics()
+    hook = tftp_events.combine(metrics, console, events and tftp_events.JsonLines(events))
+
+    if resume and direction == TFTP_GET:
+        try:
+            stats = tftp_resume(filename, hostname, TFTP_PORT, hook=hook)
+        except IOError as e:
+            sys.stderr.write("File error (%s): %s\n" % (filename, e.strerror))
+            sys.exit(2)
+    else:
+        stats = tftp_transfer(fd, hostname, direction, TFTP_PORT, hook=hook, digest=hashlib.md5())
+        fd.close()
+        stats['size'] = stats['bytes']
+    if events is not None:
+        events.close()
+    metrics.report()
 
+    # The digest was taken while the file was written, no need to read it back
     if direction == TFTP_GET:
-        with open(filename, "rb") as fd:
-            d = fd.read()
-        md5 = hashlib.md5(d).hexdigest()
-        print md5
-        print str(len(d))
-        if filename == "small.txt" or filename == "ensmall.txt":
-            true_md5 = "667ff61c0d573502e482efa85b468f1f"
-            true_size = 1931
-        elif filename == "medium.pdf" or filename == "enmedium.pdf":
-            true_md5 = "ee98d0524433e2ca4c0c1e05685171a7"
-            true_size = 17577
-        elif filename == "large.jpeg" or filename == "enlarge.jpeg":
-            true_md5 = "f5b558fe29913cc599161bafe0c08ccf"
-            true_size = 82142
-
-        print true_md5
-        if md5 == true_md5 and len(d) == true_size:
-            print "True"
+        print(stats['digest'])
+        print(str(stats['size']))
+        try:
+            manifest = tftp_io.load_manifest(manifest_file)
+        except IOError as e:
+            sys.stderr.write("Manifest error (%s): %s\n" % (manifest_file, e.strerror))
+            sys.exit(2)
+        ok = tftp_io.check_manifest(manifest, filename, stats['digest'], stats['size'])
+        if ok is None:
+            print("%s is not in %s" % (filename, manifest_file))
         else:
-            print "False"
+            print(manifest[os.path.basename(filename)][0])
+            print(str(ok and stats['completed']))
 
 if __name__ == "__main__":
     main()
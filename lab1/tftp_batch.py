@@ -0,0 +1,241 @@
+#! /usr/bin/python3
+#
+# Batched datagram I/O for tftp.tftp_transfer.
+#
+# With a window of blocks in flight a transfer spends most of its time in
+# one recvfrom and one sendto per packet. On Linux recvmmsg(2) takes every
+# datagram that is waiting, up to BATCH_MAX, in one call, and sendmmsg(2)
+# sends a whole window in one. Both are called through ctypes. Where they
+# are missing BatchSocket does one packet per call, like tftp_transfer
+# always did.
+#
+# BatchSocket also counts the system calls it makes, waits for the socket
+# included, so that transfers can report syscalls per MB.
+import os,sys,socket,selectors,struct,errno,collections,ctypes,ctypes.util
+
+# Most datagrams received or sent in one system call
+BATCH_MAX= 32
+
+# Room for any socket address, see sockaddr_storage
+SOCKADDR_SIZE= 128
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def load_libc():
+    """libc if it has recvmmsg and sendmmsg, None otherwise"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int,
+                                  ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+libc = load_libc()
+
+
+def available():
+    """True if datagrams can be batched here"""
+    return libc is not None
+
+
+def encode_sockaddr(addr, family):
+    """C socket address for the Python address addr"""
+    if family == socket.AF_INET6:
+        (host, port) = addr[:2]
+        flowinfo = len(addr) > 2 and addr[2] or 0
+        scope_id = len(addr) > 3 and addr[3] or 0
+        return (struct.pack("=H", family) + struct.pack("!HI", port, flowinfo)
+                + socket.inet_pton(family, host.split("%")[0]) + struct.pack("=I", scope_id))
+    (host, port) = addr
+    return struct.pack("=H", family) + struct.pack("!H", port) + socket.inet_aton(host) + b'\0' * 8
+
+
+def decode_sockaddr(data):
+    """Python address of a C socket address"""
+    family = struct.unpack_from("=H", data)[0]
+    if family == socket.AF_INET6:
+        (port, flowinfo) = struct.unpack_from("!HI", data, 2)
+        scope_id = struct.unpack_from("=I", data, 24)[0]
+        return socket.inet_ntop(family, data[8:24]), port, flowinfo, scope_id
+    port = struct.unpack_from("!H", data, 2)[0]
+    return socket.inet_ntop(socket.AF_INET, data[4:8]), port
+
+
+def raise_errno():
+    e = ctypes.get_errno()
+    raise socket.error(e, os.strerror(e))
+
+
+class BatchSocket(object):
+    """Receives and sends the datagrams of one transfer on sock, batch of
+        them per system call at most. A batch of 1, or a system without
+        recvmmsg, gives plain recvfrom_into and sendto.
+
+        receive() hands out datagrams as views into buffers of packet_size
+        bytes. A view is only valid until the next receive() that has to go
+        to the kernel, that is once every datagram of its batch has been
+        handed out"""
+
+    def __init__(self, sock, packet_size, batch=BATCH_MAX):
+        self.sock = sock
+        self.family = sock.family
+        self.batch = max(1, batch)
+        if not available():
+            self.batch = 1
+        self.syscalls = 0
+        self.selector = None
+        self.backlog = collections.deque()
+        self.bufs = [bytearray(packet_size) for i in range(self.batch)]
+        self.views = [memoryview(buf) for buf in self.bufs]
+        self.addrs = {}
+        if self.batch == 1:
+            return
+
+        # Every receive slot points at its own buffer and address for good
+        self.rx_msgs = (mmsghdr * self.batch)()
+        self.rx_iovs = (iovec * self.batch)()
+        self.rx_data = [(ctypes.c_char * packet_size).from_buffer(buf) for buf in self.bufs]
+        self.rx_names = [bytearray(SOCKADDR_SIZE) for i in range(self.batch)]
+        self.rx_name_views = [memoryview(name) for name in self.rx_names]
+        # Slots filled by the last recvmmsg, their address lengths must be
+        # set back before the next one
+        self.rx_used = self.batch
+        for i in range(self.batch):
+            self.rx_iovs[i].iov_base = ctypes.addressof(self.rx_data[i])
+            self.rx_iovs[i].iov_len = packet_size
+            hdr = self.rx_msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(ctypes.c_char.from_buffer(self.rx_names[i]))
+            hdr.msg_iov = ctypes.pointer(self.rx_iovs[i])
+            hdr.msg_iovlen = 1
+        self.tx_msgs = (mmsghdr * self.batch)()
+        self.tx_iovs = (iovec * self.batch)()
+        # Address the send slots point at, set when it changes
+        self.tx_addr = None
+        self.tx_name = None
+        for i in range(self.batch):
+            self.tx_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.tx_iovs[i])
+            self.tx_msgs[i].msg_hdr.msg_iovlen = 1
+
+    def receive(self, timeout):
+        """Next datagram as (view, nbytes, addr), or None if none came within
+            timeout seconds"""
+        if self.backlog:
+            return self.backlog.popleft()
+        if self.selector is None:
+            # Set up once, not for every wait like select.select
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.sock, selectors.EVENT_READ)
+        while True:
+            self.syscalls += 1
+            if not self.selector.select(timeout):
+                return None
+            if self.read():
+                return self.backlog.popleft()
+            # Readable, but the datagram is gone again (a bad checksum)
+
+    def receive_nowait(self):
+        """Next datagram like receive, or None if there is none waiting. For
+            callers that have their own event loop, see tftp_loop"""
+        if self.backlog or self.read():
+            return self.backlog.popleft()
+        return None
+
+    def read(self):
+        """Move the datagrams waiting on the socket to the backlog without
+            blocking. False if there were none"""
+        self.syscalls += 1
+        if self.batch == 1:
+            try:
+                (nbytes, addr) = self.sock.recvfrom_into(self.bufs[0], 0, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.backlog.append((self.views[0], nbytes, addr))
+            return True
+        for i in range(self.rx_used):
+            self.rx_msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        n = libc.recvmmsg(self.sock.fileno(), self.rx_msgs, self.batch, socket.MSG_DONTWAIT, None)
+        if n <= 0:
+            self.rx_used = 0
+            if ctypes.get_errno() not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise_errno()
+            return False
+        self.rx_used = n
+        for i in range(n):
+            msg = self.rx_msgs[i]
+            name = self.rx_name_views[i][:msg.msg_hdr.msg_namelen].tobytes()
+            addr = self.addrs.get(name)
+            if addr is None:
+                addr = self.addrs[name] = decode_sockaddr(name)
+            self.backlog.append((self.views[i], msg.msg_len, addr))
+        return True
+
+    def sendto(self, packet, addr):
+        self.syscalls += 1
+        return self.sock.sendto(packet, addr)
+
+    def send_window(self, packets, addr):
+        """Send all of packets to addr, batch of them per system call"""
+        if self.batch == 1 or len(packets) == 1:
+            for packet in packets:
+                self.sendto(packet, addr)
+            return
+        if addr != self.tx_addr:
+            sockaddr = encode_sockaddr(addr, self.family)
+            self.tx_name = ctypes.create_string_buffer(sockaddr, len(sockaddr))
+            self.tx_addr = addr
+            for i in range(self.batch):
+                hdr = self.tx_msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(self.tx_name)
+                hdr.msg_namelen = len(sockaddr)
+        # Keep the C views of the packets alive until they are sent
+        data = []
+        for start in range(0, len(packets), self.batch):
+            chunk = packets[start:start + self.batch]
+            for (i, packet) in enumerate(chunk):
+                # The first byte is enough to know where the packet is
+                try:
+                    c_packet = ctypes.c_char.from_buffer(packet)
+                except (TypeError, ValueError):
+                    # bytes are read only, they are copied
+                    c_packet = ctypes.create_string_buffer(bytes(packet), len(packet))
+                data.append(c_packet)
+                self.tx_iovs[i].iov_base = ctypes.addressof(c_packet)
+                self.tx_iovs[i].iov_len = len(packet)
+            sent = 0
+            while sent < len(chunk):
+                self.syscalls += 1
+                n = libc.sendmmsg(self.sock.fileno(), ctypes.byref(self.tx_msgs[sent]), len(chunk) - sent, 0)
+                if n < 0:
+                    if ctypes.get_errno() == errno.EINTR:
+                        continue
+                    raise_errno()
+                sent += n
+
+    def close(self):
+        """Release the selector, the socket is left to its owner"""
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
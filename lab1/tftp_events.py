@@ -0,0 +1,184 @@
+#! /usr/bin/python3
+#
+# Instrumentation for tftp.tftp_transfer.
+#
+# tftp_transfer reports what it does to a hook: a packet received or sent, a
+# retransmission, a timeout, an RTT sample. A hook is any object with an
+# event(name, fields) method. Without a hook the transfer only tests for None
+# at each of these places, the event is never built.
+#
+# Events, with the fields each of them carries:
+#
+#   request     opcode, filename, options    RRQ or WRQ sent
+#   oack        block_size, window_size      options accepted by the server
+#   data_rx     blocknr, nbytes              DATA received in order
+#   data_tx     blocknr, nbytes              DATA sent for the first time
+#   ack_rx      blocknr                      ACK received
+#   ack_tx      blocknr                      ACK sent
+#   duplicate   blocknr, expected            DATA we already have, or too early
+#   rewind      blocknr                      ACK that does not cover the window
+#   retransmit  what, blocknr, count         anything sent again
+#   timeout     rto, waited                  nothing came within the RTO
+#   rtt         sample, srtt, rto            a round trip was measured
+#   error       code, message, sent          ERROR packet received or sent
+#   malformed   nbytes, opcode               packet dropped, opcode None if
+#                                            it could not be parsed at all
+#   done        the dict tftp_transfer returns, with the system calls made
+#
+# Metrics counts the events and keeps an RTT histogram, JsonLines writes one
+# JSON object per event and Console prints them the way tftp.py used to.
+import sys,time,json,math
+
+# RTT histogram buckets are powers of two, starting at 100 us
+RTT_HIST_MIN= 0.0001
+RTT_HIST_BUCKETS= 20
+
+
+class Hooks(object):
+    """Passes every event on to each of hooks"""
+
+    def __init__(self, hooks):
+        self.hooks = list(hooks)
+
+    def event(self, name, fields):
+        for hook in self.hooks:
+            hook.event(name, fields)
+
+
+def combine(*hooks):
+    """One hook for all of hooks that are not None, or None if there are none
+        so that the transfer runs without instrumentation"""
+    hooks = [h for h in hooks if h is not None]
+    if not hooks:
+        return None
+    if len(hooks) == 1:
+        return hooks[0]
+    return Hooks(hooks)
+
+
+def rtt_bucket(sample):
+    """Histogram bucket of an RTT sample. Bucket i holds samples below
+        RTT_HIST_MIN * 2**i, the last one everything above"""
+    if sample < RTT_HIST_MIN:
+        return 0
+    return min(int(math.log(sample / RTT_HIST_MIN, 2)) + 1, RTT_HIST_BUCKETS - 1)
+
+
+def rtt_bucket_limit(i):
+    """Upper limit of bucket i in seconds, None for the last one"""
+    if i >= RTT_HIST_BUCKETS - 1:
+        return None
+    return RTT_HIST_MIN * 2 ** i
+
+
+class Metrics(object):
+    """Counters for a transfer, or for several transfers one after another"""
+
+    COUNTERS = ['data_rx', 'data_tx', 'ack_rx', 'ack_tx', 'duplicate', 'rewind',
+                'retransmit', 'timeout', 'error', 'malformed']
+
+    def __init__(self):
+        self.counts = dict((name, 0) for name in self.COUNTERS)
+        self.bytes = 0
+        self.rtt_hist = [0] * RTT_HIST_BUCKETS
+        self.transfers = 0
+        self.transfer_time = 0.0
+        self.syscalls = 0
+
+    def event(self, name, fields):
+        if name in self.counts:
+            self.counts[name] += 1
+        if name == 'data_rx' or name == 'data_tx':
+            self.bytes += fields['nbytes']
+        elif name == 'rtt':
+            self.rtt_hist[rtt_bucket(fields['sample'])] += 1
+        elif name == 'done':
+            self.transfers += 1
+            self.transfer_time += fields['time']
+            self.syscalls += fields.get('syscalls', 0)
+
+    def bytes_per_second(self):
+        if self.transfer_time <= 0:
+            return 0.0
+        return self.bytes / self.transfer_time
+
+    def syscalls_per_mb(self):
+        if self.bytes <= 0:
+            return 0.0
+        return self.syscalls / (self.bytes / 1048576.0)
+
+    def summary(self):
+        """Counters as a dict, with blocks being the DATA packets that made
+            it through and the histogram as (upper limit, count) pairs"""
+        result = dict(self.counts)
+        result['blocks'] = self.counts['data_rx'] + self.counts['data_tx']
+        result['bytes'] = self.bytes
+        result['transfers'] = self.transfers
+        result['time'] = self.transfer_time
+        result['bytes_per_second'] = self.bytes_per_second()
+        result['syscalls'] = self.syscalls
+        result['syscalls_per_mb'] = self.syscalls_per_mb()
+        result['rtt_hist'] = [(rtt_bucket_limit(i), n) for (i, n) in enumerate(self.rtt_hist) if n]
+        return result
+
+    def report(self, out=sys.stdout):
+        s = self.summary()
+        out.write("Blocks: %d, bytes: %d, %.0f bytes/s\n" % (s['blocks'], s['bytes'], s['bytes_per_second']))
+        out.write("Retransmits: %d, duplicates: %d, rewinds: %d, timeouts: %d, malformed: %d\n"
+                  % (s['retransmit'], s['duplicate'], s['rewind'], s['timeout'], s['malformed']))
+        out.write("System calls: %d, %.0f per MB\n" % (s['syscalls'], s['syscalls_per_mb']))
+        for (limit, n) in s['rtt_hist']:
+            if limit is None:
+                out.write("RTT        more: %d\n" % n)
+            else:
+                out.write("RTT < %8.1f ms: %d\n" % (limit * 1000, n))
+
+
+class JsonLines(object):
+    """Writes each event to out as one line of JSON, with the time since the
+        hook was made in t"""
+
+    def __init__(self, out):
+        self.out = out
+        self.start = time.time()
+
+    def event(self, name, fields):
+        record = {'t': round(time.time() - self.start, 6), 'event': name}
+        record.update(fields)
+        self.out.write(json.dumps(record) + "\n")
+
+
+class Console(object):
+    """Prints events as text, the per packet log tftp.py used to print"""
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+
+    def event(self, name, fields):
+        if name == 'request':
+            line = "Sending %s for %s %s" % (fields['opcode'], fields['filename'], fields['options'] or "")
+        elif name == 'oack':
+            line = "Negotiated block size: %d, window size: %d" % (fields['block_size'], fields['window_size'])
+        elif name == 'data_rx':
+            line = "RECEIVED DATA BLOCKNR %d" % fields['blocknr']
+        elif name == 'data_tx':
+            line = "Sending %d bytes of data, block: %d" % (fields['nbytes'], fields['blocknr'])
+        elif name == 'ack_rx':
+            line = "RECEIVED ACK BLOCKNR: %d" % fields['blocknr']
+        elif name == 'ack_tx':
+            line = "Sending ACK for block: %d" % fields['blocknr']
+        elif name == 'duplicate':
+            line = "Duplicate! Got block %d, expected %d" % (fields['blocknr'], fields['expected'])
+        elif name == 'rewind':
+            line = "Wrong ACK number! Resend from block %d" % (fields['blocknr'] + 1)
+        elif name == 'retransmit':
+            line = "RE-Sending %s %s, resend count: %d" % (fields['what'], fields['blocknr'], fields['count'])
+        elif name == 'timeout':
+            line = "Timeout! Waited %.3f s" % fields['waited']
+        elif name == 'error':
+            line = "%s ERROR %d: %s" % (fields['sent'] and "Sending" or "RECEIVED", fields['code'], fields['message'])
+        elif name == 'malformed':
+            line = "Dropped malformed packet of %d bytes, opcode %s" % (fields['nbytes'], fields['opcode'])
+        else:
+            return
+        self.out.write(line + "\n")
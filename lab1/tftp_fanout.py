@@ -0,0 +1,223 @@
+#! /usr/bin/python3
+#
+# Push one file to many TFTP servers at once, spread over several processes.
+#
+#  bash$ ./tftp_fanout.py -j 4 -n 8 image.bin 10.0.0.1 10.0.0.2:6969 ...
+#
+# The file is mapped into memory once, before the worker processes are
+# forked, so every process reads its blocks from the same pages and the file
+# is never read or copied once per target. Each process runs up to
+# PER_PROCESS transfers in threads, sharing one tftp.TftpSession, which
+# takes the per packet work of the transfers off a single interpreter.
+#
+# Every target is a job of its own: a server that fails, or even a worker
+# process that dies, only fails the targets it was pushing to. While the
+# transfers run a status line shows how far each target has got, at the end
+# there is one line per target and the aggregate throughput.
+import sys,getopt,socket,threading,time,multiprocessing,queue
+import tftp,tftp_io
+
+PROCESSES= multiprocessing.cpu_count()
+PER_PROCESS= 8
+
+# Least time between two progress reports of a transfer, in seconds
+PROGRESS_INTERVAL= 0.5
+
+
+class Progress(object):
+    """Hook that reports the bytes sent to a target on queue, at most every
+        PROGRESS_INTERVAL seconds"""
+
+    def __init__(self, queue, index):
+        self.queue = queue
+        self.index = index
+        self.bytes = 0
+        self.last = 0.0
+
+    def event(self, name, fields):
+        if name != 'data_tx':
+            return
+        self.bytes += fields['nbytes']
+        now = time.time()
+        if now - self.last >= PROGRESS_INTERVAL:
+            self.last = now
+            self.queue.put(('progress', self.index, self.bytes))
+
+
+def push(fd, filemap, target, blksize, windowsize, session, hook):
+    """Send the file to one target and return its result dict. Errors are
+        reported in the result, never raised"""
+    (host, port) = target
+    result = {'host': host, 'port': port, 'completed': False, 'error': None}
+    start = time.time()
+    try:
+        stats = tftp.tftp_transfer(fd, host, tftp.TFTP_PUT, port, blksize, windowsize,
+                                   hook=hook, session=session, filemap=filemap)
+        result.update(stats)
+    except (IOError, socket.error) as e:
+        result['error'] = str(e)
+    result['time'] = time.time() - start
+    return result
+
+
+def worker(fd, filemap, jobs, per_process, blksize, windowsize, queue):
+    """Body of a worker process: push to every (index, target) in jobs, at
+        most per_process at a time, and put each result on queue"""
+    session = tftp.TftpSession()
+    pending = list(jobs)
+    lock = threading.Lock()
+
+    def run():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                (index, target) = pending.pop(0)
+            result = push(fd, filemap, target, blksize, windowsize, session, Progress(queue, index))
+            queue.put(('done', index, result))
+
+    threads = [threading.Thread(target=run) for i in range(min(per_process, len(jobs)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    session.close()
+
+
+def format_status(progress, size, done):
+    """One line with the percentage sent to each target, or done/FAILED"""
+    fields = []
+    for (index, nbytes) in enumerate(progress):
+        if index in done:
+            fields.append(done[index] and "done" or "FAILED")
+        elif size > 0:
+            fields.append("%3d%%" % (100 * nbytes / size))
+        else:
+            fields.append("  0%")
+    return " ".join(fields)
+
+
+def tftp_fanout(filename, targets, processes=PROCESSES, per_process=PER_PROCESS,
+                blksize=None, windowsize=tftp.WINDOW_SIZE, status=None):
+    """PUT filename to every (host, port) in targets and return a list with
+        one result dict per target, in the same order. Targets are dealt out
+        round robin over the processes. status, if given, is a file that
+        gets a progress line about once a second"""
+    fd = open(filename, "rb")
+    filemap = tftp_io.FileMap(fd)
+    # Worker processes are forked, so that they inherit filemap instead of
+    # each mapping the file again
+    context = multiprocessing.get_context("fork")
+    reports = context.Queue()
+    processes = max(1, min(processes, len(targets)))
+    groups = [[] for i in range(processes)]
+    for (index, target) in enumerate(targets):
+        groups[index % processes].append((index, target))
+
+    workers = []
+    for jobs in groups:
+        p = context.Process(target=worker,
+                            args=(fd, filemap, jobs, per_process, blksize, windowsize, reports))
+        p.daemon = True
+        p.start()
+        workers.append((p, jobs))
+
+    results = [None] * len(targets)
+    progress = [0] * len(targets)
+    done = {}
+    last_status = time.time()
+    last_line = None
+    while len(done) < len(targets):
+        try:
+            (kind, index, value) = reports.get(timeout=1.0)
+            if kind == 'progress':
+                progress[index] = value
+            else:
+                results[index] = value
+                done[index] = value['completed']
+        except queue.Empty:
+            pass
+        # A worker that died takes its unfinished targets with it. Its
+        # last results may still be in the queue, so only give up on them
+        # once the queue is empty
+        if reports.empty():
+            for (p, jobs) in workers:
+                if p.is_alive() or p.exitcode is None:
+                    continue
+                for (index, target) in jobs:
+                    if index not in done:
+                        results[index] = {'host': target[0], 'port': target[1], 'completed': False,
+                                          'error': "worker exited with code %d" % p.exitcode,
+                                          'time': 0.0}
+                        done[index] = False
+        if status is not None and time.time() - last_status >= 1.0:
+            last_status = time.time()
+            line = format_status(progress, filemap.size, done)
+            if line != last_line:
+                status.write(line + "\n")
+                last_line = line
+
+    for (p, jobs) in workers:
+        p.join()
+    filemap.close()
+    fd.close()
+    return results
+
+
+def usage():
+    """Print the usage on stderr and quit with error code"""
+    sys.stderr.write("Usage: %s [-j PROCESSES] [-n PER_PROCESS] [-P PORT] FILE HOST[:PORT] ...\n" % sys.argv[0])
+    sys.exit(1)
+
+
+def main():
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "j:n:P:")
+    except getopt.GetoptError:
+        usage()
+        return
+
+    processes = PROCESSES
+    per_process = PER_PROCESS
+    port = tftp.TFTP_PORT
+    for (opt, value) in opts:
+        if opt == "-j":
+            processes = int(value)
+        elif opt == "-n":
+            per_process = int(value)
+        elif opt == "-P":
+            port = int(value)
+
+    if len(args) < 2:
+        usage()
+        return
+    filename = args[0]
+    targets = [tftp.parse_address(arg, port) for arg in args[1:]]
+
+    start = time.time()
+    results = tftp_fanout(filename, targets, processes, per_process, status=sys.stderr)
+    total_time = time.time() - start
+
+    failed = 0
+    total_bytes = 0
+    for r in results:
+        if r['completed']:
+            status = "OK"
+            total_bytes += r['bytes']
+        else:
+            status = "FAILED"
+            failed += 1
+        line = "%-6s %s:%d %.3f s" % (status, r['host'], r['port'], r['time'])
+        if r['error']:
+            line += " (" + r['error'] + ")"
+        elif 'bytes' in r:
+            line += ", %d bytes, %d timeouts" % (r['bytes'], r['timeouts'])
+        print(line)
+    print("%d of %d targets completed in %.3f s, %.0f bytes/s in total" % (
+        len(results) - failed, len(results), total_time, total_bytes / max(total_time, 1e-9)))
+    if failed:
+        sys.exit(3)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,459 @@
+#! /usr/bin/python3
+#
+# File I/O backends for tftp.py and tftp_server.py.
+#
+# A block source hands out the blocks of the file being sent by block number,
+# so a window can be rewound to any earlier block without keeping copies
+# around. Regular files are memory mapped and every block is a zero-copy
+# slice of the mapping. Pipes and other inputs that cannot be mapped are read
+# front to back, keeping the blocks that have not been acknowledged yet.
+#
+# On the receiving side WriteBehind takes the blocks off the transfer loop:
+# they are gathered into large chunks which a background thread writes out,
+# so a slow disk does not delay the next ACK. The chunks can be hashed on the
+# way, which saves reading the file back to verify it against a manifest.
+#
+# A GET that fails leaves a checkpoint next to the file, so that the next
+# attempt only asks for what is missing. WriteBehind can also have one
+# written every so often while the transfer runs, so that a download that
+# is killed does not start over.
+import os,stat,mmap,errno,time,threading,collections,json
+
+# Most data received but not yet written, in bytes. A transfer that gets
+# this far ahead of the disk waits for it
+WRITE_BEHIND_MAX= 4 * 1024 * 1024
+
+# Blocks are gathered into chunks of this size before they are written
+WRITE_CHUNK= 256 * 1024
+
+# The checkpoint of file x is x + CHECKPOINT_SUFFIX
+CHECKPOINT_SUFFIX= ".tftp-resume"
+
+# Seconds between two fsyncs by WriteBehind for a checkpoint
+CHECKPOINT_INTERVAL= 1.0
+
+
+def close_map(m):
+    """Unmap m. A block somebody still holds keeps the mapping alive, it is
+        then unmapped once the last block is gone"""
+    try:
+        m.close()
+    except BufferError:
+        pass
+
+
+class MmapSource(object):
+    """Blocks of a memory mapped file, starting offset bytes into the file.
+        block() is O(1) for any block and makes neither a syscall nor a
+        copy. The file must not be truncated while it is mapped.
+
+        With shared_map, a mapping of fd made by someone else, no mapping
+        of our own is made and close() leaves shared_map alone"""
+
+    def __init__(self, fd, size, block_size, offset=0, shared_map=None):
+        self.block_size = block_size
+        self.size = size
+        self.offset = offset
+        self.owner = shared_map is None
+        self.map = shared_map
+        # mmap refuses empty files, there is nothing to map anyway
+        if self.owner and size > 0:
+            self.map = mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+        # Blocks are slices of one view. The map cannot be closed while any
+        # of them is alive, they must not be kept past release()
+        self.view = None
+        if self.map is not None:
+            self.view = memoryview(self.map)
+
+    def block(self, blocknr):
+        """Payload of block blocknr, counting from 1. A block shorter than
+            block_size, possibly empty, is the last one"""
+        offset = self.offset + (blocknr - 1) * self.block_size
+        if offset >= self.size:
+            return b''
+        return self.view[offset:min(offset + self.block_size, self.size)]
+
+    def release(self, blocknr):
+        pass
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.map is not None and self.owner:
+            close_map(self.map)
+        self.map = None
+
+
+class FileMap(object):
+    """A file mapped into memory once, for many transfers of the same file.
+        source() hands out block sources of any block size that all read
+        from the one mapping. A FileMap made before fork() is shared with
+        the child processes, the pages are in memory only once"""
+
+    def __init__(self, fd):
+        self.size = os.fstat(fd.fileno()).st_size
+        self.map = None
+        if self.size > 0:
+            self.map = mmap.mmap(fd.fileno(), self.size, access=mmap.ACCESS_READ)
+
+    def source(self, block_size, offset=0):
+        return MmapSource(None, self.size, block_size, offset, self.map)
+
+    def close(self):
+        if self.map is not None:
+            close_map(self.map)
+            self.map = None
+
+
+class StreamSource(object):
+    """Blocks of a file that can only be read front to back. Blocks are read
+        when first asked for and kept until release() says the receiver has
+        them, so at most a window of data is held in memory. With length,
+        the file ends length bytes after offset"""
+
+    def __init__(self, fd, block_size, offset=0, length=None):
+        self.fd = fd
+        self.block_size = block_size
+        self.blocks = {}
+        self.last_read = 0
+        self.eof = False
+        self.left = length
+        self.skip(offset)
+
+    def skip(self, nbytes):
+        try:
+            self.fd.seek(nbytes, os.SEEK_CUR)
+            return
+        except (AttributeError, IOError):
+            pass
+        while nbytes > 0:
+            data = self.fd.read(min(nbytes, WRITE_CHUNK))
+            if not data:
+                return
+            nbytes -= len(data)
+
+    def block(self, blocknr):
+        while self.last_read < blocknr and not self.eof:
+            if self.left is None:
+                data = self.fd.read(self.block_size)
+            else:
+                data = self.fd.read(min(self.block_size, self.left))
+                self.left -= len(data)
+            self.last_read += 1
+            self.blocks[self.last_read] = data
+            if len(data) < self.block_size:
+                self.eof = True
+        return self.blocks.get(blocknr, b'')
+
+    def release(self, blocknr):
+        """Forget all blocks up to and including blocknr"""
+        for n in [n for n in self.blocks if n <= blocknr]:
+            del self.blocks[n]
+
+    def close(self):
+        self.blocks = {}
+
+
+def open_source(fd, block_size, offset=0, length=None):
+    """Pick the block source for fd: a memory map of regular files, plain
+        reads for everything else. Block 1 starts offset bytes into fd, and
+        with length the last block ends length bytes after that"""
+    try:
+        st = os.fstat(fd.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        # Not backed by a file descriptor at all, like a StringIO
+        return StreamSource(fd, block_size, offset, length)
+    if not stat.S_ISREG(st.st_mode):
+        return StreamSource(fd, block_size, offset, length)
+    # Only the first offset + length bytes are mapped, the block past them
+    # comes out short or empty like at the end of the file
+    size = st.st_size
+    if length is not None:
+        size = min(size, offset + length)
+    try:
+        return MmapSource(fd, size, block_size, offset)
+    except (mmap.error, ValueError):
+        return StreamSource(fd, block_size, offset, length)
+
+
+class WriteError(IOError):
+    """A write by WriteBehind failed. Kept apart from IOError so that callers
+        can tell it from socket errors"""
+
+
+class PositionalFile(object):
+    """Writes to fileno, a file descriptor, from offset on with os.pwrite.
+        Several of them can share one descriptor, each keeps a position of
+        its own. Has the parts of a file object tftp_transfer uses, name is
+        the name asked for"""
+
+    def __init__(self, fileno, name, offset=0):
+        self.fd = fileno
+        self.name = name
+        self.offset = offset
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            n = os.pwrite(self.fd, view, self.offset)
+            self.offset += n
+            view = view[n:]
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+
+class WriteBehind(object):
+    """Buffers writes to fd. Data is copied into a chunk and every full chunk
+        is written as one large write, by a background thread if threaded is
+        set and right away otherwise. At most max_buffered bytes are held in
+        memory, write() waits for the thread beyond that. If digest, a
+        hashlib object, is given every chunk is added to it before it is
+        written.
+
+        If checkpoint is given the file is synced every CHECKPOINT_INTERVAL
+        seconds, after a chunk is written, and checkpoint(nbytes, hexdigest)
+        is called with the bytes on disk so far and the hexdigest of them.
+        It is called from the thread that writes.
+
+        A failed write is raised as WriteError from the next write() or
+        close(), after that the writer is dead"""
+
+    def __init__(self, fd, max_buffered=WRITE_BEHIND_MAX, chunk_size=WRITE_CHUNK, threaded=True,
+                 digest=None, checkpoint=None):
+        self.fd = fd
+        self.digest = digest
+        self.checkpoint = checkpoint
+        self.checkpoint_at = time.time()
+        # Bytes written to fd so far
+        self.written = 0
+        self.max_buffered = max_buffered
+        self.chunk_size = min(chunk_size, max_buffered)
+        self.chunk = bytearray()
+        self.queue = collections.deque()
+        self.queued = 0
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = None
+        if threaded:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, data):
+        """Queue data for writing. data is copied, it may be a view into a
+            buffer that is about to be reused"""
+        if self.error is not None:
+            raise self.error
+        self.chunk += data
+        if len(self.chunk) >= self.chunk_size:
+            self.flush_chunk()
+
+    def flush_chunk(self):
+        (chunk, self.chunk) = (self.chunk, bytearray())
+        if not chunk:
+            return
+        if self.thread is None:
+            try:
+                self.store(chunk)
+            except (IOError, OSError) as e:
+                self.error = WriteError(e.errno, e.strerror)
+                raise self.error
+            return
+        with self.cond:
+            while self.queue and self.queued + len(chunk) > self.max_buffered and self.error is None:
+                self.cond.wait()
+            if self.error is not None:
+                raise self.error
+            self.queue.append(chunk)
+            self.queued += len(chunk)
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                chunk = self.queue[0]
+            # hashlib lets go of the GIL for large updates, the transfer
+            # loop keeps running while we hash
+            try:
+                self.store(chunk)
+            except (IOError, OSError) as e:
+                with self.cond:
+                    self.error = WriteError(e.errno, e.strerror)
+                    self.queue.clear()
+                    self.queued = 0
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                # abort() may have thrown the queue away meanwhile
+                if self.queue and self.queue[0] is chunk:
+                    self.queue.popleft()
+                    self.queued -= len(chunk)
+                self.cond.notify_all()
+
+    def store(self, chunk):
+        """Hash and write chunk, and checkpoint if it is time to"""
+        if self.digest is not None:
+            self.digest.update(chunk)
+        self.fd.write(chunk)
+        self.written += len(chunk)
+        if self.checkpoint is not None and time.time() - self.checkpoint_at >= CHECKPOINT_INTERVAL:
+            self.sync()
+            self.checkpoint(self.written, self.digest and self.digest.hexdigest())
+            self.checkpoint_at = time.time()
+
+    def sync(self):
+        self.fd.flush()
+        try:
+            os.fsync(self.fd.fileno())
+        except (AttributeError, ValueError):
+            # Not backed by a file descriptor
+            pass
+        except OSError as e:
+            # Pipes and terminals cannot be synced, there is nothing to wait for
+            if e.errno != errno.EINVAL:
+                raise
+
+    def stop(self):
+        if self.thread is not None:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+            self.thread.join()
+            self.thread = None
+
+    def close(self, sync=True):
+        """Write out everything that is buffered and, if sync is set, fsync
+            the file. Raises IOError if any write failed"""
+        try:
+            self.flush_chunk()
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+        if sync:
+            self.sync()
+        else:
+            self.fd.flush()
+
+    def abort(self):
+        """Stop without writing what is still buffered"""
+        with self.cond:
+            self.queue.clear()
+            self.queued = 0
+        self.chunk = bytearray()
+        self.stop()
+
+
+def load_manifest(filename):
+    """Read a checksum manifest. Every line has an MD5 digest, optionally the
+        size in bytes, and a file name:
+
+            667ff61c0d573502e482efa85b468f1f 1931 small.txt
+
+        so the output of md5sum is a manifest as well. Empty lines and lines
+        starting with # are skipped. Returns a dict from file name to
+        (digest, size), size is None where the line has none"""
+    manifest = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split(None, 2)
+            if len(fields) == 3 and fields[1].isdigit():
+                (digest, size, name) = (fields[0], int(fields[1]), fields[2])
+            else:
+                (digest, name) = line.split(None, 1)
+                size = None
+            # md5sum marks files read in binary mode with a *
+            if name.startswith("*"):
+                name = name[1:]
+            manifest[name] = (digest.lower(), size)
+    return manifest
+
+
+def check_manifest(manifest, name, digest, size):
+    """True if digest and size match what manifest says about name, False if
+        they do not, None if name is not in manifest"""
+    entry = manifest.get(os.path.basename(name))
+    if entry is None:
+        return None
+    (expected_digest, expected_size) = entry
+    return digest == expected_digest and (expected_size is None or size == expected_size)
+
+
+def checkpoint_path(filename):
+    return filename + CHECKPOINT_SUFFIX
+
+
+def save_checkpoint(filename, state):
+    """Write the checkpoint of filename. state is a dict with at least bytes,
+        the length of the part of the file that is on disk, and digest, the
+        hexdigest of that part. The old checkpoint is replaced in one rename,
+        a crash leaves either the old or the new one"""
+    path = checkpoint_path(filename)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.rename(path + ".tmp", path)
+
+
+def load_checkpoint(filename):
+    """The checkpoint of filename as a dict, None if there is none or it
+        cannot be read"""
+    try:
+        with open(checkpoint_path(filename)) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(state, dict) or not isinstance(state.get('bytes'), int):
+        return None
+    return state
+
+
+def remove_checkpoint(filename):
+    try:
+        os.remove(checkpoint_path(filename))
+    except OSError:
+        pass
+
+
+def resume_point(filename, digest):
+    """Where to resume the download of filename: returns (offset, digest)
+        with digest, a copy of the given hashlib object, fed the first offset
+        bytes of the file. hashlib objects cannot be saved, so the part we
+        have is read once more and must hash to what the checkpoint says.
+        Without a checkpoint, or if the file does not match it, the answer
+        is (0, digest)"""
+    state = load_checkpoint(filename)
+    if state is None or state.get('digest_name', digest.name).lower() != digest.name.lower():
+        return 0, digest
+    offset = state['bytes']
+    resumed = digest.copy()
+    try:
+        with open(filename, "rb") as f:
+            left = offset
+            while left > 0:
+                data = f.read(min(left, WRITE_CHUNK))
+                if not data:
+                    return 0, digest
+                resumed.update(data)
+                left -= len(data)
+    except IOError:
+        return 0, digest
+    if resumed.hexdigest() != state.get('digest'):
+        return 0, digest
+    return offset, resumed
@@ -0,0 +1,140 @@
+#! /usr/bin/python3
+#
+# Event loop for running many transfers from one thread, used by
+# tftp_server.py and by tftp.LoopTransfer.
+#
+# Sockets are watched with a selectors.DefaultSelector, epoll on Linux,
+# which is set up once instead of building fd sets for every wait. The
+# retransmission deadlines live in a timer wheel: a ring of slots, one per
+# tick, where a timer sits in the slot of the tick it expires in. Arming,
+# moving and cancelling a timer are O(1) whatever the number of timers, and
+# every transfer moves its timer with each window. Timers further away than
+# one turn of the wheel wait in their slot until their turn comes. A timer
+# fires up to one tick after its deadline, never before.
+import time,math,selectors
+
+# Seconds per slot of the timer wheel, and slots in the wheel
+TICK= 0.005
+WHEEL_SLOTS= 1024
+
+
+class Timer(object):
+    """Calls callback once its deadline has passed. Made once per transfer
+        and armed again and again, see EventLoop.arm"""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.deadline = None
+        # Tick the timer expires in, None while it is not armed
+        self.tick = None
+
+    def armed(self):
+        return self.tick is not None
+
+
+class TimerWheel(object):
+
+    def __init__(self, tick=TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [set() for i in range(slots)]
+        # Last tick whose timers have fired
+        self.current = int(time.time() / tick)
+        self.count = 0
+
+    def arm(self, timer, deadline):
+        """Have timer fire at deadline, a time.time() value. A timer that is
+            armed already is moved"""
+        if timer.tick is not None:
+            self.slots[timer.tick % len(self.slots)].discard(timer)
+            self.count -= 1
+        tick = max(int(math.ceil(deadline / self.tick)), self.current + 1)
+        timer.deadline = deadline
+        timer.tick = tick
+        self.slots[tick % len(self.slots)].add(timer)
+        self.count += 1
+
+    def cancel(self, timer):
+        if timer.tick is not None:
+            self.slots[timer.tick % len(self.slots)].discard(timer)
+            self.count -= 1
+            timer.tick = None
+
+    def next_timeout(self, now):
+        """Seconds until the next slot with timers in it comes up, None if no
+            timer is armed"""
+        if not self.count:
+            return None
+        for i in range(1, len(self.slots) + 1):
+            if self.slots[(self.current + i) % len(self.slots)]:
+                return max(0.0, (self.current + i) * self.tick - now)
+        return None
+
+    def expire(self, now):
+        """Fire every timer whose tick has come by now"""
+        target = int(now / self.tick)
+        if target - self.current >= len(self.slots):
+            # Slept through a whole turn, every slot is due once
+            self.fire([slot for slot in self.slots if slot], target)
+            self.current = target
+        while self.current < target and self.count:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            if slot:
+                self.fire([slot], self.current)
+        self.current = max(self.current, target)
+
+    def fire(self, slots, tick):
+        due = [timer for slot in slots for timer in slot if timer.tick <= tick]
+        for timer in due:
+            self.slots[timer.tick % len(self.slots)].discard(timer)
+            self.count -= 1
+            timer.tick = None
+        for timer in due:
+            # An earlier callback may have armed this timer again
+            if timer.tick is None:
+                timer.callback()
+
+
+class EventLoop(object):
+    """Calls back when a socket is readable or a timer expires"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = TimerWheel()
+
+    def register(self, sock, callback):
+        """Call callback(sock) whenever sock is readable"""
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+    def unregister(self, sock):
+        self.selector.unregister(sock)
+
+    def timer(self, callback):
+        return Timer(callback)
+
+    def arm(self, timer, deadline):
+        self.timers.arm(timer, deadline)
+
+    def cancel(self, timer):
+        self.timers.cancel(timer)
+
+    def idle(self):
+        """True when there is nothing left to wait for"""
+        return not self.selector.get_map() and not self.timers.count
+
+    def run_once(self, max_wait=None):
+        """Wait for sockets or the next timer and handle what is due"""
+        timeout = self.timers.next_timeout(time.time())
+        if max_wait is not None and (timeout is None or timeout > max_wait):
+            timeout = max_wait
+        for (key, events) in self.selector.select(timeout):
+            key.data(key.fileobj)
+        self.timers.expire(time.time())
+
+    def run(self, done=None):
+        """Run until done(), if given, is true or nothing is left to wait for"""
+        while not self.idle() and (done is None or not done()):
+            self.run_once()
+
+    def close(self):
+        self.selector.close()
@@ -0,0 +1,251 @@
+#! /usr/bin/python3
+#
+# Download one file from several TFTP servers that all have a copy of it.
+#
+#  bash$ ./tftp_mirrors.py -s 4194304 image.bin 10.0.0.1 10.0.0.2:6969 ...
+#
+# The file is cut into pieces of PIECE_SIZE bytes and every mirror fetches
+# pieces with a ranged RRQ, using the non-standard offset and length options
+# of tftp_server.py. A mirror takes the next piece as soon as it is done
+# with one, so a fast mirror ends up fetching more of the file than a slow
+# one. A piece that fails goes back to the others, and a mirror that keeps
+# failing is dropped.
+#
+# The output is sized up front and opened once. Every piece is written at
+# its own offset with os.pwrite, which leaves the position of the shared
+# descriptor alone, so the pieces can land in any order.
+# Once all are in, the file is checked against the manifest.
+import sys,os,getopt,socket,threading,time,hashlib,collections
+import tftp,tftp_io
+
+PIECE_SIZE= 4 * 1024 * 1024
+PER_MIRROR= 1
+
+# A mirror that fails this many pieces in a row is given up on
+MAX_FAILURES= 3
+
+# Attempts to learn the file size from the first mirror that answers
+PROBE_RETRIES= 3
+
+
+def probe_size(filename, host, port, session):
+    """Size of filename on the server, from the tsize option (RFC 2349), or
+        None if the server does not tell. The transfer the RRQ starts is
+        cancelled right after the OACK, so the socket is closed rather than
+        given back to the session: the server resends its OACK to that port
+        if our ERROR is lost"""
+    (family, socktype, proto, canonname, sockaddr) = session.resolve(host, port)
+    s = session.socket(family, socktype, proto)
+    try:
+        for attempt in range(PROBE_RETRIES):
+            s.sendto(tftp.make_request(tftp.TFTP_GET, filename, {'tsize': 0}), sockaddr)
+            deadline = time.time() + tftp.TFTP_TIMEOUT
+            while time.time() < deadline:
+                s.settimeout(max(deadline - time.time(), 0.001))
+                try:
+                    (data, sender) = s.recvfrom(tftp.BLKSIZE_MAX + 4)
+                except socket.timeout:
+                    break
+                pkt = tftp.parse_packet(data)
+                if sender[0] != sockaddr[0] or not tftp.first_response(pkt, tftp.TFTP_GET):
+                    continue
+                if pkt[0] == tftp.OPCODE_ERR:
+                    return None
+                s.sendto(tftp.make_packet_err(0, "Only asked for the size"), sender)
+                if pkt[0] == tftp.OPCODE_OACK and pkt[1].get('tsize', '').isdigit():
+                    return int(pkt[1]['tsize'])
+                return None
+        return None
+    finally:
+        s.close()
+
+
+class Pieces(object):
+    """The pieces still to fetch, handed out to the mirror threads. A piece
+        that failed is put back in front so that it is retried first"""
+
+    def __init__(self, size, piece_size):
+        self.pending = collections.deque((offset, min(piece_size, size - offset))
+                                         for offset in range(0, size, piece_size))
+        self.running = 0
+        self.cond = threading.Condition()
+
+    def next_piece(self):
+        """Block until there is a piece to fetch. Returns (offset, length), or
+            None when every piece is done"""
+        with self.cond:
+            while not self.pending and self.running:
+                self.cond.wait()
+            if not self.pending:
+                return None
+            self.running += 1
+            return self.pending.popleft()
+
+    def piece_done(self, piece, ok):
+        with self.cond:
+            self.running -= 1
+            if not ok:
+                self.pending.appendleft(piece)
+            self.cond.notify_all()
+
+    def left(self):
+        with self.cond:
+            return len(self.pending) + self.running
+
+
+def fetch_piece(out, filename, mirror, piece, blksize, windowsize, session):
+    """Fetch one piece of filename into out, a file descriptor of the output.
+        True if all of it arrived"""
+    (offset, length) = piece
+    (host, port) = mirror
+    fd = tftp_io.PositionalFile(out, filename, offset)
+    stats = tftp.tftp_transfer(fd, host, tftp.TFTP_GET, port, blksize, windowsize,
+                               offset=offset, length=length, session=session)
+    return stats['completed'] and stats['bytes'] == length
+
+
+def tftp_mirrors(filename, mirrors, size=None, piece_size=PIECE_SIZE, per_mirror=PER_MIRROR,
+                 blksize=None, windowsize=tftp.WINDOW_SIZE):
+    """GET filename from all of mirrors, a list of (host, port), into a file
+        of the same name. size is asked from the mirrors if not given.
+        Returns a dict with completed, size and per mirror statistics"""
+    session = tftp.TftpSession()
+    start = time.time()
+    for (host, port) in mirrors:
+        if size is not None:
+            break
+        try:
+            size = probe_size(filename, host, port, session)
+        except socket.error:
+            pass
+    result = {'completed': False, 'size': size, 'mirrors': []}
+    if size is None:
+        session.close()
+        result['error'] = "no mirror told the size of " + filename
+        return result
+
+    # Size the output before any piece is written, so that every piece has
+    # its place in the file whatever the order they come in
+    out = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    os.ftruncate(out, size)
+    pieces = Pieces(size, piece_size)
+
+    def run(mirror, counters):
+        failures = 0
+        while failures < MAX_FAILURES:
+            piece = pieces.next_piece()
+            if piece is None:
+                return
+            piece_start = time.time()
+            try:
+                ok = fetch_piece(out, filename, mirror, piece, blksize, windowsize, session)
+            except (IOError, socket.error):
+                ok = False
+            pieces.piece_done(piece, ok)
+            if ok:
+                failures = 0
+                counters['pieces'] += 1
+                counters['bytes'] += piece[1]
+                counters['time'] += time.time() - piece_start
+            else:
+                failures += 1
+                counters['failures'] += 1
+
+    threads = []
+    for (host, port) in mirrors:
+        counters = {'host': host, 'port': port, 'pieces': 0, 'bytes': 0, 'time': 0.0, 'failures': 0}
+        result['mirrors'].append(counters)
+        for i in range(per_mirror):
+            t = threading.Thread(target=run, args=((host, port), counters))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+    for t in threads:
+        t.join()
+    session.close()
+    os.close(out)
+
+    result['completed'] = pieces.left() == 0
+    result['time'] = time.time() - start
+    if not result['completed']:
+        result['error'] = "every mirror failed, %d pieces missing" % pieces.left()
+    return result
+
+
+def file_digest(filename):
+    """MD5 of filename. The pieces arrive out of order, so unlike a single
+        GET the digest cannot be taken on the way in"""
+    digest = hashlib.md5()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(tftp_io.WRITE_CHUNK)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def usage():
+    """Print the usage on stderr and quit with error code"""
+    sys.stderr.write("Usage: %s [-s PIECE_SIZE] [-n PER_MIRROR] [-P PORT] [-m MANIFEST] FILE HOST[:PORT] ...\n"
+                     % sys.argv[0])
+    sys.exit(1)
+
+
+def main():
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "s:n:P:m:")
+    except getopt.GetoptError:
+        usage()
+        return
+
+    piece_size = PIECE_SIZE
+    per_mirror = PER_MIRROR
+    port = tftp.TFTP_PORT
+    manifest_file = tftp.MANIFEST
+    for (opt, value) in opts:
+        if opt == "-s":
+            piece_size = int(value)
+        elif opt == "-n":
+            per_mirror = int(value)
+        elif opt == "-P":
+            port = int(value)
+        elif opt == "-m":
+            manifest_file = value
+
+    if len(args) < 2 or piece_size <= 0:
+        usage()
+        return
+    filename = args[0]
+    mirrors = [tftp.parse_address(arg, port) for arg in args[1:]]
+
+    try:
+        manifest = tftp_io.load_manifest(manifest_file)
+    except IOError as e:
+        sys.stderr.write("Manifest error (%s): %s\n" % (manifest_file, e.strerror))
+        sys.exit(2)
+    # The manifest knows the size as well, the mirrors need not be asked
+    size = manifest.get(os.path.basename(filename), (None, None))[1]
+
+    result = tftp_mirrors(filename, mirrors, size, piece_size, per_mirror)
+    for m in result['mirrors']:
+        rate = m['time'] > 0 and m['bytes'] / m['time'] or 0.0
+        print("%s:%d %d pieces, %d bytes, %.0f bytes/s, %d failures" % (
+            m['host'], m['port'], m['pieces'], m['bytes'], rate, m['failures']))
+    if not result['completed']:
+        print("FAILED", result['error'])
+        sys.exit(3)
+    print("%d bytes in %.3f s, %.0f bytes/s" % (result['size'], result['time'],
+                                                result['size'] / max(result['time'], 1e-9)))
+
+    ok = tftp_io.check_manifest(manifest, filename, file_digest(filename), result['size'])
+    if ok is None:
+        print("%s is not in %s" % (filename, manifest_file))
+    elif ok:
+        print("%s matches %s" % (filename, manifest_file))
+    else:
+        print("%s does NOT match %s" % (filename, manifest_file))
+        sys.exit(3)
+
+if __name__ == "__main__":
+    main()
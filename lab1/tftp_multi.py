@@ -0,0 +1,257 @@
+#! /usr/bin/python3
+#
+# Run many TFTP transfers at the same time, for instance to push one image to
+# a whole rack of devices. Every transfer runs on its own UDP socket, so each
+# one has its own TID towards the server, and all of them are driven from one
+# thread by a tftp_loop.EventLoop, see tftp.LoopTransfer. Thousands of
+# transfers at a time take no more than a socket and a timer each: GETs
+# write every window as it comes in, without the write-behind thread and
+# buffer a single tftp_transfer uses.
+#
+# At most max_concurrent transfers are running at any time and at most
+# max_per_host of them talk to the same server, so that a long list of jobs
+# for one slow host cannot starve the others.
+#
+#  bash$ ./tftp_multi.py -p -n 64 -m 2 image.bin@10.0.0.1 image.bin@10.0.0.2 ...
+#
+# tftp_transfer_many_async does the same for asyncio code, every transfer a
+# tftp.tftp_transfer_async on the running loop, so the transfers can run next
+# to whatever else the program does. -a runs the command line jobs that way.
+#
+# The transfers run without a hook and print next to nothing while they are
+# running. The summary at the end lists one line per job.
+import sys,getopt,socket,time,asyncio
+import tftp,tftp_loop
+
+MAX_CONCURRENT= 32
+MAX_PER_HOST= 4
+
+
+def make_job(filename, direction, hostname, port=tftp.TFTP_PORT):
+    return {'filename': filename,
+            'direction': direction,
+            'host': hostname,
+            'port': port}
+
+
+def start_job(loop, job, blksize, windowsize, session, done):
+    """Start a single transfer on loop. done(result) is called with its
+        result dict once it is over. A transfer that fails never takes the
+        others down, the error is reported in the result"""
+    result = dict(job)
+    result['completed'] = False
+    result['error'] = None
+    start = time.time()
+
+    def finish(stats, error):
+        fd.close()
+        if stats is not None:
+            result.update(stats)
+        else:
+            result['error'] = str(error)
+        result['time'] = time.time() - start
+        done(result)
+
+    try:
+        if job['direction'] == tftp.TFTP_GET:
+            fd = open(job['filename'], "wb")
+        else:
+            fd = open(job['filename'], "rb")
+    except IOError as e:
+        result['error'] = str(e)
+        result['time'] = time.time() - start
+        done(result)
+        return
+    steps = tftp.transfer_steps(fd, job['host'], job['direction'], job['port'],
+                                blksize, windowsize, write_buffer=0, session=session)
+    tftp.LoopTransfer(loop, steps, finish)
+
+
+class Scheduler(object):
+    """Hands out jobs in order, skipping jobs for hosts that already have
+        max_per_host transfers running"""
+
+    def __init__(self, jobs, max_per_host):
+        self.pending = list(enumerate(jobs))
+        self.max_per_host = max_per_host
+        self.running = {}
+
+    def next_job(self):
+        """(index, job) of the first job that can be started now, or None"""
+        for i in range(len(self.pending)):
+            (index, job) = self.pending[i]
+            if self.running.get(job['host'], 0) < self.max_per_host:
+                del self.pending[i]
+                self.running[job['host']] = self.running.get(job['host'], 0) + 1
+                return index, job
+        return None
+
+    def job_done(self, job):
+        self.running[job['host']] -= 1
+
+
+def tftp_transfer_many(jobs, max_concurrent=MAX_CONCURRENT, max_per_host=MAX_PER_HOST,
+                       blksize=None, windowsize=tftp.WINDOW_SIZE, on_result=None):
+    """Run all jobs (see make_job) and return a list with one result dict per
+        job, in the same order. on_result, if given, is called with
+        (index, result) as soon as each transfer finishes. All transfers
+        share one tftp.TftpSession, every host is looked up once"""
+    scheduler = Scheduler(jobs, max_per_host)
+    results = [None] * len(jobs)
+    session = tftp.TftpSession()
+    loop = tftp_loop.EventLoop()
+    state = {'running': 0, 'filling': False}
+
+    def fill():
+        # A job that fails right away is done before start_job returns, the
+        # loop below then starts the next one instead of recursing
+        if state['filling']:
+            return
+        state['filling'] = True
+        try:
+            while state['running'] < max_concurrent:
+                item = scheduler.next_job()
+                if item is None:
+                    return
+                (index, job) = item
+                state['running'] += 1
+                start_job(loop, job, blksize, windowsize, session,
+                          lambda result, index=index, job=job: job_done(index, job, result))
+        finally:
+            state['filling'] = False
+
+    def job_done(index, job, result):
+        results[index] = result
+        state['running'] -= 1
+        scheduler.job_done(job)
+        if on_result is not None:
+            on_result(index, result)
+        fill()
+
+    fill()
+    loop.run()
+    loop.close()
+    session.close()
+    return results
+
+
+async def run_job_async(job, blksize, windowsize, session):
+    """Like start_job, for asyncio. Returns the result dict"""
+    result = dict(job)
+    result['completed'] = False
+    result['error'] = None
+    start = time.time()
+    try:
+        if job['direction'] == tftp.TFTP_GET:
+            fd = open(job['filename'], "wb")
+        else:
+            fd = open(job['filename'], "rb")
+    except IOError as e:
+        result['error'] = str(e)
+        result['time'] = time.time() - start
+        return result
+    try:
+        result.update(await tftp.tftp_transfer_async(fd, job['host'], job['direction'], job['port'],
+                                                     blksize, windowsize, write_buffer=0,
+                                                     session=session))
+    except (IOError, socket.error) as e:
+        result['error'] = str(e)
+    finally:
+        fd.close()
+    result['time'] = time.time() - start
+    return result
+
+
+async def tftp_transfer_many_async(jobs, max_concurrent=MAX_CONCURRENT, max_per_host=MAX_PER_HOST,
+                                   blksize=None, windowsize=tftp.WINDOW_SIZE, on_result=None):
+    """tftp_transfer_many for asyncio code, with the same arguments and
+        result. A job waits for a slot of its host before it takes one of
+        the max_concurrent, so jobs for a busy host do not hold up the rest"""
+    session = tftp.TftpSession()
+    running = asyncio.Semaphore(max_concurrent)
+    hosts = {}
+
+    async def run(index, job):
+        host = hosts.setdefault(job['host'], asyncio.Semaphore(max_per_host))
+        async with host:
+            async with running:
+                result = await run_job_async(job, blksize, windowsize, session)
+        if on_result is not None:
+            on_result(index, result)
+        return result
+
+    try:
+        return await asyncio.gather(*[run(index, job) for (index, job) in enumerate(jobs)])
+    finally:
+        session.close()
+
+
+def usage():
+    """Print the usage on stderr and quit with error code"""
+    sys.stderr.write("Usage: %s [-g|-p] [-a] [-n MAX] [-m MAX_PER_HOST] [-P PORT] FILE@HOST ...\n" % sys.argv[0])
+    sys.exit(1)
+
+
+def main():
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "gpan:m:P:")
+    except getopt.GetoptError:
+        usage()
+        return
+
+    direction = tftp.TFTP_GET
+    max_concurrent = MAX_CONCURRENT
+    max_per_host = MAX_PER_HOST
+    port = tftp.TFTP_PORT
+    use_asyncio = False
+    for (opt, value) in opts:
+        if opt == "-g":
+            direction = tftp.TFTP_GET
+        elif opt == "-p":
+            direction = tftp.TFTP_PUT
+        elif opt == "-a":
+            use_asyncio = True
+        elif opt == "-n":
+            max_concurrent = int(value)
+        elif opt == "-m":
+            max_per_host = int(value)
+        elif opt == "-P":
+            port = int(value)
+
+    jobs = []
+    for arg in args:
+        (filename, sep, hostname) = arg.rpartition("@")
+        if not sep or not filename or not hostname:
+            usage()
+            return
+        jobs.append(make_job(filename, direction, hostname, port))
+    if not jobs:
+        usage()
+        return
+
+    start = time.time()
+    if use_asyncio:
+        results = asyncio.run(tftp_transfer_many_async(jobs, max_concurrent, max_per_host))
+    else:
+        results = tftp_transfer_many(jobs, max_concurrent, max_per_host)
+    total_time = time.time() - start
+
+    failed = 0
+    for r in results:
+        if r['completed']:
+            status = "OK"
+        else:
+            status = "FAILED"
+            failed += 1
+        line = "%-6s %s@%s %.3f s" % (status, r['filename'], r['host'], r['time'])
+        if r['error']:
+            line += " (" + r['error'] + ")"
+        elif 'bytes' in r:
+            line += ", %d bytes, %d timeouts" % (r['bytes'], r['timeouts'])
+        print(line)
+    print("%d of %d transfers completed in %.3f s" % (len(results) - failed, len(results), total_time))
+    if failed:
+        sys.exit(3)
+
+if __name__ == "__main__":
+    main()
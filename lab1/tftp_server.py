@@ -0,0 +1,576 @@
+#! /usr/bin/python3
+#
+# TFTP server. Serves RRQ and WRQ from a root directory and runs every
+# transfer from one event loop: each transfer has its own UDP socket (its
+# TID) registered with a tftp_loop.EventLoop, and retransmissions are driven
+# by its timer wheel. There is no thread per client, so thousands of
+# transfers can be running at the same time.
+#
+# Supports the blksize (RFC 2348), windowsize (RFC 7440) and tsize (RFC 2349)
+# options, rollover to pick whether block numbers roll over to 0 or 1 after
+# 65535, and offset and length, non-standard options for resuming a RRQ part
+# way through the file or asking for just a range of it. The packets are built and parsed with the functions in
+# tftp.py.
+#
+#  bash$ ./tftp_server.py -p 6969 -w /srv/tftp
+import sys,os,socket,errno,time,getopt,tempfile
+import tftp,tftp_io,tftp_loop
+
+# Largest options we agree to. Clients asking for more get these
+MAX_BLKSIZE= tftp.BLKSIZE_MAX
+MAX_WINDOWSIZE= 64
+
+# Timeouts in a row before we give up on a client
+MAX_RETRIES= 5
+
+# After the last block of a WRQ has been acknowledged, wait this many backed
+# off timeouts for the client to resend it, in case our ACK was lost
+DALLY_RETRIES= 3
+
+# Read at most this many datagrams from one socket per loop iteration, so one
+# busy client cannot starve the others
+MAX_BURST= 64
+
+
+class Transfer(object):
+    """State shared by both directions of a transfer: the socket, the peer
+        and the retransmission timer"""
+
+    def __init__(self, server, sock, peer, fd, path, block_size, window_size, oack, offset=0,
+                 rollover=0, length=None):
+        self.server = server
+        self.sock = sock
+        self.peer = peer
+        self.fd = fd
+        self.path = path
+        self.block_size = block_size
+        self.window_size = window_size
+        self.oack = oack
+        self.offset = offset
+        self.length = length
+        self.rollover = rollover
+        self.rtt = tftp.RttEstimator()
+        self.timed_blocknr = None
+        self.timed_at = None
+        self.timer = server.loop.timer(self.on_timeout)
+        self.retries = 0
+        self.done = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, packet):
+        try:
+            self.sock.sendto(packet, self.peer)
+        except socket.error:
+            # Nothing we can do about it here, the timer will resend
+            pass
+
+    def arm(self):
+        self.server.loop.arm(self.timer, time.time() + self.rtt.rto)
+
+    def on_readable(self, sock):
+        self.server.drain(sock, self.on_datagram)
+
+    def time_packet(self, blocknr):
+        self.timed_blocknr = blocknr
+        self.timed_at = time.time()
+
+    def check_timed(self, blocknr):
+        if self.timed_blocknr == blocknr:
+            self.rtt.sample(time.time() - self.timed_at)
+            self.timed_blocknr = None
+
+    def on_datagram(self, view, nbytes, addr):
+        # Packets from anyone else than our client get an error, the transfer
+        # goes on (RFC 1350 section 4)
+        if addr != self.peer:
+            self.server.send_error(self.sock, addr, 5)
+            return
+        pkt = tftp.parse_packet_view(view, nbytes)
+        if pkt is None:
+            self.fail(4)
+        elif pkt[0] == tftp.OPCODE_ERR:
+            self.finish(False)
+        else:
+            self.handle(pkt)
+
+    def on_timeout(self):
+        self.retries += 1
+        if self.retries > MAX_RETRIES:
+            self.finish(False)
+            return
+        self.rtt.backoff()
+        self.timed_blocknr = None
+        self.retransmit()
+        self.arm()
+
+    def fail(self, errcode):
+        self.server.send_error(self.sock, self.peer, errcode)
+        self.finish(False)
+
+    def finish(self, ok):
+        if self.done:
+            return
+        self.done = True
+        self.server.loop.cancel(self.timer)
+        self.fd.close()
+        self.server.transfer_done(self, ok)
+
+
+class ReadTransfer(Transfer):
+    """Answers a RRQ: we are the sender. Works like the PUT side of
+        tftp.tftp_transfer, we keep a window of unacknowledged DATA packets
+        and rewind to the block after the last ACK"""
+
+    def start(self):
+        self.acked = 0
+        self.blocknr = 0
+        self.window = []
+        # One packet buffer per window slot, block n is built in slot
+        # n % window_size
+        self.slots = [tftp.PacketBuffer(self.block_size) for i in range(self.window_size)]
+        self.source = tftp_io.open_source(self.fd, self.block_size, self.offset, self.length)
+        self.last_read = False
+        # ACKs for the block we rewound to are taken as duplicates from the
+        # same broken window for rtt.repeat_window() after the rewind
+        self.rewound_to = None
+        self.rewound_at = None
+        if self.oack:
+            self.send(self.oack)
+            self.time_packet(0)
+            self.arm()
+        else:
+            self.on_ack(0)
+
+    def handle(self, pkt):
+        if pkt[0] != tftp.OPCODE_ACK:
+            self.fail(4)
+            return
+        self.on_ack(tftp.unwrap_blocknr(pkt[1], self.acked, self.rollover))
+
+    def on_ack(self, ack_blocknr):
+        if ack_blocknr < self.acked or ack_blocknr > self.blocknr:
+            return
+        if (ack_blocknr == self.rewound_to and
+                time.time() - self.rewound_at < self.rtt.repeat_window()):
+            return
+        self.check_timed(ack_blocknr)
+        self.retries = 0
+        # Rewinds take no RTT samples, the backoff has to end on progress
+        if ack_blocknr > self.acked:
+            self.rtt.resume()
+
+        old_blocknr = self.blocknr
+        if ack_blocknr < self.blocknr:
+            self.rewound_to = ack_blocknr
+            self.rewound_at = time.time()
+        del self.window[:ack_blocknr - self.acked]
+        self.acked = ack_blocknr
+        self.source.release(ack_blocknr)
+
+        if self.last_read and not self.window:
+            self.finish(True)
+            return
+
+        while len(self.window) < self.window_size and not self.last_read:
+            self.blocknr += 1
+            slot = self.slots[self.blocknr % self.window_size]
+            packet_blocknr = tftp.wire_blocknr(self.blocknr, self.rollover)
+            if slot.fill(packet_blocknr, self.source.block(self.blocknr)) < self.block_size:
+                self.last_read = True
+            self.window.append(slot.packet)
+
+        for packet in self.window:
+            self.send(packet)
+        # Only a block that was never sent before gives a valid sample
+        if self.blocknr == old_blocknr:
+            self.timed_blocknr = None
+        else:
+            self.time_packet(self.blocknr)
+        self.arm()
+
+    def retransmit(self):
+        self.rewound_to = None
+        if self.blocknr == 0:
+            self.send(self.oack)
+        for packet in self.window:
+            self.send(packet)
+
+
+    def finish(self, ok):
+        if not self.done:
+            self.source.close()
+        Transfer.finish(self, ok)
+
+
+class WriteTransfer(Transfer):
+    """Answers a WRQ: we are the receiver. Only the last block of each window
+        is acknowledged. After the last block we hang around for a few
+        timeouts to ACK it again in case our ACK was lost.
+
+        The data goes to a temporary file next to the target, which replaces
+        the target only once the whole file is in. Blocks are gathered into
+        large writes, but without a writer thread: the server is a single
+        thread and must not end up with one per client"""
+
+    def start(self):
+        self.writer = tftp_io.WriteBehind(self.fd, threaded=False)
+        self.expected = 1
+        self.window_count = 0
+        # Like ReadTransfer.rewound_to, one rewind ACK per broken window
+        # unless the client is still resending a while later
+        self.rewind_sent = False
+        self.rewind_at = None
+        self.closing = False
+        self.size = 0
+        if self.oack:
+            self.last_ack = self.oack
+        else:
+            self.last_ack = tftp.make_packet_ack(0)
+        self.send(self.last_ack)
+        self.time_packet(1)
+        self.arm()
+
+    def handle(self, pkt):
+        if pkt[0] != tftp.OPCODE_DATA:
+            self.fail(4)
+            return
+        (opcode, blocknr, data) = pkt
+        blocknr = tftp.unwrap_blocknr(blocknr, self.expected, self.rollover)
+
+        if blocknr != self.expected:
+            if (self.rewind_sent and not self.closing and
+                    time.time() - self.rewind_at < self.rtt.repeat_window()):
+                return
+            if self.window_size > 1:
+                self.rewind_sent = True
+                self.rewind_at = time.time()
+            self.window_count = 0
+            self.timed_blocknr = None
+            # Acknowledge the last block we have in order, the client resends
+            # from there. The ACK of the last full window, or the OACK, would
+            # make it rewind further than needed and after reordering have it
+            # resend blocks we already have over and over again
+            self.last_ack = tftp.make_packet_ack(tftp.wire_blocknr(self.expected - 1, self.rollover))
+            self.send(self.last_ack)
+            return
+
+        self.check_timed(blocknr)
+        if self.retries:
+            self.rtt.resume()
+        self.retries = 0
+        self.rewind_sent = False
+        self.size += len(data)
+        self.expected += 1
+        self.window_count += 1
+
+        last = len(data) < self.block_size
+        if self.window_count < self.window_size and not last:
+            self.store(data)
+            return
+        self.window_count = 0
+        self.last_ack = tftp.make_packet_ack(tftp.wire_blocknr(blocknr, self.rollover))
+        if not last:
+            self.send(self.last_ack)
+        if not self.store(data):
+            return
+        if last:
+            # The file must be on disk and in place before the last block is
+            # acknowledged, the client takes that ACK as done
+            try:
+                self.writer.close()
+            except (IOError, OSError) as e:
+                self.write_failed(e)
+                return
+            self.fd.close()
+            try:
+                os.rename(self.fd.name, self.path)
+            except OSError:
+                self.fail(2)
+                return
+            self.closing = True
+            self.send(self.last_ack)
+        else:
+            self.time_packet(blocknr + 1)
+        self.arm()
+
+    def store(self, data):
+        """Hand data to the writer. Fails the transfer and returns False if
+            the file cannot be written"""
+        try:
+            self.writer.write(data)
+        except IOError as e:
+            self.write_failed(e)
+            return False
+        return True
+
+    def write_failed(self, e):
+        if e.errno == errno.ENOSPC:
+            self.fail(3)
+        else:
+            self.fail(2)
+
+    def on_timeout(self):
+        if self.closing:
+            # Nothing to resend, the client has to come back to us. Back off
+            # like it does so that its resends still find us here
+            self.retries += 1
+            if self.retries > DALLY_RETRIES:
+                self.finish(True)
+            else:
+                self.rtt.backoff()
+                self.arm()
+        else:
+            Transfer.on_timeout(self)
+
+    def retransmit(self):
+        self.rewind_sent = False
+        self.window_count = 0
+        self.send(self.last_ack)
+
+    def finish(self, ok):
+        if not self.done and not self.closing:
+            # Do not leave half written files behind
+            self.writer.abort()
+            self.fd.close()
+            try:
+                os.remove(self.fd.name)
+            except OSError:
+                pass
+        Transfer.finish(self, ok)
+
+
+class TftpServer(object):
+
+    def __init__(self, root, port=tftp.TFTP_PORT, host="", allow_write=False,
+                 max_blksize=MAX_BLKSIZE, max_windowsize=MAX_WINDOWSIZE):
+        self.root = os.path.realpath(root)
+        self.allow_write = allow_write
+        self.max_blksize = max_blksize
+        self.max_windowsize = max_windowsize
+
+        (family, socktype, proto, canonname, sockaddr) = socket.getaddrinfo(
+            host or None, port, 0, socket.SOCK_DGRAM, 0, socket.AI_PASSIVE)[0]
+        self.family = family
+        self.host = sockaddr[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.bind(sockaddr)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+
+        # All sockets are read into this buffer, a packet is handled
+        # completely before the next one is received
+        self.recv_buf = bytearray(65536)
+        self.recv_view = memoryview(self.recv_buf)
+
+        self.loop = tftp_loop.EventLoop()
+        self.loop.register(self.sock, self.on_request)
+        self.transfers = {}
+
+        self.completed = 0
+        self.failed = 0
+
+    # REQUESTS -------------------------------------------------------------
+
+    def send_error(self, sock, addr, errcode, errmsg=None):
+        if errmsg is None:
+            errmsg = tftp.ERROR_CODES[errcode]
+        try:
+            sock.sendto(tftp.make_packet_err(errcode, errmsg), addr)
+        except socket.error:
+            pass
+
+    def resolve(self, filename):
+        """Map a requested filename to a path below root, or None if it points
+            somewhere else"""
+        path = os.path.realpath(os.path.join(self.root, filename.lstrip("/")))
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def negotiate(self, opcode, options, fd):
+        """Return the options we accept, with the values we agree to. Unknown
+            options and values we cannot parse are left out"""
+        accepted = {}
+        for (name, value) in options.items():
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+            if name == "blksize" and value >= tftp.BLKSIZE_MIN:
+                accepted[name] = min(value, self.max_blksize)
+            elif name == "windowsize" and value >= 1:
+                accepted[name] = min(value, self.max_windowsize)
+            elif name == "tsize" and opcode == tftp.OPCODE_RRQ:
+                accepted[name] = os.fstat(fd.fileno()).st_size
+            elif name == "tsize" and value >= 0:
+                accepted[name] = value
+            elif name == "rollover" and value in (0, 1):
+                accepted[name] = value
+            elif name == "offset" and opcode == tftp.OPCODE_RRQ:
+                # Not a standard option. Resuming clients ask for the file
+                # from offset on, block 1 starts there
+                if 0 <= value <= os.fstat(fd.fileno()).st_size:
+                    accepted[name] = value
+        # Not a standard option either: only length bytes from offset on,
+        # or less if the file ends before that. Never from the wrong place,
+        # a length goes with an offset we agreed to or with none at all
+        if (opcode == tftp.OPCODE_RRQ and "length" in options
+                and ("offset" in accepted or "offset" not in options)):
+            try:
+                length = int(options["length"])
+            except ValueError:
+                length = -1
+            if length >= 0:
+                accepted["length"] = min(length, os.fstat(fd.fileno()).st_size - accepted.get("offset", 0))
+        return accepted
+
+    def handle_request(self, view, nbytes, addr):
+        pkt = tftp.parse_packet_view(view, nbytes)
+        if pkt is None or pkt[0] not in (tftp.OPCODE_RRQ, tftp.OPCODE_WRQ):
+            self.send_error(self.sock, addr, 4)
+            return
+        (opcode, filename, mode, options) = pkt
+
+        # netascii is served as is, like most servers do
+        if mode not in (tftp.MODE_OCTET, tftp.MODE_NETASCII):
+            self.send_error(self.sock, addr, 4, "Unsupported mode")
+            return
+
+        path = self.resolve(filename)
+        if path is None or (opcode == tftp.OPCODE_WRQ and not self.allow_write):
+            self.send_error(self.sock, addr, 2)
+            return
+
+        try:
+            if opcode == tftp.OPCODE_RRQ:
+                fd = open(path, "rb")
+            else:
+                (tmp, tmp_path) = tempfile.mkstemp(prefix=".tftp-", dir=os.path.dirname(path))
+                os.close(tmp)
+                os.chmod(tmp_path, 0o644)
+                fd = open(tmp_path, "wb")
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                self.send_error(self.sock, addr, 1)
+            else:
+                self.send_error(self.sock, addr, 2)
+            return
+
+        accepted = self.negotiate(opcode, options, fd)
+        oack = None
+        if accepted:
+            oack = tftp.make_packet_oack(accepted)
+
+        # Every transfer gets a socket of its own, the port is our TID
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        sock.bind((self.host, 0))
+        sock.setblocking(False)
+
+        args = (self, sock, addr, fd, path, accepted.get("blksize", tftp.BLOCK_SIZE),
+                accepted.get("windowsize", 1), oack, accepted.get("offset", 0),
+                accepted.get("rollover", 0), accepted.get("length"))
+        if opcode == tftp.OPCODE_RRQ:
+            transfer = ReadTransfer(*args)
+        else:
+            transfer = WriteTransfer(*args)
+        self.transfers[sock.fileno()] = transfer
+        self.loop.register(sock, transfer.on_readable)
+        transfer.start()
+
+    def transfer_done(self, transfer, ok):
+        fd = transfer.fileno()
+        self.loop.unregister(transfer.sock)
+        del self.transfers[fd]
+        transfer.sock.close()
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    # EVENT LOOP -----------------------------------------------------------
+
+    def drain(self, sock, handler):
+        for i in range(MAX_BURST):
+            try:
+                (nbytes, addr) = sock.recvfrom_into(self.recv_buf)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                # ICMP errors from an earlier send, nothing to read
+                continue
+            handler(self.recv_view, nbytes, addr)
+            if sock.fileno() < 0:
+                # The handler finished the transfer and closed its socket
+                return
+
+    def on_request(self, sock):
+        self.drain(sock, self.handle_request)
+
+    def run_once(self, max_wait=None):
+        """Wait for packets or the next retransmission deadline and handle
+            what is due. Returns after one round"""
+        self.loop.run_once(max_wait)
+
+    def serve_forever(self):
+        while True:
+            self.run_once()
+
+    def close(self):
+        for transfer in list(self.transfers.values()):
+            transfer.finish(False)
+        self.loop.unregister(self.sock)
+        self.loop.close()
+        self.sock.close()
+
+
+def raise_file_limit():
+    # One socket and one file per transfer, the default limit of 1024
+    # descriptors is not enough for thousands of transfers
+    try:
+        import resource
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def usage():
+    """Print the usage on stderr and quit with error code"""
+    sys.stderr.write("Usage: %s [-p PORT] [-b ADDRESS] [-w] ROOT\n" % sys.argv[0])
+    sys.exit(1)
+
+
+def main():
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "p:b:w")
+    except getopt.GetoptError:
+        usage()
+        return
+    if len(args) != 1:
+        usage()
+        return
+
+    port = tftp.TFTP_PORT
+    host = ""
+    allow_write = False
+    for (opt, value) in opts:
+        if opt == "-p":
+            port = int(value)
+        elif opt == "-b":
+            host = value
+        elif opt == "-w":
+            allow_write = True
+
+    raise_file_limit()
+    server = TftpServer(args[0], port, host, allow_write)
+    print("Serving %s on port %d" % (server.root, server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+    print("%d transfers completed, %d failed" % (server.completed, server.failed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#! /usr/bin/python
+#
+# The simpy M/M/1 of qsim.py against the NumPy one of qsim_numpy.py. Runs
+# both with the same seed for a few horizons and prints events per second and
+# the time average of N each of them got, which should agree.
+#
+#  bash$ ./bench_qsim.py [LAMBDA] [MU] [SEED]
+import sys,time
+import qsim,qsim_numpy
+
+SIMTIMES= [1000.0, 10000.0, 100000.0]
+
+
+def timed(func, seed):
+    start = time.time()
+    stats = func(seed)
+    return stats, time.time() - start
+
+
+def main():
+    if len(sys.argv) > 1:
+        qsim.lambd = float(sys.argv[1])
+    if len(sys.argv) > 2:
+        qsim.mu = float(sys.argv[2])
+    seed = 1
+    if len(sys.argv) > 3:
+        seed = int(sys.argv[3])
+    qsim.trace = False
+
+    print "lambda %g, mu %g, seed %d, E[N] %.4f" % (qsim.lambd, qsim.mu, seed,
+                                                     qsim.lambd / (qsim.mu - qsim.lambd))
+    print "%10s %10s %14s %14s %8s %12s %12s" % ("simtime", "events", "simpy ev/s", "numpy ev/s",
+                                                 "speedup", "simpy N", "numpy N")
+    for simtime in SIMTIMES:
+        qsim.simtime = simtime
+        (old, old_time) = timed(qsim.run_once, seed)
+        (new, new_time) = timed(qsim_numpy.run_once, seed)
+        old_rate = old['events'] / old_time
+        new_rate = new['events'] / new_time
+        print "%10.0f %10d %14.0f %14.0f %7.1fx %12.6f %12.6f" % (simtime, old['events'], old_rate, new_rate,
+                                                                  new_rate / old_rate, old['navg'], new['navg'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+#! /usr/bin/python
+#
+# Queueing networks: qsim.py grown from one M/M/1 queue into nodes with any
+# number of servers, any service time distribution and an optional finite
+# waiting room, joined in tandem or feed-forward by routing probabilities.
+#
+#  bash$ ./qnet.py [SIMTIME] [SEED]
+#
+# runs the models that have a closed form (M/M/1, M/M/c, M/G/1 by
+# Pollaczek-Khinchine, M/M/1/K and a tandem of M/M/1 queues, which is a
+# Jackson network) and prints what the simulation got next to the theory.
+#
+# Events are kept in a heap of their own instead of a simpy Environment,
+# which takes a plain tuple per event instead of an Event with a callback
+# list. Every source and node draws from random streams of its own, so a
+# run is repeatable from its seed, like a qsim.Simulation.
+#
+# A finite waiting room works like the DropTail queues with MaxPackets in
+# sim-udp.py: queue_size customers can wait besides the ones in service,
+# any more are dropped.
+#
+# Waits and sojourn times go into qsim_stats.SampleSummary as they happen and
+# N into a qsim_stats.TimeAverage, none of them keeps the samples, so a run
+# of any length takes the same memory.
+
+import sys,random,heapq,math,collections
+import qsim_stats
+
+# Random streams a network leaves room for per seed
+MAX_STREAMS= 1000
+
+
+# DISTRIBUTIONS -------------------------------------------------------------
+# Anything with sample(rng), mean() and moment2(), the second moment that the
+# M/G/1 waiting time depends on
+
+class Exponential(object):
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def sample(self, rng):
+        return rng.expovariate(self.rate)
+
+    def mean(self):
+        return 1.0 / self.rate
+
+    def moment2(self):
+        return 2.0 / self.rate ** 2
+
+
+class Deterministic(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def sample(self, rng):
+        return self.value
+
+    def mean(self):
+        return self.value
+
+    def moment2(self):
+        return self.value ** 2
+
+
+class Uniform(object):
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng):
+        return rng.uniform(self.low, self.high)
+
+    def mean(self):
+        return (self.low + self.high) / 2.0
+
+    def moment2(self):
+        return (self.high ** 3 - self.low ** 3) / (3.0 * (self.high - self.low))
+
+
+class Erlang(object):
+    """Sum of k exponential phases, mean m in all"""
+
+    def __init__(self, k, m):
+        self.k = k
+        self.m = m
+
+    def sample(self, rng):
+        return rng.gammavariate(self.k, float(self.m) / self.k)
+
+    def mean(self):
+        return self.m
+
+    def moment2(self):
+        return self.m ** 2 * (1.0 + 1.0 / self.k)
+
+
+# SIMULATION ----------------------------------------------------------------
+
+class Scheduler(object):
+    """Calls callback(*args) at the times they were scheduled for, in order.
+        Events at the same time run in the order they were scheduled"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+
+    def schedule(self, delay, callback, *args):
+        self.seq += 1
+        heapq.heappush(self.events, (self.now + delay, self.seq, callback, args))
+
+    def run(self, until):
+        events = self.events
+        while events and events[0][0] < until:
+            (self.now, seq, callback, args) = heapq.heappop(events)
+            callback(*args)
+        self.now = until
+
+
+class Customer(object):
+    __slots__ = ('born', 'arrived')
+
+    def __init__(self, born):
+        self.born = born
+        self.arrived = born
+
+
+class Node(object):
+    """A queue with servers servers, FIFO. queue_size None is an infinite
+        waiting room"""
+
+    def __init__(self, network, name, service, servers=1, queue_size=None):
+        self.network = network
+        self.scheduler = network.scheduler
+        self.name = name
+        self.service = service
+        self.servers = servers
+        self.queue_size = queue_size
+        self.service_rng = network.stream()
+        self.route_rng = network.stream()
+        # (cumulative probability, node), whatever is left leaves the network
+        self.routes = []
+        self.waiting = collections.deque()
+        self.busy = 0
+        self.reset(0.0)
+
+    def route(self, node, probability=1.0):
+        """Send that share of the customers done here on to node"""
+        total = probability + (self.routes and self.routes[-1][0] or 0.0)
+        if total > 1.0 + 1e-9:
+            raise ValueError("routing probabilities of %s add up to more than 1" % self.name)
+        self.routes.append((total, node))
+
+    def reset(self, now):
+        """Forget what happened so far, for a warm up period"""
+        self.arrivals = 0
+        self.drops = 0
+        self.completions = 0
+        self.n_avg = qsim_stats.TimeAverage(now)
+        self.busy_avg = qsim_stats.TimeAverage(now)
+        self.waits = qsim_stats.SampleSummary()
+        self.sojourns = qsim_stats.SampleSummary()
+
+    def update(self, now):
+        self.n_avg.update(now, self.busy + len(self.waiting))
+        self.busy_avg.update(now, self.busy)
+
+    def arrive(self, customer):
+        now = self.scheduler.now
+        self.update(now)
+        self.arrivals += 1
+        customer.arrived = now
+        if self.busy < self.servers:
+            self.start(customer, now)
+        elif self.queue_size is None or len(self.waiting) < self.queue_size:
+            self.waiting.append(customer)
+        else:
+            self.drops += 1
+
+    def start(self, customer, now):
+        self.busy += 1
+        self.waits.add(now - customer.arrived)
+        self.scheduler.schedule(self.service.sample(self.service_rng), self.depart, customer)
+
+    def depart(self, customer):
+        now = self.scheduler.now
+        self.update(now)
+        self.busy -= 1
+        self.completions += 1
+        self.sojourns.add(now - customer.arrived)
+        if self.waiting:
+            self.start(self.waiting.popleft(), now)
+        if self.routes:
+            u = self.route_rng.random()
+            for (limit, node) in self.routes:
+                if u < limit:
+                    node.arrive(customer)
+                    return
+        self.network.leave(customer)
+
+    def report(self):
+        result = {'name': self.name,
+                  'arrivals': self.arrivals,
+                  'drops': self.drops,
+                  'loss': self.arrivals and float(self.drops) / self.arrivals or 0.0,
+                  'completions': self.completions,
+                  'utilization': self.busy_avg.mean() / self.servers,
+                  'n': self.n_avg.mean(),
+                  'n_var': self.n_avg.variance()}
+        result.update(self.waits.report('wait'))
+        result.update(self.sojourns.report('sojourn'))
+        return result
+
+
+class Source(object):
+    """Customers coming into node with interarrival times from a
+        distribution"""
+
+    def __init__(self, network, interarrival, node):
+        self.scheduler = network.scheduler
+        self.interarrival = interarrival
+        self.node = node
+        self.rng = network.stream()
+
+    def start(self):
+        self.scheduler.schedule(self.interarrival.sample(self.rng), self.arrive)
+
+    def arrive(self):
+        self.node.arrive(Customer(self.scheduler.now))
+        self.scheduler.schedule(self.interarrival.sample(self.rng), self.arrive)
+
+
+class Network(object):
+    """Sources and nodes sharing one scheduler. Seed None seeds the random
+        streams from the system"""
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.scheduler = Scheduler()
+        self.nodes = []
+        self.sources = []
+        self.streams = 0
+        self.sojourns = qsim_stats.SampleSummary()
+
+    def stream(self):
+        self.streams += 1
+        if self.seed is None:
+            return random.Random()
+        if self.streams > MAX_STREAMS:
+            raise ValueError("more than %d random streams" % MAX_STREAMS)
+        return random.Random(self.seed * MAX_STREAMS + self.streams)
+
+    def node(self, name, service, servers=1, queue_size=None):
+        node = Node(self, name, service, servers, queue_size)
+        self.nodes.append(node)
+        return node
+
+    def source(self, interarrival, node):
+        source = Source(self, interarrival, node)
+        self.sources.append(source)
+        return source
+
+    def leave(self, customer):
+        self.sojourns.add(self.scheduler.now - customer.born)
+
+    def run(self, simtime, warmup=0.0):
+        """Simulate until simtime, counting from warmup on. Returns a dict
+            with a report per node and the time customers spent in the
+            network"""
+        for source in self.sources:
+            source.start()
+        if warmup > 0:
+            self.scheduler.run(warmup)
+            for node in self.nodes:
+                node.reset(warmup)
+            self.sojourns = qsim_stats.SampleSummary()
+        self.scheduler.run(simtime)
+        for node in self.nodes:
+            node.update(simtime)
+        result = {'nodes': [node.report() for node in self.nodes],
+                  'departures': self.sojourns.stats.n}
+        result.update(self.sojourns.report('sojourn'))
+        return result
+
+
+# CLOSED FORMS --------------------------------------------------------------
+# Mean number in the node, mean wait before service, utilization and loss
+
+def mm1(lambd, mu):
+    rho = float(lambd) / mu
+    return {'n': rho / (1 - rho), 'wait': rho / (mu - lambd), 'utilization': rho, 'loss': 0.0}
+
+
+def mmc(lambd, mu, c):
+    """Erlang C"""
+    a = lambd / mu
+    rho = a / c
+    top = a ** c / math.factorial(c) / (1 - rho)
+    p_wait = top / (sum(a ** k / math.factorial(k) for k in range(c)) + top)
+    wait = p_wait / (c * mu - lambd)
+    return {'n': lambd * (wait + 1.0 / mu), 'wait': wait, 'utilization': rho, 'loss': 0.0}
+
+
+def mg1(lambd, service):
+    """Pollaczek-Khinchine"""
+    rho = lambd * service.mean()
+    wait = lambd * service.moment2() / (2 * (1 - rho))
+    return {'n': lambd * (wait + service.mean()), 'wait': wait, 'utilization': rho, 'loss': 0.0}
+
+
+def mm1k(lambd, mu, k):
+    """At most k customers in the node, the one in service included"""
+    rho = lambd / mu
+    p0 = (1 - rho) / (1 - rho ** (k + 1))
+    loss = rho ** k * p0
+    n = rho / (1 - rho) - (k + 1) * rho ** (k + 1) / (1 - rho ** (k + 1))
+    wait = n / (lambd * (1 - loss)) - 1.0 / mu
+    return {'n': n, 'wait': wait, 'utilization': 1 - p0, 'loss': loss}
+
+
+# VALIDATION ----------------------------------------------------------------
+
+def single(service, servers=1, queue_size=None, lambd=15.0):
+    def build(network):
+        node = network.node("queue", service, servers, queue_size)
+        network.source(Exponential(lambd), node)
+    return build
+
+
+def tandem(lambd, mus):
+    def build(network):
+        nodes = [network.node("queue%d" % (i + 1), Exponential(mu)) for (i, mu) in enumerate(mus)]
+        for (node, after) in zip(nodes, nodes[1:]):
+            node.route(after)
+        network.source(Exponential(lambd), nodes[0])
+    return build
+
+
+def scenarios():
+    """(name, build, theory per node, mean time in the network)"""
+    lambd = 15.0
+    return [("M/M/1", single(Exponential(20.0)), [mm1(lambd, 20.0)], None),
+            ("M/M/3", single(Exponential(6.0), servers=3), [mmc(lambd, 6.0, 3)], None),
+            ("M/D/1", single(Deterministic(0.05)), [mg1(lambd, Deterministic(0.05))], None),
+            ("M/U/1", single(Uniform(0.02, 0.08)), [mg1(lambd, Uniform(0.02, 0.08))], None),
+            ("M/E4/1", single(Erlang(4, 0.05)), [mg1(lambd, Erlang(4, 0.05))], None),
+            ("M/M/1/5", single(Exponential(20.0), queue_size=4), [mm1k(lambd, 20.0, 5)], None),
+            ("tandem M/M/1", tandem(lambd, [20.0, 25.0]), [mm1(lambd, 20.0), mm1(lambd, 25.0)],
+             1 / (20.0 - lambd) + 1 / (25.0 - lambd))]
+
+
+def main():
+    simtime = 10000.0
+    seed = 1
+    if len(sys.argv) > 1:
+        simtime = float(sys.argv[1])
+    if len(sys.argv) > 2:
+        seed = int(sys.argv[2])
+    warmup = simtime / 20
+
+    print "%-14s %-8s %12s %10s %10s %10s %10s %10s" % ("model", "node", "", "N", "wait", "wait p99",
+                                                        "util", "loss")
+    for (name, build, theory, sojourn) in scenarios():
+        network = Network(seed)
+        build(network)
+        result = network.run(simtime, warmup)
+        for (node, expected) in zip(result['nodes'], theory):
+            print "%-14s %-8s %12s %10.4f %10.4f %10.4f %10.4f %10.4f" % (
+                name, node['name'], "simulated", node['n'], node['wait'], node['wait_p99'],
+                node['utilization'], node['loss'])
+            print "%-14s %-8s %12s %10.4f %10.4f %10s %10.4f %10.4f" % (
+                "", "", "theory", expected['n'], expected['wait'], "", expected['utilization'],
+                expected['loss'])
+        if sojourn is not None:
+            print "%-14s %-8s %12s %10.4f, theory %.4f, p99 %.4f, p999 %.4f" % (
+                "", "network", "sojourn", result['sojourn'], sojourn, result['sojourn_p99'],
+                result['sojourn_p999'])
+            for line in result['sojourn_hist'].format():
+                print "%-14s %s" % ("", line)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,42 @@
 #! /usr/bin/python
+#
+# M/M/1 queue simulated with simpy, one event per arrival and departure.
+#
+# Interarrival and service times come from two random streams of their own,
+# see make_streams, so that a run is repeatable from its seed and
+# qsim_numpy.py can draw the very same times in bulk.
+#
+# All state of a run is in a Simulation, the module only has the default
+# parameters. Any number of runs can go on in one process, one after another
+# or in threads of their own.
+#
+# N and the sojourn times go into the constant memory estimators of
+# qsim_stats, only the arrival times of the customers in the queue are kept,
+# so runs of hundreds of millions of events report their quantiles and
+# histogram without holding on to samples. The trace of every event is off
+# unless asked for:
+#
+#  bash$ ./qsim.py [-v]
 
-import simpy, random
+import sys, math, simpy, random, collections
+import qsim_stats
 
 
-N=0           # initial queue length
 lambd=15.0    # customers/hour
 mu=20.0       # customers/hour
 simtime=200.0 # run for 200 seconds
 
+# Print every arrival and departure
+trace=False
+
+def make_streams(seed=None):
+    """Random streams for interarrival and service times. Seed None seeds
+        both from the system"""
+    if seed is None:
+        return random.Random(), random.Random()
+    return random.Random(2 * seed), random.Random(2 * seed + 1)
+
+
 def schedule_new_event(env, cb_func, delay):
     ev = simpy.events.Event(env)
     ev.callbacks.append(cb_func)
@@ -15,40 +44,92 @@ def schedule_new_event(env, cb_func, delay):
     env.schedule(ev, simpy.events.NORMAL, delay)
 
 
-navg = 0.0
-prev_t = 0.0
-def update_avg(t, n):
-    global navg, prev_t
-    navg = navg + n * (t - prev_t)
-    prev_t = t
+class Simulation(object):
+    """One run of the queue. arrival and departure are the event callbacks,
+        bound to the run they belong to"""
+
+    __slots__ = ('lambd', 'mu', 'simtime', 'trace', 'arrival_rng', 'service_rng',
+                 'N', 'n_avg', 'queue', 'sojourns', 'arrivals', 'departures')
+
+    def __init__(self, lambd=lambd, mu=mu, simtime=simtime, seed=None, trace=False):
+        self.lambd = lambd
+        self.mu = mu
+        self.simtime = simtime
+        self.trace = trace
+        (self.arrival_rng, self.service_rng) = make_streams(seed)
+        self.N = 0           # initial queue length
+        self.n_avg = qsim_stats.TimeAverage()
+        self.queue = collections.deque()    # arrival times, FIFO
+        self.sojourns = qsim_stats.SampleSummary()
+        self.arrivals = 0
+        self.departures = 0
+
+    def update_avg(self, t, n):
+        self.n_avg.update(t, n)
 
+    def arrival(self, ev):
+        self.update_avg(ev.env.now, self.N)
+        self.N = self.N + 1
+        self.queue.append(ev.env.now)
+        self.arrivals = self.arrivals + 1
+        if self.trace:
+            print ev.env.now, "arr, N len", self.N
+        if self.N == 1:
+            schedule_new_event(ev.env, self.departure, self.service_rng.expovariate(self.mu))
+        schedule_new_event(ev.env, self.arrival, self.arrival_rng.expovariate(self.lambd))
 
-def arrival(ev):
-    global N
-    update_avg(ev.env.now, N)
-    N = N + 1
-    print ev.env.now, "arr, N len", N
-    if N == 1:
-        schedule_new_event(ev.env, departure, random.expovariate(mu))
-    schedule_new_event(ev.env, arrival, random.expovariate(lambd))
+    def departure(self, ev):
+        self.update_avg(ev.env.now, self.N)
+        self.N = self.N - 1
+        self.departures = self.departures + 1
+        self.sojourns.add(ev.env.now - self.queue.popleft())
+        if self.trace:
+            print ev.env.now, "dep, N len", self.N
+        if self.N > 0:
+            schedule_new_event(ev.env, self.departure, self.service_rng.expovariate(self.mu))
 
+    def run(self):
+        """Simulate simtime seconds. Returns a dict with the time average and
+            variance of N, the mean, quantiles and qsim_stats.Histogram of
+            the sojourn time of the customers that left and the arrivals and
+            departures within that time"""
+        env = simpy.Environment(0.0)
+        schedule_new_event(env, self.arrival,
+                           self.arrival_rng.expovariate(self.lambd))
+        env.run(until=self.simtime)
+        self.update_avg(self.simtime, self.N)
+        stats = {'navg': self.n_avg.mean(),
+                 'nvar': self.n_avg.variance(),
+                 'expected': self.lambd / (self.mu - self.lambd),
+                 'arrivals': self.arrivals,
+                 'departures': self.departures,
+                 'events': self.arrivals + self.departures}
+        stats.update(self.sojourns.report('sojourn'))
+        return stats
 
-def departure(ev):
-    global N
-    update_avg(ev.env.now, N)
-    N = N - 1
-    print ev.env.now, "dep, N len", N
-    if N > 0:
-        schedule_new_event(ev.env, departure, random.expovariate(mu))
 
+def run_once(seed=None, lambd=None, mu=None, simtime=None):
+    """One Simulation, with the parameters of this module unless given"""
+    if lambd is None:
+        lambd = globals()['lambd']
+    if mu is None:
+        mu = globals()['mu']
+    if simtime is None:
+        simtime = globals()['simtime']
+    return Simulation(lambd, mu, simtime, seed, trace).run()
 
-def run_once():
-    env = simpy.Environment(0.0)
-    schedule_new_event(env, arrival,
-                       random.expovariate(lambd))
-    env.run(until=simtime)
-    update_avg(simtime, N)
-    print "E[N(t)] = ", lambd / (mu - lambd)
-    print "Average N length", navg / simtime
 
-run_once()
+if __name__ == "__main__":
+    if "-v" in sys.argv[1:]:
+        trace = True
+    stats = run_once()
+    print "E[N(t)] = ", stats['expected']
+    print "Average N length", stats['navg']
+    # The sojourn time of M/M/1 is exponential with rate mu - lambda
+    print "Sojourn time mean", stats['sojourn'], "expected", 1 / (mu - lambd)
+    for p in qsim_stats.QUANTILES:
+        name = qsim_stats.quantile_name(p)
+        print "Sojourn time", name, stats['sojourn_' + name], "expected", -math.log(1 - p) / (mu - lambd)
+    print "Sojourn times"
+    for line in stats['sojourn_hist'].format():
+        print line
@@ -0,0 +1,132 @@
+#! /usr/bin/python
+#
+# M/M/1 queue of qsim.py without an event loop. All interarrival and service
+# times are drawn in bulk with NumPy and the departure times follow from the
+# Lindley recursion
+#
+#   D[i] = max(A[i], D[i-1]) + S[i]
+#
+# which unrolls to D = C + running max of (A - C + S), C the running sum of
+# the service times, so it takes a few array operations instead of a Python
+# callback per event.
+#
+# The times come from the same two random streams as in qsim.py, their
+# Mersenne Twister state is handed to NumPy, so for the same seed run_once
+# returns the same statistics as qsim.run_once. The quantiles of the sojourn
+# time are exact here, from all the sojourn times at once, where qsim.py
+# estimates them as it goes, which makes this a check of those estimates.
+#
+#  bash$ ./qsim_numpy.py [LAMBDA] [MU] [SIMTIME] [SEED]
+
+import sys
+import numpy
+import qsim,qsim_stats
+
+# Interarrival times drawn per round, on top of the expected number
+DRAW_MARGIN= 1000
+
+
+def numpy_stream(rng):
+    """NumPy generator that carries on where rng, a random.Random, is"""
+    state = rng.getstate()[1]
+    stream = numpy.random.RandomState()
+    stream.set_state(('MT19937', numpy.array(state[:624], dtype=numpy.uint32), state[624]))
+    return stream
+
+
+def exponential(stream, rate, n):
+    """n draws of random.expovariate(rate), computed the same way"""
+    return -numpy.log(1.0 - stream.random_sample(n)) / rate
+
+
+def arrival_times(stream, lambd, simtime):
+    """Times of all arrivals before simtime"""
+    times = numpy.empty(0)
+    last = 0.0
+    while last < simtime:
+        n = int((simtime - last) * lambd * 1.1) + DRAW_MARGIN
+        more = last + numpy.cumsum(exponential(stream, lambd, n))
+        times = numpy.concatenate((times, more))
+        last = more[-1]
+    return times[times < simtime]
+
+
+def departure_times(arrivals, services):
+    """Lindley recursion for a single FIFO server, all at once"""
+    done = numpy.cumsum(services)
+    return done + numpy.maximum.accumulate(arrivals - done + services)
+
+
+def run_once(seed=None, lambd=None, mu=None, simtime=None):
+    """Like qsim.run_once, with the parameters of qsim unless given"""
+    if lambd is None:
+        lambd = qsim.lambd
+    if mu is None:
+        mu = qsim.mu
+    if simtime is None:
+        simtime = qsim.simtime
+    (arrival_rng, service_rng) = qsim.make_streams(seed)
+
+    arrivals = arrival_times(numpy_stream(arrival_rng), lambd, simtime)
+    # Customer i gets the i-th service time, as in qsim where one is drawn
+    # whenever a customer gets to the server
+    services = exponential(numpy_stream(service_rng), mu, len(arrivals))
+    departures = departure_times(arrivals, services)
+
+    # Every customer adds the time it spends in the system before simtime
+    # to the area under N(t)
+    in_system = numpy.minimum(departures, simtime) - arrivals
+    area = numpy.sum(in_system)
+    n_departures = int(numpy.count_nonzero(departures < simtime))
+    stats = {'navg': float(area / simtime),
+             'nvar': n_variance(arrivals, departures, simtime, area / simtime),
+             'expected': lambd / (mu - lambd),
+             'arrivals': len(arrivals),
+             'departures': n_departures,
+             'events': len(arrivals) + n_departures}
+    # Departures come in the order of arrivals, the first n_departures
+    # customers are the ones that left
+    sojourns = (departures - arrivals)[:n_departures]
+    stats['sojourn'] = n_departures and float(numpy.mean(sojourns)) or 0.0
+    for p in qsim_stats.QUANTILES:
+        name = 'sojourn_' + qsim_stats.quantile_name(p)
+        if n_departures:
+            # Nearest rank, like qsim_stats.P2Quantile before five samples
+            rank = int(numpy.ceil(p * n_departures)) - 1
+            stats[name] = float(numpy.partition(sojourns, rank)[rank])
+        else:
+            stats[name] = None
+    stats['sojourn_hist'] = histogram(sojourns)
+    return stats
+
+
+def histogram(samples):
+    """qsim_stats.Histogram of samples, filled in one go"""
+    hist = qsim_stats.Histogram()
+    index = numpy.zeros(len(samples), dtype=int)
+    above = samples >= hist.low
+    index[above] = (numpy.log(samples[above] / hist.low) / hist.log_factor).astype(int) + 1
+    counts = numpy.bincount(numpy.minimum(index, len(hist.counts) - 1), minlength=len(hist.counts))
+    hist.counts = [int(n) for n in counts]
+    hist.count = len(samples)
+    return hist
+
+
+def n_variance(arrivals, departures, simtime, navg):
+    """Time weighted variance of N, from N between consecutive events"""
+    leaving = departures[departures < simtime]
+    times = numpy.concatenate((arrivals, leaving))
+    steps = numpy.concatenate((numpy.ones(len(arrivals)), -numpy.ones(len(leaving))))
+    order = numpy.argsort(times, kind='mergesort')
+    times = numpy.append(times[order], simtime)
+    n = numpy.cumsum(steps[order])
+    area2 = numpy.sum(n * n * numpy.diff(times))
+    return float(max(0.0, area2 / simtime - navg * navg))
+
+
+if __name__ == "__main__":
+    args = [float(arg) for arg in sys.argv[1:4]]
+    seed = len(sys.argv) > 4 and int(sys.argv[4]) or None
+    stats = run_once(seed, *args)
+    print "E[N(t)] = ", stats['expected']
+    print "Average N length", stats['navg']
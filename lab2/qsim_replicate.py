@@ -0,0 +1,167 @@
+#! /usr/bin/python
+#
+# Independent replications of the M/M/1 queue over a grid of arrival and
+# service rates, spread over a multiprocessing pool.
+#
+#  bash$ ./qsim_replicate.py -l 5,10,15,18 -m 20 -w 0.01 -o reps.csv -s summary.csv
+#
+# Every point of the grid gets replications in rounds until the 95%
+# confidence interval of the mean of N is within WIDTH of the mean, or
+# MAX_REPS replications have run. Each replication has a seed of its own,
+# made from the base seed, the point and the replication number, so a sweep
+# gives the same numbers whatever the number of processes. Replications are
+# written to the CSV file as they finish and only running sums are kept per
+# point, a sweep of any size takes the same memory.
+import sys,getopt,csv,multiprocessing
+import qsim,qsim_numpy,qsim_stats
+
+MIN_REPS= 10
+MAX_REPS= 10000
+# Replications per round once MIN_REPS are in
+ROUND= 64
+# Target half width of the confidence interval, relative to the mean
+WIDTH= 0.02
+SIMTIME= 1000.0
+ENGINE= "numpy"
+SEED= 1
+
+# Points per sweep and replications per point the seeds leave room for
+MAX_POINTS= 1000
+SEEDS_PER_POINT= 1000000
+
+REPLICATION_COLUMNS= ['lambda', 'mu', 'rep', 'seed', 'navg', 'arrivals', 'departures']
+SUMMARY_COLUMNS= ['lambda', 'mu', 'reps', 'mean', 'ci_low', 'ci_high', 'half_width', 'expected']
+
+
+def replication_seed(seed, point, rep):
+    return (seed * MAX_POINTS + point) * SEEDS_PER_POINT + rep
+
+
+def replicate(job):
+    """One replication, run in a pool process. Returns the job and the dict
+        of run_once"""
+    (lambd, mu, rep, seed, simtime, engine) = job
+    if engine == "simpy":
+        stats = qsim.Simulation(lambd, mu, simtime, seed).run()
+    else:
+        stats = qsim_numpy.run_once(seed, lambd, mu, simtime)
+    return job, stats
+
+
+def run_point(pool, index, lambd, mu, simtime=SIMTIME, engine=ENGINE, seed=SEED, min_reps=MIN_REPS,
+              max_reps=MAX_REPS, width=WIDTH, writer=None):
+    """Replicate one point of the grid until the confidence interval is narrow
+        enough. Each replication goes to writer, a csv writer, if given.
+        Returns the qsim_stats.RunningStats of the time average of N"""
+    acc = qsim_stats.RunningStats()
+    rep = 0
+    while rep < max_reps:
+        if rep < min_reps:
+            n = min_reps - rep
+        else:
+            n = ROUND
+        n = min(n, max_reps - rep)
+        jobs = [(lambd, mu, r, replication_seed(seed, index, r), simtime, engine) for r in range(rep, rep + n)]
+        for (job, stats) in pool.imap(replicate, jobs):
+            acc.add(stats['navg'])
+            if writer is not None:
+                writer.writerow([lambd, mu, job[2], job[3], repr(stats['navg']), stats['arrivals'],
+                                 stats['departures']])
+        rep += n
+        if acc.half_width() <= width * abs(acc.mean):
+            break
+    return acc
+
+
+def usage():
+    """Print the usage on stderr and quit with error code"""
+    sys.stderr.write("Usage: %s [-l LAMBDAS] [-m MUS] [-t SIMTIME] [-e simpy|numpy] [-j PROCESSES]\n"
+                     "       [-n MIN_REPS] [-N MAX_REPS] [-w WIDTH] [-r SEED] [-o REPS.csv] [-s SUMMARY.csv]\n"
+                     % sys.argv[0])
+    sys.exit(1)
+
+
+def main():
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "l:m:t:e:j:n:N:w:r:o:s:")
+    except getopt.GetoptError:
+        usage()
+        return
+
+    lambdas = [qsim.lambd]
+    mus = [qsim.mu]
+    simtime = SIMTIME
+    engine = ENGINE
+    processes = multiprocessing.cpu_count()
+    min_reps = MIN_REPS
+    max_reps = MAX_REPS
+    width = WIDTH
+    seed = SEED
+    reps_file = None
+    summary_file = None
+    for (opt, value) in opts:
+        if opt == "-l":
+            lambdas = [float(v) for v in value.split(",")]
+        elif opt == "-m":
+            mus = [float(v) for v in value.split(",")]
+        elif opt == "-t":
+            simtime = float(value)
+        elif opt == "-e":
+            engine = value
+        elif opt == "-j":
+            processes = int(value)
+        elif opt == "-n":
+            min_reps = int(value)
+        elif opt == "-N":
+            max_reps = int(value)
+        elif opt == "-w":
+            width = float(value)
+        elif opt == "-r":
+            seed = int(value)
+        elif opt == "-o":
+            reps_file = value
+        elif opt == "-s":
+            summary_file = value
+    if args or engine not in ("simpy", "numpy") or min_reps < 2 or max_reps < min_reps:
+        usage()
+        return
+
+    reps_out = None
+    writer = None
+    if reps_file is not None:
+        reps_out = open(reps_file, "wb")
+        writer = csv.writer(reps_out)
+        writer.writerow(REPLICATION_COLUMNS)
+    summary_out = None
+    summary = None
+    if summary_file is not None:
+        summary_out = open(summary_file, "wb")
+        summary = csv.writer(summary_out)
+        summary.writerow(SUMMARY_COLUMNS)
+
+    pool = multiprocessing.Pool(processes)
+    print "%8s %8s %6s %10s %21s %10s" % ("lambda", "mu", "reps", "mean N", "95% CI", "E[N]")
+    index = 0
+    for lambd in lambdas:
+        for mu in mus:
+            index += 1
+            if lambd >= mu:
+                sys.stderr.write("lambda %g >= mu %g, the queue grows without bound, skipped\n" % (lambd, mu))
+                continue
+            acc = run_point(pool, index, lambd, mu, simtime, engine, seed, min_reps, max_reps, width, writer)
+            (low, high) = acc.interval()
+            expected = lambd / (mu - lambd)
+            print "%8g %8g %6d %10.4f [%9.4f, %9.4f] %10.4f" % (lambd, mu, acc.n, acc.mean, low, high, expected)
+            if summary is not None:
+                summary.writerow([lambd, mu, acc.n, repr(acc.mean), repr(low), repr(high),
+                                  repr(acc.half_width()), repr(expected)])
+                summary_out.flush()
+    pool.close()
+    pool.join()
+    if reps_out is not None:
+        reps_out.close()
+    if summary_out is not None:
+        summary_out.close()
+
+if __name__ == "__main__":
+    main()
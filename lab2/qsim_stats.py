@@ -0,0 +1,245 @@
+#! /usr/bin/python
+#
+# Statistics for simulation output that take constant memory, whatever the
+# number of samples fed to them.
+#
+# RunningStats has the mean and variance of samples, TimeAverage those of a
+# value over time like the length of a queue. P2Quantile estimates a quantile
+# with the P-square algorithm of Jain and Chlamtac, from five markers that
+# are moved as samples come in. Histogram counts samples in buckets that grow
+# by a constant factor, which keeps the relative error of the tail the same
+# from microseconds to hours. SampleSummary puts these together for a stream
+# of times such as the sojourn times of customers.
+
+import math
+
+# Quantiles SampleSummary estimates
+QUANTILES= [0.5, 0.99, 0.999]
+
+# Histogram buckets grow by this factor from HIST_LOW on, HIST_BUCKETS of
+# them reach from a microsecond to about a million seconds
+HIST_LOW= 1e-6
+HIST_FACTOR= 2 ** 0.25
+HIST_BUCKETS= 160
+
+# Histogram.format puts this many buckets on a line, which makes every line
+# twice as wide as the one before, with bars of at most HIST_WIDTH characters
+HIST_MERGE= 4
+HIST_WIDTH= 50
+
+# Two sided 95% quantiles of Student's t for 1 to 30 degrees of freedom
+T_95= [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+       2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+       2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+Z_95= 1.959964
+
+
+def t_quantile(df):
+    """Two sided 95% quantile of Student's t with df degrees of freedom. Past
+        the table, the Cornish-Fisher expansion around the normal one"""
+    if df <= len(T_95):
+        return T_95[df - 1]
+    z = Z_95
+    return z + (z ** 3 + z) / (4.0 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96.0 * df ** 2)
+
+
+class RunningStats(object):
+    """Mean and variance of samples as they come (Welford)"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def variance(self):
+        if self.n < 2:
+            return float("nan")
+        return self.m2 / (self.n - 1)
+
+    def half_width(self):
+        """Half width of the 95% confidence interval of the mean"""
+        if self.n < 2:
+            return float("inf")
+        return t_quantile(self.n - 1) * math.sqrt(self.variance() / self.n)
+
+    def interval(self):
+        h = self.half_width()
+        return self.mean - h, self.mean + h
+
+
+class TimeAverage(object):
+    """Time weighted mean and variance of a value that changes at events and
+        holds in between, the length of a queue for instance"""
+
+    def __init__(self, start=0.0):
+        self.start = start
+        self.last_t = start
+        self.area = 0.0
+        self.area2 = 0.0
+
+    def update(self, t, value):
+        """value was held from the last update until t"""
+        dt = t - self.last_t
+        self.area += value * dt
+        self.area2 += value * value * dt
+        self.last_t = t
+
+    def mean(self):
+        if self.last_t <= self.start:
+            return 0.0
+        return self.area / (self.last_t - self.start)
+
+    def variance(self):
+        if self.last_t <= self.start:
+            return 0.0
+        m = self.mean()
+        return max(0.0, self.area2 / (self.last_t - self.start) - m * m)
+
+
+class P2Quantile(object):
+    """Estimate of the p quantile, 0 < p < 1, from five markers. Until five
+        samples are in it is the sample quantile"""
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        # Marker heights and positions, the positions they should be at and
+        # how far those move with every sample
+        self.q = []
+        self.n = [1, 2, 3, 4, 5]
+        self.desired = [1.0, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.0]
+        self.step = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def add(self, x):
+        self.count += 1
+        q = self.q
+        if self.count <= 5:
+            q.append(x)
+            q.sort()
+            return
+        n = self.n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.step[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = d > 0 and 1 or -1
+                height = self.parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / float(n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def parabolic(self, i, d):
+        q = self.q
+        n = self.n
+        return q[i] + d / float(n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / float(n[i] - n[i - 1]))
+
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            return self.q[min(self.count - 1, int(math.ceil(self.p * self.count)) - 1)]
+        return self.q[2]
+
+
+class Histogram(object):
+    """Counts of samples in buckets that grow by factor. Bucket 0 holds the
+        samples below low, the last one everything too large for the others"""
+
+    def __init__(self, low=HIST_LOW, factor=HIST_FACTOR, buckets=HIST_BUCKETS):
+        self.low = low
+        self.log_factor = math.log(factor)
+        self.counts = [0] * buckets
+        self.count = 0
+
+    def add(self, x):
+        self.count += 1
+        if x < self.low:
+            self.counts[0] += 1
+        else:
+            i = int(math.log(x / self.low) / self.log_factor) + 1
+            self.counts[min(i, len(self.counts) - 1)] += 1
+
+    def limit(self, i):
+        """Upper limit of bucket i, None for the last one"""
+        if i >= len(self.counts) - 1:
+            return None
+        return self.low * math.exp(i * self.log_factor)
+
+    def quantile(self, p):
+        """Upper limit of the bucket the p quantile is in"""
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if n and seen >= p * self.count:
+                return self.limit(i)
+        return None
+
+    def items(self):
+        """(upper limit, count) of the buckets that have samples"""
+        return [(self.limit(i), n) for (i, n) in enumerate(self.counts) if n]
+
+    def format(self, merge=HIST_MERGE, width=HIST_WIDTH):
+        """Lines of text with a bar per merge buckets, from the first bucket
+            that has samples to the last"""
+        used = [i for (i, n) in enumerate(self.counts) if n]
+        if not used:
+            return []
+        rows = [sum(self.counts[i:i + merge]) for i in range(0, len(self.counts), merge)]
+        most = max(rows)
+        lines = []
+        for row in range(used[0] // merge, used[-1] // merge + 1):
+            limit = self.limit(row * merge + merge - 1)
+            n = rows[row]
+            lines.append("%12s %10d %7.3f%% %s" % (limit is None and "rest" or "< %.4g" % limit, n,
+                                                   100.0 * n / self.count, "#" * int(round(width * float(n) / most))))
+        return lines
+
+
+def quantile_name(p):
+    """p50 for 0.5, p999 for 0.999"""
+    return "p" + ("%g" % (p * 100)).replace(".", "")
+
+
+class SampleSummary(object):
+    """Mean, variance, quantiles and histogram of a stream of samples"""
+
+    def __init__(self, quantiles=QUANTILES):
+        self.stats = RunningStats()
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+        self.hist = Histogram()
+
+    def add(self, x):
+        self.stats.add(x)
+        for estimator in self.quantiles:
+            estimator.add(x)
+        self.hist.add(x)
+
+    def report(self, name):
+        """{name: mean, name_p50: median, ..., name_hist: the Histogram}"""
+        result = {name: self.stats.n and self.stats.mean or 0.0,
+                  name + "_hist": self.hist}
+        for estimator in self.quantiles:
+            result[name + "_" + quantile_name(estimator.p)] = estimator.value()
+        return result